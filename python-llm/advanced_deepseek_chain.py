@@ -3,221 +3,803 @@
 支持对话记忆、上下文管理、多轮对话等功能
 """
 
+import asyncio
+import hashlib
+import logging
 import os
+import threading
+import time
 import uuid
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from itertools import islice
+from typing import Optional, List, Dict, Any, Iterator, AsyncIterator, Tuple, Callable, TYPE_CHECKING
 from dotenv import load_dotenv
-from langchain_core.language_models import LLM
-from langchain_core.callbacks import CallbackManagerForLLMRun
-from langchain_core.prompts import PromptTemplate, ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from openai import OpenAI
-import json
+from message_history import Message, MessageHistory, parse_timestamp
+from session_store import SessionStore, create_session_store
+from session_lock import SessionLocks
+from response_cache import ResponseCache, make_cache_key
+from prompt_registry import PromptRegistry
+from backend_router import get_router
+from metrics import CHAT_LATENCY, COMPACTIONS, TIME_TO_FIRST_TOKEN, cached_prompt_tokens, usage_tokens
+
+if TYPE_CHECKING:
+    from deepseek_client import DeepSeekV3Client
+    from semantic_cache import SemanticCache
 
 # 加载环境变量
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
-class DeepSeekV3LLM(LLM):
-    """DeepSeek V3硅基流动LLM封装 - 高级版本"""
-    
-    model_name: str = "deepseek-ai/DeepSeek-V3"
-    temperature: float = 0.7
-    max_tokens: int = 4096
-    
-    def __init__(self, **kwargs):
-        """初始化DeepSeek V3 LLM"""
-        super().__init__(**kwargs)
-    
-    @property
-    def _llm_type(self) -> str:
-        return "deepseek_v3_advanced"
-    
-    def _get_api_config(self):
-        """获取API配置"""
-        api_key = os.environ.get("SILICON_FLOW_API_KEY", "")
-        api_url = os.environ.get("SILICON_FLOW_API_URL", "https://api.siliconflow.cn/v1")
-        
-        if not api_key:
-            raise ValueError("请设置SILICON_FLOW_API_KEY环境变量")
-        
-        return api_key, api_url
-    
-    def _call(
-        self,
-        prompt: str,
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any
-    ) -> str:
-        """调用DeepSeek V3 API"""
-        try:
-            api_key, api_url = self._get_api_config()
-            
-            client = OpenAI(
-                api_key=api_key,
-                base_url=api_url
-            )
-            
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=self.temperature,
-                max_tokens=self.max_tokens,
-                stop=stop if stop else None
-            )
-            
-            return response.choices[0].message.content or ""
-            
-        except Exception as e:
-            raise Exception(f"API调用失败: {str(e)}")
-    
-    def call_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> str:
-        """使用消息列表调用API（支持多轮对话）"""
-        try:
-            api_key, api_url = self._get_api_config()
-            
-            client = OpenAI(
-                api_key=api_key,
-                base_url=api_url
-            )
-            
-            # 应用kwargs中的参数
-            temperature = kwargs.get('temperature', self.temperature)
-            max_tokens = kwargs.get('max_tokens', self.max_tokens)
-            
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            
-            return response.choices[0].message.content or ""
-            
-        except Exception as e:
-            raise Exception(f"API调用失败: {str(e)}")
+
+def _error_fields(error: Exception) -> Dict[str, Any]:
+    """失败结果中附带的错误分类，供接口层选择状态码"""
+    return {
+        'error_type': getattr(error, 'code', 'internal_error'),
+        'status_code': getattr(error, 'status_code', 500),
+        'retry_after': getattr(error, 'retry_after', None)
+    }
+
+
+# 压缩对话时使用的指令，要求保留后续规划依赖的约束条件
+COMPACTION_PROMPT = (
+    "你负责压缩一段旅行规划对话。请把【已有摘要】和【新增对话】合并成一份新的摘要，"
+    "完整保留用户给出的约束条件（目的地、日期、天数、人数、预算、偏好和禁忌）"
+    "以及已经确定的安排和结论，删去寒暄和重复内容。直接输出摘要正文，不超过300字。"
+)
+SUMMARY_HEADER = "以下是此前对话的摘要：\n"
+
+
+def __getattr__(name: str):
+    """兼容从本模块导入 DeepSeekV3LLM（已移到 deepseek_llm，导入时才加载 langchain_core）"""
+    if name == 'DeepSeekV3LLM':
+        from deepseek_llm import DeepSeekV3LLM
+        return DeepSeekV3LLM
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class ConversationManager:
-    """对话管理器，处理对话历史和上下文"""
+    """对话管理器，处理对话历史和上下文
+    
+    会话按最近活跃时间排序保存在 _activity 中（最久未活跃的在最前），
+    空闲超时清理和超出数量上限时的LRU淘汰都只需从队首开始弹出；
+    会话列表按 _by_activity 中有序的 (last_activity, session_id) 二分定位游标后分页。
+    session_info 中的各类消息计数随 add_message 增量维护，查询摘要无需遍历历史。
+    
+    conversations / session_info 是活跃会话的内存缓存，所有修改同时写入 store；
+    不在缓存中的会话在首次访问时才从 store 加载最近的历史。
+    """
     
-    def __init__(self, max_history: int = 10):
-        self.conversations: Dict[str, List[Dict[str, Any]]] = {}
+    def __init__(
+        self,
+        max_history: int = 10,
+        session_ttl: Optional[float] = None,
+        max_sessions: Optional[int] = None,
+        store: Optional[SessionStore] = None,
+        trim_step: Optional[int] = None
+    ):
+        self.store = store if store is not None else create_session_store()
+        self.conversations: Dict[str, MessageHistory] = {}
         self.max_history = max_history
+        # 前缀稳定模式（LLM_PREFIX_STABLE=1）：历史超出容量或token预算时一次丢弃 trim_step 条
+        # （默认约半个容量，取偶数使每轮的用户消息和回复一起丢弃），期间每轮发送的上下文只在末尾追加，
+        # 系统提示和之前的消息逐字节不变，可以命中上游的前缀缓存；默认逐条滑动
+        if trim_step is None:
+            trim_step = 1
+            if os.environ.get('LLM_PREFIX_STABLE', '').lower() in ('1', 'true', 'yes'):
+                trim_step = int(os.environ.get('LLM_CONTEXT_TRIM_STEP', 0)) or max_history + max_history % 2
+        self.trim_step = min(max(trim_step, 1), max_history * 2)
         self.session_info: Dict[str, Dict[str, Any]] = {}
+        # 空闲超时（秒）与会话数量上限，0 表示不限制
+        self.session_ttl = session_ttl if session_ttl is not None \
+            else float(os.environ.get('SESSION_TTL_SECONDS', 3600))
+        self.max_sessions = max_sessions if max_sessions is not None \
+            else int(os.environ.get('SESSION_MAX_COUNT', 10000))
+        # session_id -> 最近活跃的单调时钟时间
+        self._activity: "OrderedDict[str, float]" = OrderedDict()
+        # 按 (last_activity, session_id) 升序排列的会话，_listed 记录每个会话当前在其中的键
+        self._by_activity: List[Tuple[str, str]] = []
+        self._listed: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.RLock()
+        self._eviction_listeners: List[Callable[[str, str], None]] = []
+        self.eviction_counts = {'idle': 0, 'capacity': 0}
+        self._sweeper: Optional[threading.Thread] = None
+        self._sweeper_stop = threading.Event()
+        # 新会话ID的生成方式，多worker模式下替换为只生成归属本worker的ID
+        self.session_id_factory: Callable[[], str] = lambda: str(uuid.uuid4())
     
     def create_session(self, session_id: str = None) -> str:
         """创建新的对话会话"""
         if session_id is None:
-            session_id = str(uuid.uuid4())
+            session_id = self.session_id_factory()
         
-        self.conversations[session_id] = []
-        self.session_info[session_id] = {
-            'created_at': datetime.now().isoformat(),
-            'last_activity': datetime.now().isoformat(),
-            'message_count': 0
-        }
+        # 系统提示常驻，其余保留最近 max_history 轮（每轮用户和AI各一条）
+        with self._lock:
+            self.conversations[session_id] = MessageHistory(self.max_history * 2, self.trim_step)
+            self.session_info[session_id] = {
+                'created_at': datetime.now().isoformat(),
+                'last_activity': datetime.now().isoformat(),
+                'message_count': 0,
+                'user_messages': 0,
+                'assistant_messages': 0,
+                'prompt_type': 'default'
+            }
+            self.store.save_session(session_id, self.session_info[session_id])
+            self._touch(session_id)
+            evicted = self._evict_over_capacity()
         
+        self._notify_evicted(evicted, 'capacity')
         return session_id
     
-    def add_message(self, session_id: str, role: str, content: str, metadata: Dict = None):
-        """添加消息到对话历史"""
-        if session_id not in self.conversations:
-            self.create_session(session_id)
-        
-        message = {
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now().isoformat(),
-            'metadata': metadata or {}
-        }
+    def _load(self, session_id: str) -> bool:
+        """确保会话在内存缓存中，必要时从存储加载，会话不存在时返回False
         
-        self.conversations[session_id].append(message)
+        读取存储不持有 _lock，磁盘慢或数据库被锁住时只影响正在加载的这个会话。
+        """
+        if session_id in self.conversations:
+            return True
         
-        # 保持历史记录在最大长度内
-        if len(self.conversations[session_id]) > self.max_history * 2:  # *2 因为每轮对话有用户和AI两条消息
-            self.conversations[session_id] = self.conversations[session_id][-self.max_history * 2:]
+        loaded = self.store.load_session(session_id, self.max_history * 2)
+        with self._lock:
+            if session_id in self.conversations:
+                return True
+            if loaded is None:
+                return False
+            info, messages = loaded
+            history = MessageHistory(self.max_history * 2, self.trim_step)
+            summary = info.get('summary')
+            if summary:
+                history.set_summary(Message.from_dict(summary))
+            # 已压缩进摘要的消息不再放回历史
+            through = parse_timestamp(summary['metadata']['through']) if summary else 0.0
+            for message in messages:
+                if message.role == 'system' or message.created > through:
+                    history.append(message)
+            if 'user_messages' not in info:
+                # 旧版本保存的会话没有计数，按加载到的历史补齐
+                info['user_messages'] = sum(1 for message in history if message.role == 'user')
+                info['assistant_messages'] = sum(1 for message in history if message.role == 'assistant')
+                info['prompt_type'] = history.system.meta('prompt_type', 'default') if history.system else 'default'
+            self.conversations[session_id] = history
+            self.session_info[session_id] = info
+            self._touch(session_id)
+            evicted = self._evict_over_capacity()
         
-        # 更新会话信息
-        self.session_info[session_id]['last_activity'] = datetime.now().isoformat()
-        self.session_info[session_id]['message_count'] += 1
+        self._notify_evicted(evicted, 'capacity')
+        return True
+    
+    def has_session(self, session_id: str) -> bool:
+        """会话是否存在（内存或存储中）"""
+        return bool(session_id) and self._load(session_id)
+    
+    def get_history(self, session_id: str) -> Optional[MessageHistory]:
+        """获取会话的消息历史，会话不存在时返回None"""
+        if not self._load(session_id):
+            return None
+        return self.conversations.get(session_id)
+    
+    def add_message(self, session_id: str, role: str, content: str, metadata: Dict = None):
+        """添加消息到对话历史"""
+        message = Message(role, content, metadata=metadata)
+        
+        # 先在锁外加载；持锁后再检查一次，避免检查与写入之间会话被后台清理
+        self._load(session_id)
+        with self._lock:
+            if not self._load(session_id):
+                self.create_session(session_id)
+            
+            # 环形缓冲区自动淘汰最旧的消息，系统提示不受影响
+            self.conversations[session_id].append(message)
+            
+            # 更新会话信息
+            info = self.session_info[session_id]
+            info['message_count'] += 1
+            if role == 'user':
+                info['user_messages'] += 1
+            elif role == 'assistant':
+                info['assistant_messages'] += 1
+            elif role == 'system':
+                info['prompt_type'] = message.meta('prompt_type', 'default')
+                info['prompt_version'] = message.meta('prompt_version')
+            self._touch(session_id)
+            
+            self.store.append_message(session_id, message)
+            self.store.save_session(session_id, self.session_info[session_id])
+    
+    def record_usage(self, session_id: str, usage):
+        """累计会话的上游token用量，其中 prompt_cache_hit_tokens 为命中前缀缓存的提示词token"""
+        with self._lock:
+            info = self.session_info.get(session_id)
+            if info is None:
+                return
+            totals = info.setdefault('usage', {'prompt_tokens': 0, 'prompt_cache_hit_tokens': 0, 'completion_tokens': 0})
+            totals['prompt_tokens'] += usage_tokens(usage, 'prompt_tokens')
+            totals['prompt_cache_hit_tokens'] += cached_prompt_tokens(usage)
+            totals['completion_tokens'] += usage_tokens(usage, 'completion_tokens')
     
     def get_conversation_history(self, session_id: str) -> List[Dict[str, str]]:
         """获取对话历史（OpenAI API格式）"""
-        if session_id not in self.conversations:
+        history = self.get_history(session_id)
+        if history is None:
             return []
         
-        return [
-            {'role': msg['role'], 'content': msg['content']}
-            for msg in self.conversations[session_id]
+        # 后台压缩和其他请求持 _lock 修改历史，读取时同样持锁，不会看到折叠了一半的历史
+        with self._lock:
+            return history.api_messages()
+    
+    def page_messages(
+        self,
+        session_id: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        since: Optional[str] = None
+    ) -> Optional[Tuple[List[Dict[str, str]], int]]:
+        """分页读取内存历史中的用户和AI消息，返回 (本页消息, 符合条件的总条数)，会话不存在时返回None
+        
+        since 为ISO时间戳，只返回其后的消息；返回的是不含 metadata 的字典。
+        """
+        if not self._load(session_id):
+            return None
+        
+        after = parse_timestamp(since) if since else None
+        with self._lock:
+            history = self.conversations.get(session_id)
+            if history is None:
+                return None
+            matched = [
+                message for message in history
+                if message.role in ('user', 'assistant') and (after is None or message.created > after)
+            ]
+        
+        end = None if limit is None else offset + limit
+        page = [
+            {'role': message.role, 'content': message.content, 'timestamp': message.timestamp}
+            for message in islice(matched, offset, end)
         ]
+        return page, len(matched)
+    
+    def iter_messages(self, session_id: str) -> Optional[Iterator[Message]]:
+        """按顺序逐条返回会话的全部消息，会话不存在时返回None
+        
+        存储支持时直接从存储分批读取（包含已被环形缓冲区淘汰或压缩进摘要的消息），
+        否则持锁复制一份内存历史。
+        """
+        if not self._load(session_id):
+            return None
+        
+        messages = self.store.iter_messages(session_id)
+        if messages is not None:
+            return messages
+        with self._lock:
+            history = self.conversations.get(session_id)
+            return iter(list(history)) if history is not None else None
+    
+    def snapshot_messages(self, session_id: str) -> Optional[List[Dict[str, Any]]]:
+        """持锁把内存历史（含系统提示和摘要）转为接口格式，会话不存在时返回None"""
+        if not self._load(session_id):
+            return None
+        with self._lock:
+            history = self.conversations.get(session_id)
+            if history is None:
+                return None
+            return [message.to_dict() for message in history]
+    
+    def get_context_window(self, session_id: str, max_tokens: int) -> Tuple[List[Dict[str, str]], int]:
+        """按token预算获取对话上下文（OpenAI API格式）及其估算token数"""
+        history = self.get_history(session_id)
+        if history is None:
+            return [], 0
+        
+        with self._lock:
+            return history.window(max_tokens)
     
     def get_session_info(self, session_id: str) -> Dict[str, Any]:
         """获取会话信息"""
+        self._load(session_id)
         return self.session_info.get(session_id, {})
     
+    def update_session_info(self, session_id: str, **fields):
+        """更新会话元数据"""
+        if not self._load(session_id):
+            return
+        with self._lock:
+            if self._load(session_id):
+                self.session_info[session_id].update(fields)
+                self.store.save_session(session_id, self.session_info[session_id])
+    
     def clear_session(self, session_id: str):
         """清空会话"""
-        if session_id in self.conversations:
-            self.conversations[session_id] = []
-            self.session_info[session_id]['message_count'] = 0
+        if not self._load(session_id):
+            return
+        with self._lock:
+            if self._load(session_id):
+                # 保留系统提示，会话角色不变
+                self.conversations[session_id].clear()
+                info = self.session_info[session_id]
+                info['message_count'] = 0
+                info['user_messages'] = 0
+                info['assistant_messages'] = 0
+                info.pop('summary', None)
+                self.store.clear_messages(session_id)
+                self.store.save_session(session_id, self.session_info[session_id])
+    
+    def oldest_messages(self, session_id: str, keep_recent: int) -> Optional[Tuple[MessageHistory, int, List[Dict[str, Any]]]]:
+        """持锁取出除最近 keep_recent 条以外的消息，返回 (history, generation, messages)"""
+        with self._lock:
+            history = self.conversations.get(session_id)
+            if history is None:
+                return None
+            return history, history.generation, history.oldest(history.recent_count - keep_recent)
+    
+    def apply_summary(
+        self,
+        session_id: str,
+        history: MessageHistory,
+        generation: int,
+        folded: List[Dict[str, Any]],
+        content: str
+    ) -> bool:
+        """把后台生成的摘要写回会话；压缩期间会话被清空、删除或淘汰时放弃，返回是否写入"""
+        with self._lock:
+            if self.conversations.get(session_id) is not history or history.generation != generation:
+                return False
+            previous = history.summary.meta('folded_messages', 0) if history.summary else 0
+            summary = Message('system', content, metadata={
+                'summary': True,
+                # 最后一条被折叠消息的时间，从存储恢复时据此跳过已折叠的消息
+                'through': folded[-1].timestamp,
+                'folded_messages': previous + len(folded)
+            })
+            history.compact(folded, summary)
+            self.session_info[session_id]['summary'] = summary.to_dict()
+            self.store.save_session(session_id, self.session_info[session_id])
+            return True
     
     def delete_session(self, session_id: str):
         """删除会话"""
-        if session_id in self.conversations:
-            del self.conversations[session_id]
-        if session_id in self.session_info:
-            del self.session_info[session_id]
+        with self._lock:
+            self._remove(session_id)
+            self.store.delete_session(session_id)
+    
+    def _touch(self, session_id: str):
+        """把会话移到活跃队列末尾并更新 last_activity 及其在 _by_activity 中的位置（调用方需持有锁）"""
+        self._activity[session_id] = time.monotonic()
+        self._activity.move_to_end(session_id)
+        self._unlist(session_id)
+        info = self.session_info.get(session_id)
+        if info is not None:
+            info['last_activity'] = datetime.now().isoformat()
+            key = (info['last_activity'], session_id)
+            insort(self._by_activity, key)
+            self._listed[session_id] = key
+    
+    def _unlist(self, session_id: str):
+        """从 _by_activity 中移除会话（调用方需持有锁）"""
+        key = self._listed.pop(session_id, None)
+        if key is not None:
+            del self._by_activity[bisect_left(self._by_activity, key)]
+    
+    def list_sessions(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None,
+        prompt_type: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """按 last_activity 从新到旧分页列出内存中的会话，返回 (本页会话, 下一页游标)
+        
+        游标为上一页最后一条的 "last_activity,session_id"，会话在翻页期间变得活跃也不会重复出现；
+        按游标二分定位后向前扫描，每页的代价只与本页条数（及被 prompt_type 过滤掉的条数）有关。
+        """
+        after = tuple(cursor.split(',', 1)) if cursor else None
+        sessions = []
+        with self._lock:
+            end = bisect_left(self._by_activity, after) if after is not None else len(self._by_activity)
+            for index in range(end - 1, -1, -1):
+                session_id = self._by_activity[index][1]
+                info = self.session_info[session_id]
+                if prompt_type and info.get('prompt_type', 'default') != prompt_type:
+                    continue
+                sessions.append({
+                    'session_id': session_id,
+                    'created_at': info.get('created_at'),
+                    'last_activity': info['last_activity'],
+                    'prompt_type': info.get('prompt_type', 'default'),
+                    'message_count': info.get('message_count', 0),
+                    'user_messages': info.get('user_messages', 0),
+                    'assistant_messages': info.get('assistant_messages', 0)
+                })
+                if len(sessions) >= limit:
+                    break
+        
+        next_cursor = None
+        if len(sessions) >= limit:
+            last = sessions[-1]
+            next_cursor = f"{last['last_activity']},{last['session_id']}"
+        return sessions, next_cursor
+    
+    def _remove(self, session_id: str):
+        """从内存缓存中移除会话（调用方需持有锁）"""
+        self.conversations.pop(session_id, None)
+        self.session_info.pop(session_id, None)
+        self._activity.pop(session_id, None)
+        self._unlist(session_id)
+    
+    def _evict_over_capacity(self) -> List[str]:
+        """淘汰最久未活跃的会话直到不超过数量上限（调用方需持有锁）"""
+        evicted = []
+        if self.max_sessions <= 0:
+            return evicted
+        while len(self._activity) > self.max_sessions:
+            session_id = next(iter(self._activity))
+            self._remove(session_id)
+            evicted.append(session_id)
+        self.eviction_counts['capacity'] += len(evicted)
+        return evicted
+    
+    def evict_expired(self) -> int:
+        """清理空闲超时的会话，返回从内存中移除的数量
+        
+        队列按活跃时间有序，遇到第一个未超时的会话即可停止。
+        存储中超时的会话按其中记录的最近活跃时间删除，多个进程共享存储时同样准确。
+        """
+        if self.session_ttl <= 0:
+            return 0
+        
+        deadline = time.monotonic() - self.session_ttl
+        evicted = []
+        with self._lock:
+            while self._activity:
+                session_id, last_seen = next(iter(self._activity.items()))
+                if last_seen > deadline:
+                    break
+                self._remove(session_id)
+                evicted.append(session_id)
+            self.eviction_counts['idle'] += len(evicted)
+        
+        self._notify_evicted(evicted, 'idle')
+        self.store.purge_expired(self.session_ttl)
+        return len(evicted)
+    
+    def add_eviction_listener(self, listener: Callable[[str, str], None]):
+        """注册会话被淘汰时的回调，参数为 (session_id, reason)"""
+        self._eviction_listeners.append(listener)
+    
+    def _notify_evicted(self, session_ids: List[str], reason: str):
+        for session_id in session_ids:
+            for listener in self._eviction_listeners:
+                try:
+                    listener(session_id, reason)
+                except Exception as e:
+                    logger.error(f"会话淘汰回调失败: {str(e)}")
+    
+    def start_sweeper(self, interval: Optional[float] = None):
+        """启动后台线程定期清理空闲会话"""
+        if self._sweeper is not None or self.session_ttl <= 0:
+            return
+        if interval is None:
+            interval = float(os.environ.get('SESSION_SWEEP_INTERVAL', 60))
+        
+        def run():
+            while not self._sweeper_stop.wait(interval):
+                try:
+                    evicted = self.evict_expired()
+                    if evicted:
+                        logger.info(f"清理空闲会话 {evicted} 个")
+                except Exception as e:
+                    logger.error(f"清理空闲会话失败: {str(e)}")
+        
+        self._sweeper_stop.clear()
+        self._sweeper = threading.Thread(target=run, name='session-sweeper', daemon=True)
+        self._sweeper.start()
+    
+    def stop_sweeper(self):
+        """停止后台清理线程"""
+        if self._sweeper is None:
+            return
+        self._sweeper_stop.set()
+        self._sweeper.join()
+        self._sweeper = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """会话数量及淘汰统计"""
+        with self._lock:
+            return {
+                'live_sessions': len(self._activity),
+                'max_sessions': self.max_sessions,
+                'session_ttl': self.session_ttl,
+                'evictions': dict(self.eviction_counts),
+                'trim_step': self.trim_step,
+                'store': self.store.name
+            }
+    
+    def close(self):
+        """停止后台清理并提交存储中尚未写入的数据"""
+        self.stop_sweeper()
+        self.store.close()
 
 
 class AdvancedDeepSeekChain:
     """高级DeepSeek对话链条"""
     
-    def __init__(self, max_history: int = 10):
-        self.llm = DeepSeekV3LLM()
+    def __init__(
+        self,
+        max_history: int = 10,
+        max_concurrency: Optional[int] = None,
+        max_context_tokens: Optional[int] = None,
+        response_cache: Optional[ResponseCache] = None,
+        semantic_cache: Optional['SemanticCache'] = None,
+        prompt_registry: Optional[PromptRegistry] = None
+    ):
+        # 上游调用客户端在第一次使用时才创建（导入 openai 较慢），见 llm 属性
+        self._llm: Optional['DeepSeekV3Client'] = None
+        self._llm_lock = threading.Lock()
         self.conversation_manager = ConversationManager(max_history)
-        self.system_prompts = {
-            'default': "你是DeepSeek V3智能助手，一个友好、专业且乐于助人的AI。请用中文回答问题。",
-            'travel': "你是一个专业的旅行规划师，擅长制定详细的旅行计划、推荐景点和提供旅行建议。",
-            'writing': "你是一个专业的写作助手，擅长协助用户进行各种类型的写作，包括文章、报告、创意写作等。",
-            'code': "你是一个编程专家，擅长多种编程语言，能够帮助用户解决编程问题、编写代码、解释算法等。"
-        }
+        # 上下文token预算（含预留的输出token），未设置时仅按消息条数截断
+        self.max_context_tokens = max_context_tokens or int(os.environ.get('LLM_MAX_CONTEXT_TOKENS', 0)) or None
+        # 异步路径上同时进行的上游调用数上限
+        self.max_concurrency = max_concurrency or int(os.environ.get('LLM_MAX_CONCURRENCY', 64))
+        self._upstream_semaphore: Optional[asyncio.Semaphore] = None
+        # 同一会话的对话轮次依次执行，不同会话互不阻塞
+        self.session_locks = SessionLocks()
+        # 回复缓存（LLM_RESPONSE_CACHE=1 时启用），仅用于低温度或调用方标记为可缓存的请求
+        if response_cache is None and os.environ.get('LLM_RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes'):
+            response_cache = ResponseCache()
+        self.response_cache = response_cache
+        self.cache_max_temperature = float(os.environ.get('LLM_CACHE_MAX_TEMPERATURE', 0.2))
+        # 语义缓存（LLM_SEMANTIC_CACHE=1 时启用）：会话第一轮的提问按相似度复用回复，适用条件与回复缓存相同
+        if semantic_cache is None and os.environ.get('LLM_SEMANTIC_CACHE', '').lower() in ('1', 'true', 'yes'):
+            from semantic_cache import SemanticCache
+            semantic_cache = SemanticCache()
+        self.semantic_cache = semantic_cache
+        # 对话压缩（LLM_COMPACTION=1 时启用）：未压缩的消息达到 compaction_trigger 条时，
+        # 在后台把除最近 compaction_keep_recent 条以外的消息折叠进滚动摘要
+        self.compaction_enabled = os.environ.get('LLM_COMPACTION', '').lower() in ('1', 'true', 'yes')
+        # 默认在环形缓冲区装满前留出两轮余量触发，每次至少折叠两轮，避免每轮都调用一次模型
+        capacity = self.conversation_manager.max_history * 2
+        keep_recent = int(os.environ.get('LLM_COMPACTION_KEEP_RECENT', 4))
+        self.compaction_trigger = int(os.environ.get('LLM_COMPACTION_TRIGGER', 0)) \
+            or min(max(capacity - 4, keep_recent + 4), capacity)
+        self.compaction_keep_recent = min(keep_recent, self.compaction_trigger - 2)
+        self.compaction_max_tokens = int(os.environ.get('LLM_COMPACTION_MAX_TOKENS', 512))
+        self._compaction_executor: Optional[ThreadPoolExecutor] = None
+        self._compacting = set()
+        self._compaction_lock = threading.Lock()
+        self.compaction_counts = {'completed': 0, 'discarded': 0, 'failed': 0, 'messages_folded': 0}
+        # 系统提示模板（内置模板 + PROMPT_TEMPLATE_DIR 中可热更新的模板）
+        self.prompt_registry = prompt_registry or PromptRegistry()
     
-    def create_session(self, system_prompt_type: str = 'default') -> str:
-        """创建新的对话会话"""
+    @property
+    def llm(self) -> 'DeepSeekV3Client':
+        """上游调用客户端，第一次访问时导入并创建；也可以替换为 DeepSeekV3LLM 等兼容对象"""
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    from deepseek_client import DeepSeekV3Client
+                    self._llm = DeepSeekV3Client()
+        return self._llm
+    
+    @llm.setter
+    def llm(self, llm: 'DeepSeekV3Client'):
+        self._llm = llm
+    
+    @property
+    def llm_ready(self) -> bool:
+        return self._llm is not None
+    
+    def warm_up(self):
+        """提前创建上游调用客户端和各后端的HTTP客户端（只加载模块、建立连接池对象，不发送请求），使第一个请求不必等待导入"""
+        start = time.perf_counter()
+        try:
+            self.llm
+            for backend in get_router().backends:
+                backend.client()
+        except Exception as e:
+            logger.warning(f"预加载LLM失败，将在第一次请求时重试: {str(e)}")
+            return
+        logger.info(f"LLM预加载完成，用时 {time.perf_counter() - start:.2f}秒")
+    
+    @property
+    def system_prompts(self) -> Dict[str, str]:
+        """各系统提示类型的模板原文"""
+        return {name: self.prompt_registry.get(name).source for name in self.prompt_registry.names()}
+    
+    def create_session(self, system_prompt_type: str = 'default', variables: Optional[Dict[str, Any]] = None) -> str:
+        """创建新的对话会话
+        
+        系统提示由 system_prompt_type 对应的模板和 variables 渲染一次，之后随会话保存；
+        模板不存在或缺少必需的变量时抛出 ValueError。
+        """
+        template, values, system_prompt = self.prompt_registry.render(system_prompt_type, variables)
         session_id = self.conversation_manager.create_session()
         
         # 添加系统提示
-        system_prompt = self.system_prompts.get(system_prompt_type, self.system_prompts['default'])
-        self.conversation_manager.add_message(
-            session_id, 
-            'system', 
-            system_prompt,
-            {'prompt_type': system_prompt_type}
-        )
+        metadata = {'prompt_type': template.name, 'prompt_version': template.version}
+        if values:
+            metadata['prompt_variables'] = values
+        self.conversation_manager.add_message(session_id, 'system', system_prompt, metadata)
+        self.prompt_registry.record_session(template.name, template.version)
         
         return session_id
     
-    def chat(self, session_id: str, user_message: str, **kwargs) -> Dict[str, Any]:
-        """进行对话"""
-        try:
-            # 检查会话是否存在
-            if session_id not in self.conversation_manager.conversations:
-                session_id = self.create_session()
-            
-            # 添加用户消息
-            self.conversation_manager.add_message(session_id, 'user', user_message)
-            
+    def _prepare_turn(
+        self,
+        session_id: str,
+        user_message: str,
+        max_tokens: Optional[int] = None
+    ) -> Tuple[str, List[Dict[str, str]]]:
+        """记录用户消息并返回本轮要发送的上下文"""
+        # 检查会话是否存在
+        if not self.conversation_manager.has_session(session_id):
+            session_id = self.create_session()
+        
+        # 添加用户消息
+        self.conversation_manager.add_message(session_id, 'user', user_message)
+        
+        if not self.max_context_tokens:
             # 获取对话历史
             messages = self.conversation_manager.get_conversation_history(session_id)
+            return session_id, messages
+        
+        # token预算模式：为输出预留 max_tokens，其余装入系统提示和最新的若干轮
+        budget = self.max_context_tokens - (max_tokens or self.llm.max_tokens)
+        messages, context_tokens = self.conversation_manager.get_context_window(session_id, budget)
+        self.conversation_manager.update_session_info(session_id, last_context_tokens=context_tokens)
+        return session_id, messages
+    
+    def _session_prompt_type(self, session_id: str) -> str:
+        """会话创建时选择的系统提示类型"""
+        return self._session_prompt(session_id)[0]
+    
+    def _session_prompt(self, session_id: str) -> Tuple[str, Optional[int]]:
+        """会话创建时使用的 (系统提示类型, 模板版本)"""
+        history = self.conversation_manager.get_history(session_id)
+        if history is not None and history.system is not None:
+            return history.system.meta('prompt_type', 'default'), history.system.meta('prompt_version')
+        return 'default', None
+    
+    def _with_model(self, session_id: str, model_params: Dict[str, Any]) -> Dict[str, Any]:
+        """未显式指定模型时，按会话的系统提示类型选择模型"""
+        if model_params.get('model'):
+            return model_params
+        return {'model': get_router().model_for_prompt(self._session_prompt_type(session_id)), **model_params}
+    
+    def _usage_recorder(self, session_id: str) -> Callable[[Any], None]:
+        """把上游返回的用量累计到会话信息和所用模板的统计中"""
+        prompt_type, version = self._session_prompt(session_id)
+        
+        def record(usage):
+            self.conversation_manager.record_usage(session_id, usage)
+            self.prompt_registry.record_usage(prompt_type, version, usage)
+        
+        return record
+    
+    def _observe_turn(self, session_id: str, mode: str, outcome: str, start: float):
+        """记录一轮对话的耗时（按系统提示类型、调用方式和结果分组）"""
+        elapsed = time.perf_counter() - start
+        prompt_type, version = self._session_prompt(session_id)
+        CHAT_LATENCY.observe(elapsed, prompt_type=prompt_type, mode=mode, outcome=outcome)
+        self.prompt_registry.record_turn(prompt_type, version, elapsed, ok=outcome != 'error')
+    
+    def _response_cache_key(
+        self,
+        session_id: str,
+        messages: List[Dict[str, str]],
+        cacheable: bool,
+        model_params: Dict[str, Any]
+    ) -> Optional[str]:
+        """本轮请求可以使用缓存时返回缓存键，否则返回None"""
+        if self.response_cache is None:
+            return None
+        
+        temperature = model_params.get('temperature', self.llm.temperature)
+        if not cacheable and temperature > self.cache_max_temperature:
+            return None
+        
+        return make_cache_key(
+            self._session_prompt_type(session_id),
+            messages,
+            temperature,
+            model_params.get('max_tokens', self.llm.max_tokens)
+        )
+    
+    def _semantic_partition(
+        self,
+        session_id: str,
+        cacheable: bool,
+        model_params: Dict[str, Any]
+    ) -> Optional[str]:
+        """本轮是会话第一轮且可以使用缓存时，返回语义缓存的分区（系统提示类型及其内容、模型和 max_tokens）"""
+        if self.semantic_cache is None:
+            return None
+        
+        # 按会话的完整历史判断：token预算或前缀稳定模式下，后面的轮次截断后也可能只剩系统提示和本轮消息
+        info = self.conversation_manager.get_session_info(session_id)
+        if info.get('user_messages') != 1 or info.get('assistant_messages') or info.get('summary'):
+            return None
+        
+        temperature = model_params.get('temperature', self.llm.temperature)
+        if not cacheable and temperature > self.cache_max_temperature:
+            return None
+        
+        # 同一类型的模板可能有不同版本或变量，按渲染后的系统提示区分
+        history = self.conversation_manager.get_history(session_id)
+        system = history.system.content if history is not None and history.system is not None else ''
+        system_digest = hashlib.sha1(system.encode('utf-8')).hexdigest()[:12] if system else ''
+        return '|'.join((
+            self._session_prompt_type(session_id),
+            system_digest,
+            str(model_params.get('model')),
+            str(model_params.get('max_tokens', self.llm.max_tokens))
+        ))
+    
+    def _cached_response(
+        self,
+        cache_key: Optional[str],
+        partition: Optional[str],
+        user_message: str
+    ) -> Tuple[Optional[str], Dict[str, Any]]:
+        """依次查找回复缓存和语义缓存，返回 (回复, 写入消息元数据的命中信息)"""
+        if cache_key:
+            ai_response = self.response_cache.get(cache_key)
+            if ai_response is not None:
+                return ai_response, {'cached': True}
+        if partition:
+            hit = self.semantic_cache.get(partition, user_message)
+            if hit is not None:
+                return hit[0], {'cached': True, 'semantic_similarity': round(hit[1], 4)}
+        return None, {'cached': False}
+    
+    def _store_response(
+        self,
+        cache_key: Optional[str],
+        partition: Optional[str],
+        user_message: str,
+        ai_response: str
+    ):
+        if not ai_response:
+            return
+        if cache_key:
+            self.response_cache.put(cache_key, ai_response)
+        if partition:
+            self.semantic_cache.put(partition, user_message, ai_response)
+    
+    def _turn_lock(self, session_id: Optional[str]):
+        """同一会话的对话轮次依次执行；未指定会话时会新建会话，无需加锁"""
+        return self.session_locks.hold(session_id) if session_id else nullcontext()
+    
+    def _aturn_lock(self, session_id: Optional[str]):
+        return self.session_locks.ahold(session_id) if session_id else nullcontext()
+    
+    def chat(self, session_id: str, user_message: str, cacheable: bool = False, **kwargs) -> Dict[str, Any]:
+        """进行对话
+        
+        启用回复缓存时，temperature 不高于 cache_max_temperature 或 cacheable=True 的请求会复用相同上下文的回复；
+        启用语义缓存时，这类请求在会话第一轮还会复用相似提问的回复（返回 semantic_similarity）。
+        同一会话的并发请求依次执行，每轮的用户消息和回复在历史中相邻。
+        """
+        with self._turn_lock(session_id):
+            return self._chat(session_id, user_message, cacheable, **kwargs)
+    
+    def _chat(self, session_id: str, user_message: str, cacheable: bool = False, **kwargs) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            session_id, messages = self._prepare_turn(session_id, user_message, kwargs.get('max_tokens'))
+            kwargs = self._with_model(session_id, kwargs)
+            cache_key = self._response_cache_key(session_id, messages, cacheable, kwargs)
+            partition = self._semantic_partition(session_id, cacheable, kwargs)
             
             # 调用LLM
-            start_time = datetime.now()
-            ai_response = self.llm.call_with_messages(messages, **kwargs)
-            end_time = datetime.now()
+            llm_start = time.perf_counter()
+            ai_response, cache_info = self._cached_response(cache_key, partition, user_message)
+            cached = cache_info['cached']
+            if not cached:
+                ai_response = self.llm.call_with_messages(messages, on_usage=self._usage_recorder(session_id), **kwargs)
+                self._store_response(cache_key, partition, user_message, ai_response)
+            response_time = time.perf_counter() - llm_start
             
             # 添加AI响应
             self.conversation_manager.add_message(
@@ -225,68 +807,371 @@ class AdvancedDeepSeekChain:
                 'assistant', 
                 ai_response,
                 {
-                    'response_time': (end_time - start_time).total_seconds(),
+                    'response_time': response_time,
+                    **cache_info,
+                    'model_params': kwargs
+                }
+            )
+            
+            self._observe_turn(session_id, 'sync', 'cached' if cached else 'ok', start)
+            self._maybe_compact(session_id)
+            return {
+                'success': True,
+                'session_id': session_id,
+                'response': ai_response,
+                'message_count': len(messages) + 1,
+                'response_time': response_time,
+                **cache_info
+            }
+            
+        except Exception as e:
+            self._observe_turn(session_id, 'sync', 'error', start)
+            return {
+                'success': False,
+                'error': str(e),
+                'session_id': session_id,
+                **_error_fields(e)
+            }
+    
+    def chat_stream(self, session_id: str, user_message: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        """流式对话，依次产出 start / delta / done（或 error）事件
+        
+        生成器结束或被调用方提前关闭时，已生成的内容都会写入对话历史。
+        会话锁从第一次迭代开始持有，直到回复写入历史。
+        """
+        with self._turn_lock(session_id):
+            yield from self._chat_stream(session_id, user_message, **kwargs)
+    
+    def _chat_stream(self, session_id: str, user_message: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        try:
+            session_id, messages = self._prepare_turn(session_id, user_message, kwargs.get('max_tokens'))
+            kwargs = self._with_model(session_id, kwargs)
+        except Exception as e:
+            yield {'type': 'error', 'error': str(e), 'session_id': session_id, **_error_fields(e)}
+            return
+        
+        yield {'type': 'start', 'session_id': session_id}
+        
+        start = time.perf_counter()
+        first_token_time = None
+        parts: List[str] = []
+        completed = False
+        try:
+            for delta in self.llm.stream_with_messages(messages, on_usage=self._usage_recorder(session_id), **kwargs):
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start
+                parts.append(delta)
+                yield {'type': 'delta', 'content': delta}
+            completed = True
+        except Exception as e:
+            yield {'type': 'error', 'error': str(e), 'session_id': session_id, **_error_fields(e)}
+        finally:
+            total_time = time.perf_counter() - start
+            self._finish_stream(session_id, parts, completed, first_token_time, total_time, kwargs)
+        
+        if completed:
+            yield {
+                'type': 'done',
+                'session_id': session_id,
+                'message_count': len(messages) + 1,
+                'response_time': total_time,
+                'time_to_first_token': first_token_time
+            }
+    
+    def _finish_stream(
+        self,
+        session_id: str,
+        parts: List[str],
+        completed: bool,
+        first_token_time: Optional[float],
+        total_time: float,
+        model_params: Dict[str, Any]
+    ):
+        """流式结束（完成、出错或被中断）时记录耗时并写入已生成的回复"""
+        prompt_type, version = self._session_prompt(session_id)
+        outcome = 'ok' if completed else ('aborted' if parts else 'error')
+        CHAT_LATENCY.observe(total_time, prompt_type=prompt_type, mode='stream', outcome=outcome)
+        self.prompt_registry.record_turn(prompt_type, version, total_time, ok=outcome != 'error')
+        if first_token_time is not None:
+            TIME_TO_FIRST_TOKEN.observe(first_token_time, prompt_type=prompt_type)
+        self.conversation_manager.update_session_info(
+            session_id,
+            last_time_to_first_token=first_token_time,
+            last_response_time=total_time
+        )
+        if parts:
+            self.conversation_manager.add_message(
+                session_id,
+                'assistant',
+                ''.join(parts),
+                {
+                    'response_time': total_time,
+                    'time_to_first_token': first_token_time,
+                    'aborted': not completed,
+                    'model_params': model_params
+                }
+            )
+            self._maybe_compact(session_id)
+    
+    def _maybe_compact(self, session_id: str):
+        """历史较长时提交后台压缩任务，不阻塞当前请求；同一会话同时只有一个压缩任务"""
+        if not self.compaction_enabled:
+            return
+        history = self.conversation_manager.get_history(session_id)
+        if history is None or history.recent_count < self.compaction_trigger:
+            return
+        with self._compaction_lock:
+            if session_id in self._compacting:
+                return
+            self._compacting.add(session_id)
+            if self._compaction_executor is None:
+                self._compaction_executor = ThreadPoolExecutor(
+                    max_workers=int(os.environ.get('LLM_COMPACTION_WORKERS', 2)),
+                    thread_name_prefix='compaction'
+                )
+        self._compaction_executor.submit(self._compact, session_id)
+    
+    def _compact(self, session_id: str):
+        """把较早的消息连同已有摘要交给模型压缩成新的摘要"""
+        try:
+            snapshot = self.conversation_manager.oldest_messages(session_id, self.compaction_keep_recent)
+            if snapshot is None or not snapshot[2]:
+                return
+            history, generation, folded = snapshot
+            previous = history.summary.content[len(SUMMARY_HEADER):] if history.summary else '（无）'
+            transcript = '\n'.join(
+                f"{'用户' if message.role == 'user' else 'AI'}：{message.content}" for message in folded
+            )
+            content = self.llm.call_with_messages(
+                [
+                    {'role': 'system', 'content': COMPACTION_PROMPT},
+                    {'role': 'user', 'content': f"【已有摘要】\n{previous}\n\n【新增对话】\n{transcript}"}
+                ],
+                on_usage=self._usage_recorder(session_id),
+                # 压缩不是用户在等的请求，配额紧张时排在交互请求之后
+                **self._with_model(session_id, {
+                    'temperature': 0.2,
+                    'max_tokens': self.compaction_max_tokens,
+                    'priority': 'batch'
+                })
+            ).strip()
+            if not content:
+                raise ValueError("模型返回了空摘要")
+            
+            applied = self.conversation_manager.apply_summary(
+                session_id, history, generation, folded, SUMMARY_HEADER + content
+            )
+            with self._compaction_lock:
+                if applied:
+                    self.compaction_counts['completed'] += 1
+                    self.compaction_counts['messages_folded'] += len(folded)
+                else:
+                    self.compaction_counts['discarded'] += 1
+            COMPACTIONS.inc(outcome='completed' if applied else 'discarded')
+            if applied:
+                logger.info(f"会话 {session_id} 已将 {len(folded)} 条消息压缩进摘要")
+        except Exception as e:
+            with self._compaction_lock:
+                self.compaction_counts['failed'] += 1
+            COMPACTIONS.inc(outcome='failed')
+            logger.warning(f"会话 {session_id} 压缩失败: {str(e)}")
+        finally:
+            with self._compaction_lock:
+                self._compacting.discard(session_id)
+    
+    def get_compaction_stats(self) -> Dict[str, Any]:
+        """对话压缩的配置和统计"""
+        with self._compaction_lock:
+            return {
+                'enabled': self.compaction_enabled,
+                'trigger_messages': self.compaction_trigger,
+                'keep_recent': self.compaction_keep_recent,
+                'in_progress': len(self._compacting),
+                **self.compaction_counts
+            }
+    
+    def _get_upstream_semaphore(self) -> asyncio.Semaphore:
+        """延迟创建信号量，使其绑定到服务运行的事件循环"""
+        if self._upstream_semaphore is None:
+            self._upstream_semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._upstream_semaphore
+    
+    async def achat(self, session_id: str, user_message: str, cacheable: bool = False, **kwargs) -> Dict[str, Any]:
+        """异步对话，返回结构与 chat 相同"""
+        async with self._aturn_lock(session_id):
+            return await self._achat(session_id, user_message, cacheable, **kwargs)
+    
+    async def _achat(self, session_id: str, user_message: str, cacheable: bool = False, **kwargs) -> Dict[str, Any]:
+        turn_start = time.perf_counter()
+        try:
+            # 加载会话可能读磁盘或等待 sqlite 落盘，放到线程里避免阻塞事件循环
+            session_id, messages = await asyncio.to_thread(
+                self._prepare_turn, session_id, user_message, kwargs.get('max_tokens')
+            )
+            kwargs = self._with_model(session_id, kwargs)
+            cache_key = self._response_cache_key(session_id, messages, cacheable, kwargs)
+            partition = self._semantic_partition(session_id, cacheable, kwargs)
+            
+            start = time.perf_counter()
+            ai_response, cache_info = self._cached_response(cache_key, partition, user_message)
+            cached = cache_info['cached']
+            if not cached:
+                async with self._get_upstream_semaphore():
+                    ai_response = await self.llm.acall_with_messages(
+                        messages, on_usage=self._usage_recorder(session_id), **kwargs
+                    )
+                self._store_response(cache_key, partition, user_message, ai_response)
+            response_time = time.perf_counter() - start
+            
+            self.conversation_manager.add_message(
+                session_id,
+                'assistant',
+                ai_response,
+                {
+                    'response_time': response_time,
+                    **cache_info,
                     'model_params': kwargs
                 }
             )
             
+            self._observe_turn(session_id, 'async', 'cached' if cached else 'ok', turn_start)
+            self._maybe_compact(session_id)
             return {
                 'success': True,
                 'session_id': session_id,
                 'response': ai_response,
                 'message_count': len(messages) + 1,
-                'response_time': (end_time - start_time).total_seconds()
+                'response_time': response_time,
+                **cache_info
             }
             
         except Exception as e:
+            self._observe_turn(session_id, 'async', 'error', turn_start)
             return {
                 'success': False,
                 'error': str(e),
-                'session_id': session_id
+                'session_id': session_id,
+                **_error_fields(e)
+            }
+    
+    async def achat_stream(self, session_id: str, user_message: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """异步流式对话，事件格式与 chat_stream 相同"""
+        async with self._aturn_lock(session_id):
+            events = self._achat_stream(session_id, user_message, **kwargs)
+            try:
+                async for event in events:
+                    yield event
+            finally:
+                # 被提前关闭时在释放会话锁之前写入已生成的内容
+                await events.aclose()
+    
+    async def _achat_stream(self, session_id: str, user_message: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            # 加载会话可能读磁盘或等待 sqlite 落盘，放到线程里避免阻塞事件循环
+            session_id, messages = await asyncio.to_thread(
+                self._prepare_turn, session_id, user_message, kwargs.get('max_tokens')
+            )
+            kwargs = self._with_model(session_id, kwargs)
+        except Exception as e:
+            yield {'type': 'error', 'error': str(e), 'session_id': session_id, **_error_fields(e)}
+            return
+        
+        yield {'type': 'start', 'session_id': session_id}
+        
+        start = time.perf_counter()
+        first_token_time = None
+        parts: List[str] = []
+        completed = False
+        try:
+            async with self._get_upstream_semaphore():
+                deltas = self.llm.astream_with_messages(messages, on_usage=self._usage_recorder(session_id), **kwargs)
+                try:
+                    async for delta in deltas:
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter() - start
+                        parts.append(delta)
+                        yield {'type': 'delta', 'content': delta}
+                finally:
+                    # 客户端断开时立即释放上游连接，而不是等待垃圾回收
+                    await deltas.aclose()
+            completed = True
+        except Exception as e:
+            yield {'type': 'error', 'error': str(e), 'session_id': session_id, **_error_fields(e)}
+        finally:
+            total_time = time.perf_counter() - start
+            self._finish_stream(session_id, parts, completed, first_token_time, total_time, kwargs)
+        
+        if completed:
+            yield {
+                'type': 'done',
+                'session_id': session_id,
+                'message_count': len(messages) + 1,
+                'response_time': total_time,
+                'time_to_first_token': first_token_time
             }
     
     def get_conversation_summary(self, session_id: str) -> Dict[str, Any]:
         """获取对话摘要"""
-        if session_id not in self.conversation_manager.conversations:
+        history = self.conversation_manager.get_history(session_id)
+        if history is None:
             return {'error': '会话不存在'}
         
-        history = self.conversation_manager.conversations[session_id]
         session_info = self.conversation_manager.get_session_info(session_id)
         
-        user_messages = [msg for msg in history if msg['role'] == 'user']
-        ai_messages = [msg for msg in history if msg['role'] == 'assistant']
-        
         return {
             'session_id': session_id,
             'created_at': session_info.get('created_at'),
             'last_activity': session_info.get('last_activity'),
             'total_messages': len(history),
-            'user_messages': len(user_messages),
-            'ai_messages': len(ai_messages),
-            'conversation_preview': history[-2:] if len(history) >= 2 else history
+            'user_messages': session_info.get('user_messages', 0),
+            'ai_messages': session_info.get('assistant_messages', 0),
+            'usage': session_info.get('usage'),
+            'conversation_preview': [message.to_dict() for message in history.tail(2)]
         }
     
     def clear_conversation(self, session_id: str) -> Dict[str, Any]:
-        """清空对话"""
+        """清空对话（等待进行中的一轮对话结束）"""
         try:
-            self.conversation_manager.clear_session(session_id)
+            with self._turn_lock(session_id):
+                self.conversation_manager.clear_session(session_id)
             return {'success': True, 'message': '对话已清空'}
         except Exception as e:
             return {'success': False, 'error': str(e)}
     
     def export_conversation(self, session_id: str) -> Dict[str, Any]:
         """导出对话记录"""
-        if session_id not in self.conversation_manager.conversations:
+        conversation = self.conversation_manager.snapshot_messages(session_id)
+        if conversation is None:
             return {'error': '会话不存在'}
         
-        history = self.conversation_manager.conversations[session_id]
-        session_info = self.conversation_manager.get_session_info(session_id)
-        
         return {
-            'session_info': session_info,
-            'conversation': history,
+            'session_info': dict(self.conversation_manager.get_session_info(session_id)),
+            'conversation': conversation,
             'export_time': datetime.now().isoformat()
         }
+    
+    def iter_export(self, session_id: str) -> Optional[Iterator[Dict[str, Any]]]:
+        """逐条生成导出记录，会话不存在时返回None
+        
+        第一条为 {'type': 'session', ...} 会话信息，之后每条消息一条 {'type': 'message', ...}，
+        供接口以NDJSON流式输出，导出大会话时不需要先在内存中拼出完整结果。
+        """
+        messages = self.conversation_manager.iter_messages(session_id)
+        if messages is None:
+            return None
+        session_info = dict(self.conversation_manager.get_session_info(session_id))
+        
+        def generate():
+            yield {
+                'type': 'session',
+                'session_id': session_id,
+                'session_info': session_info,
+                'export_time': datetime.now().isoformat()
+            }
+            for message in messages:
+                yield {'type': 'message', **message.to_dict()}
+        
+        return generate()
 
 
 def main():
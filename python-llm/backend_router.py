@@ -0,0 +1,203 @@
+"""
+多后端路由
+可配置多个 (base_url, model, api_key) 上游后端，按响应时间和错误率的EWMA选择最快的后端，
+失败时自动切换到下一个；不同的系统提示类型可以使用不同的模型。
+
+LLM_BACKENDS 示例（JSON）：
+[
+  {"name": "siliconflow-v3", "base_url": "https://api.siliconflow.cn/v1",
+   "model": "deepseek-ai/DeepSeek-V3", "api_key_env": "SILICON_FLOW_API_KEY"},
+  {"name": "siliconflow-qwen", "base_url": "https://api.siliconflow.cn/v1",
+   "model": "Qwen/Qwen2.5-7B-Instruct", "api_key_env": "SILICON_FLOW_API_KEY"}
+]
+LLM_PROMPT_MODELS 示例（JSON）：{"default": "Qwen/Qwen2.5-7B-Instruct", "travel": "deepseek-ai/DeepSeek-V3"}
+未配置 LLM_BACKENDS 时只有一个由 SILICON_FLOW_API_KEY / SILICON_FLOW_API_URL 组成的后端。
+"""
+
+import json
+import os
+import threading
+from typing import Optional, List, Dict, Any, TYPE_CHECKING
+
+from client_pool import get_client_pool
+from resilience import CircuitBreaker, get_breaker
+
+if TYPE_CHECKING:
+    from openai import OpenAI, AsyncOpenAI
+
+DEFAULT_MODEL = "deepseek-ai/DeepSeek-V3"
+DEFAULT_API_URL = "https://api.siliconflow.cn/v1"
+# 没有成功样本但失败过的后端按此延迟（秒）估算
+UNPROVEN_LATENCY = 30.0
+
+
+class Backend:
+    """一个上游后端及其实时的延迟、错误率统计"""
+
+    def __init__(self, name: str, base_url: str, model: str, api_key: str, alpha: float):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+        # 尚无样本时为None，优先被选中以便尽快获得延迟数据
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        """同一端点的所有后端共享一个熔断器"""
+        return get_breaker(self.base_url)
+
+    def client(self) -> 'OpenAI':
+        return get_client_pool().get_client(self.api_key, self.base_url)
+
+    def async_client(self) -> 'AsyncOpenAI':
+        return get_client_pool().get_async_client(self.api_key, self.base_url)
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def abort(self):
+        """结束一次不计入统计的调用"""
+        with self._lock:
+            self.in_flight -= 1
+
+    def end(self, latency: float, ok: bool):
+        """记录一次调用的耗时和结果"""
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            if ok:
+                self.ewma_latency = latency if self.ewma_latency is None \
+                    else self.alpha * latency + (1 - self.alpha) * self.ewma_latency
+            else:
+                self.failures += 1
+            self.ewma_error = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * self.ewma_error
+
+    def score(self) -> float:
+        """预期代价，越小越优先：延迟随在途请求数增长，并按错误率加权；熔断中的排在最后"""
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return float('inf')
+        with self._lock:
+            if self.ewma_latency is None:
+                # 从未成功过的后端：尚未尝试时优先探测，失败过则按固定的高延迟计
+                if self.failures == 0:
+                    return 0.0
+                latency = UNPROVEN_LATENCY
+            else:
+                latency = self.ewma_latency
+            return latency * (1 + self.in_flight) * (1 + 4 * self.ewma_error)
+
+    def snapshot(self) -> Dict[str, Any]:
+        score = self.score()
+        with self._lock:
+            return {
+                'name': self.name,
+                'base_url': self.base_url,
+                'model': self.model,
+                'ewma_latency_ms': round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+                'error_rate': round(self.ewma_error, 4),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'failures': self.failures,
+                'breaker_state': self.breaker.state,
+                'score': round(score, 4) if score != float('inf') else None
+            }
+
+
+class BackendRouter:
+    """按模型筛选后端并按 score 排序"""
+
+    def __init__(self, backends: List[Backend], prompt_models: Dict[str, str], default_model: str):
+        if not backends:
+            raise ValueError("至少需要配置一个LLM后端")
+        self.backends = backends
+        self.prompt_models = prompt_models
+        self.default_model = default_model
+
+    def model_for_prompt(self, prompt_type: Optional[str]) -> str:
+        """系统提示类型对应的模型"""
+        return self.prompt_models.get(prompt_type or 'default', self.default_model)
+
+    def candidates(self, model: Optional[str] = None) -> List[Backend]:
+        """按优先顺序返回可尝试的后端：先是提供该模型的后端，再以其他后端兜底"""
+        model = model or self.default_model
+        scored = sorted(self.backends, key=lambda backend: backend.score())
+        preferred = [backend for backend in scored if backend.model == model]
+        return preferred + [backend for backend in scored if backend.model != model]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'default_model': self.default_model,
+            'prompt_models': dict(self.prompt_models),
+            'backends': sorted(
+                (backend.snapshot() for backend in self.backends),
+                key=lambda item: (item['score'] is None, item['score'] or 0.0)
+            )
+        }
+
+
+def _load_json_env(name: str, default: Any) -> Any:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError as e:
+        raise ValueError(f"{name} 不是合法的JSON: {str(e)}")
+
+
+def create_router() -> BackendRouter:
+    """根据环境变量构建路由表"""
+    alpha = float(os.environ.get('LLM_ROUTER_EWMA_ALPHA', 0.3))
+    default_model = os.environ.get('LLM_DEFAULT_MODEL', DEFAULT_MODEL)
+    configs = _load_json_env('LLM_BACKENDS', None)
+
+    if configs is None:
+        api_key = os.environ.get("SILICON_FLOW_API_KEY", "")
+        if not api_key:
+            raise ValueError("请设置SILICON_FLOW_API_KEY环境变量")
+        configs = [{
+            'name': 'siliconflow',
+            'base_url': os.environ.get("SILICON_FLOW_API_URL", DEFAULT_API_URL),
+            'model': default_model,
+            'api_key': api_key
+        }]
+
+    backends = []
+    for i, config in enumerate(configs):
+        api_key = config.get('api_key') or os.environ.get(config.get('api_key_env', 'SILICON_FLOW_API_KEY'), '')
+        if not api_key:
+            raise ValueError(f"LLM后端 {config.get('name', i)} 未配置API密钥")
+        base_url = config.get('base_url', DEFAULT_API_URL)
+        model = config.get('model', default_model)
+        backends.append(Backend(
+            name=config.get('name') or f"{base_url}#{model}",
+            base_url=base_url,
+            model=model,
+            api_key=api_key,
+            alpha=alpha
+        ))
+
+    return BackendRouter(backends, _load_json_env('LLM_PROMPT_MODELS', {}), default_model)
+
+
+_default_router: Optional[BackendRouter] = None
+_default_router_lock = threading.Lock()
+
+
+def get_router() -> BackendRouter:
+    """获取进程级默认路由（首次使用时读取配置）"""
+    global _default_router
+    if _default_router is None:
+        with _default_router_lock:
+            if _default_router is None:
+                _default_router = create_router()
+    return _default_router
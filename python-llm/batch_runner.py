@@ -0,0 +1,194 @@
+"""
+批量对话
+把一批提示词分发到有上限的线程池中执行，每条提示词使用独立的会话，
+结果完成一条输出一条（JSONL），并追加写入检查点文件，崩溃后重新运行会跳过已成功的条目。
+
+命令行用法:
+    python batch_runner.py prompts.jsonl --prompt-type travel --output plans.jsonl --workers 8
+输入每行一个JSON对象 {"id": "beijing", "prompt": "..."}，也可以是纯文本（每行一条提示词）；
+对象中可以带 prompt_type 和模板变量 variables（如 {"destination": "北京", "days": 3}）；
+输出文件同时作为检查点，中断后用相同命令重新运行即可继续。
+"""
+
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Optional, List, Dict, Any, Iterable, Iterator, Set
+
+
+def parse_jsonl(lines: Iterable[str]) -> List[Dict[str, Any]]:
+    """解析JSONL输入；非JSON的行按纯文本提示词处理，空行忽略"""
+    items = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = line
+        items.append(item)
+    return normalize_items(items)
+
+
+def normalize_items(items: Iterable[Any]) -> List[Dict[str, Any]]:
+    """统一为 {'id', 'prompt', ...} 格式，缺少id时使用序号"""
+    normalized = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {'prompt': item}
+        if not isinstance(item, dict) or not str(item.get('prompt', '')).strip():
+            raise ValueError(f"第{index + 1}条缺少prompt")
+        item = dict(item)
+        item['id'] = str(item.get('id', index))
+        normalized.append(item)
+    return normalized
+
+
+class BatchCheckpoint:
+    """追加写入的JSONL检查点，每完成一条立即落盘"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def load(self) -> List[Dict[str, Any]]:
+        """读取已成功的结果；最后一行可能因崩溃而不完整，直接忽略"""
+        if not os.path.exists(self.path):
+            return []
+        results = {}
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('success'):
+                    results[result['id']] = result
+        return list(results.values())
+
+    def append(self, result: Dict[str, Any]):
+        line = json.dumps(result, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def _run_item(chain, item: Dict[str, Any], prompt_type: str, model_params: Dict[str, Any]) -> Dict[str, Any]:
+    """在独立会话中执行一条提示词，完成后删除会话"""
+    params = dict(model_params)
+    for key in ('temperature', 'max_tokens'):
+        if key in item:
+            params[key] = item[key]
+
+    try:
+        session_id = chain.create_session(item.get('prompt_type', prompt_type), item.get('variables'))
+    except ValueError as e:
+        return {'id': item['id'], 'success': False, 'error': str(e), 'error_type': 'invalid_prompt'}
+    try:
+        result = chain.chat(session_id, item['prompt'], priority='batch', **params)
+    finally:
+        chain.conversation_manager.delete_session(session_id)
+
+    output = {'id': item['id'], 'success': result['success']}
+    if result['success']:
+        output.update({
+            'response': result['response'],
+            'response_time': result['response_time'],
+            'cached': result['cached']
+        })
+    else:
+        output.update({
+            'error': result['error'],
+            'error_type': result.get('error_type')
+        })
+    return output
+
+
+def run_batch(
+    chain,
+    items: List[Dict[str, Any]],
+    prompt_type: str = 'default',
+    max_workers: int = 8,
+    checkpoint: Optional[BatchCheckpoint] = None,
+    **model_params
+) -> Iterator[Dict[str, Any]]:
+    """并发执行一批提示词，按完成顺序产出结果
+
+    有检查点时先产出其中已成功的结果（标记 resumed），只执行剩余条目。
+    在途任务数不超过 max_workers * 2，调用方提前关闭生成器时取消尚未开始的任务。
+    """
+    done_ids: Set[str] = set()
+    if checkpoint is not None:
+        for result in checkpoint.load():
+            done_ids.add(result['id'])
+            yield dict(result, resumed=True)
+
+    pending_items = iter([item for item in items if item['id'] not in done_ids])
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch')
+    futures = set()
+    try:
+        while True:
+            while len(futures) < max_workers * 2:
+                item = next(pending_items, None)
+                if item is None:
+                    break
+                futures.add(executor.submit(_run_item, chain, item, prompt_type, model_params))
+            if not futures:
+                break
+
+            completed, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in completed:
+                result = future.result()
+                if checkpoint is not None:
+                    checkpoint.append(result)
+                yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量生成对话回复')
+    parser.add_argument('input', help='JSONL输入文件，每行 {"id": ..., "prompt": ...} 或一条纯文本提示词')
+    parser.add_argument('--output', required=True, help='JSONL输出文件，同时作为检查点')
+    parser.add_argument('--prompt-type', default='default')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('BATCH_MAX_WORKERS', 8)))
+    parser.add_argument('--temperature', type=float, default=0.7)
+    parser.add_argument('--max-tokens', type=int, default=2048)
+    args = parser.parse_args()
+
+    from advanced_deepseek_chain import AdvancedDeepSeekChain
+
+    with open(args.input, encoding='utf-8') as f:
+        items = parse_jsonl(f)
+
+    chain = AdvancedDeepSeekChain()
+    checkpoint = BatchCheckpoint(args.output)
+    succeeded = failed = resumed = 0
+    for result in run_batch(
+        chain,
+        items,
+        prompt_type=args.prompt_type,
+        max_workers=args.workers,
+        checkpoint=checkpoint,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens
+    ):
+        if result.get('resumed'):
+            resumed += 1
+        elif result['success']:
+            succeeded += 1
+        else:
+            failed += 1
+            print(f"❌ {result['id']}: {result['error']}")
+        print(f"进度: {resumed + succeeded + failed}/{len(items)}", end='\r')
+
+    print(f"\n✅ 完成: 成功 {succeeded}，失败 {failed}，跳过已完成 {resumed}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,444 @@
+"""
+聊天服务压测
+以固定并发驱动 /api/chat/message，每个虚拟用户创建会话后连续进行多轮对话，输出：
+- 延迟 p50/p95/p99（流式模式另有首字延迟）、吞吐（req/s）、按状态码统计的失败数
+- 服务进程的内存增量 / 新建会话数（每会话内存）
+
+--spawn 时自动启动本地模拟上游（mock_deepseek_server.py）和被测服务，不消耗API额度；
+被测服务可选 flask（chat_api.py）、asgi（uvicorn chat_asgi:app）或 workers（worker_pool.py）。
+
+示例:
+    python benchmark.py --spawn --server flask --concurrency 32 --requests 2000 --output result.json
+    python benchmark.py --spawn --server asgi --concurrency 32 --requests 2000 --baseline result.json
+    python benchmark.py --url http://127.0.0.1:5000 --concurrency 8 --duration 60
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+from typing import Optional, List, Dict, Any, Tuple
+from urllib.parse import urlparse
+
+import psutil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 固定的提示词序列，保证每次压测的请求内容相同
+PROMPTS = [
+    "你好，我想规划一个北京3天游",
+    "我比较喜欢历史文化景点",
+    "预算大概3000元，有什么建议吗？",
+    "帮我安排一下每天的交通方式",
+    "有哪些适合晚上去的地方？",
+    "再推荐几家当地的特色餐厅"
+]
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """最近秩法百分位数"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class ServiceClient:
+    """单个虚拟用户使用的长连接客户端"""
+
+    def __init__(self, url: str, timeout: float):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self.conn: Optional[HTTPConnection] = None
+
+    def request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Tuple[int, bytes, float]:
+        """发送请求并读完响应体，返回 (状态码, 响应体, 首字节耗时)；流式响应的首字节为首个delta事件"""
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body else {}
+        stream = bool(payload and payload.get('stream'))
+        for retry in (False, True):
+            if self.conn is None:
+                self.conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+            start = time.perf_counter()
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                first_byte = None
+                chunks = []
+                while True:
+                    chunk = response.read1(65536)
+                    if not chunk:
+                        break
+                    if first_byte is None and (not stream or b'event: delta' in chunk):
+                        first_byte = time.perf_counter() - start
+                    chunks.append(chunk)
+                # 读到长度上限时 read1 不会自动结束响应，需显式关闭后才能复用连接
+                response.close()
+                if response.will_close:
+                    self.close()
+                return response.status, b''.join(chunks), first_byte or 0.0
+            except (ConnectionError, OSError):
+                # 服务端关闭了空闲长连接时重连一次
+                self.close()
+                if retry:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class LoadTest:
+    """固定并发的闭环压测：每个虚拟用户收到响应后立即发送下一条"""
+
+    def __init__(
+        self,
+        url: str,
+        concurrency: int,
+        requests: Optional[int],
+        duration: Optional[float],
+        turns: int,
+        stream: bool,
+        prompt_type: str,
+        max_tokens: int,
+        timeout: float
+    ):
+        self.url = url
+        self.concurrency = concurrency
+        self.total_requests = requests
+        self.duration = duration
+        self.turns = turns
+        self.stream = stream
+        self.prompt_type = prompt_type
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._issued = 0
+        self._deadline = None
+        self.latencies: List[float] = []
+        self.first_token: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.sessions_created = 0
+
+    def _next_ticket(self) -> bool:
+        with self._lock:
+            if self.total_requests is not None and self._issued >= self.total_requests:
+                return False
+            if self._deadline is not None and time.perf_counter() >= self._deadline:
+                return False
+            self._issued += 1
+            return True
+
+    def _record(self, status: int, latency: float, first_token: float):
+        with self._lock:
+            key = str(status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            if status == 200:
+                self.latencies.append(latency)
+                if self.stream:
+                    self.first_token.append(first_token)
+
+    def _user(self, user_index: int):
+        client = ServiceClient(self.url, self.timeout)
+        session_id = None
+        turn = 0
+        try:
+            while self._next_ticket():
+                if session_id is None or turn >= self.turns:
+                    status, body, _ = client.request('POST', '/api/chat/session', {'prompt_type': self.prompt_type})
+                    if status != 200:
+                        self._record(status, 0.0, 0.0)
+                        continue
+                    session_id = json.loads(body)['session_id']
+                    turn = 0
+                    with self._lock:
+                        self.sessions_created += 1
+
+                payload = {
+                    'session_id': session_id,
+                    'message': PROMPTS[(user_index + turn) % len(PROMPTS)],
+                    'max_tokens': self.max_tokens,
+                    'stream': self.stream
+                }
+                start = time.perf_counter()
+                try:
+                    status, body, first_token = client.request('POST', '/api/chat/message', payload)
+                except OSError:
+                    status, first_token = 0, 0.0
+                latency = time.perf_counter() - start
+                if status == 200 and self.stream and b'event: error' in body:
+                    status = 'stream_error'
+                self._record(status, latency, first_token)
+                turn += 1
+        finally:
+            client.close()
+
+    def run(self) -> float:
+        """运行压测，返回墙钟耗时"""
+        threads = [
+            threading.Thread(target=self._user, args=(i,), name=f'bench-user-{i}', daemon=True)
+            for i in range(self.concurrency)
+        ]
+        start = time.perf_counter()
+        if self.duration is not None:
+            self._deadline = start + self.duration
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def _get_json(url: str, path: str) -> Optional[Dict[str, Any]]:
+    try:
+        status, body, _ = ServiceClient(url, 5.0).request('GET', path)
+        return json.loads(body) if status == 200 else None
+    except (OSError, ValueError):
+        return None
+
+
+def service_pids(url: str) -> List[int]:
+    """被测服务的进程号：单进程读 worker.pid，多worker模式读每个worker的健康信息"""
+    health = _get_json(url, '/api/health') or {}
+    if 'workers' in health:
+        return [
+            info['health']['worker']['pid'] for info in health['workers']
+            if info.get('health') and 'worker' in info['health']
+        ]
+    if 'worker' in health:
+        return [health['worker']['pid']]
+    return []
+
+
+def service_rss(pids: List[int]) -> Optional[int]:
+    """被测服务（同一台机器上）的常驻内存总和"""
+    total = 0
+    for pid in pids:
+        try:
+            total += psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return None
+    return total if pids else None
+
+
+def wait_ready(url: str, timeout: float = 30.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        health = _get_json(url, '/api/health')
+        if health and health.get('status') in ('healthy', 'degraded'):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def spawn_stack(args) -> List[subprocess.Popen]:
+    """启动模拟上游和被测服务"""
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(HERE, 'mock_deepseek_server.py'),
+        '--port', str(args.mock_port),
+        '--latency', args.mock_latency,
+        '--tokens-per-second', str(args.mock_tokens_per_second),
+        '--completion-tokens', args.mock_completion_tokens,
+        '--error-rate', str(args.mock_error_rate),
+        '--error-statuses', args.mock_error_statuses,
+        '--seed', str(args.seed)
+    ], cwd=HERE, stdout=subprocess.DEVNULL)
+
+    env = dict(
+        os.environ,
+        SILICON_FLOW_API_KEY='mock',
+        SILICON_FLOW_API_URL=f'http://127.0.0.1:{args.mock_port}/v1',
+        PORT=str(args.port),
+        HOST='127.0.0.1',
+        FLASK_DEBUG='0'
+    )
+    env.pop('LLM_BACKENDS', None)
+    if args.server == 'flask':
+        command = [sys.executable, 'chat_api.py']
+    elif args.server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'chat_asgi:app', '--host', '127.0.0.1',
+                   '--port', str(args.port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, 'worker_pool.py', '--workers', str(args.workers),
+                   '--host', '127.0.0.1', '--port', str(args.port)]
+    server = subprocess.Popen(command, cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return [server, mock]
+
+
+def build_report(test: LoadTest, elapsed: float, rss_before: Optional[int], rss_after: Optional[int]) -> Dict[str, Any]:
+    latencies = sorted(test.latencies)
+    ok = len(latencies)
+    total = sum(test.statuses.values())
+    report = {
+        'config': {
+            'concurrency': test.concurrency,
+            'requests': test.total_requests,
+            'duration': test.duration,
+            'turns_per_session': test.turns,
+            'stream': test.stream,
+            'prompt_type': test.prompt_type,
+            'max_tokens': test.max_tokens
+        },
+        'elapsed_seconds': round(elapsed, 3),
+        'requests': total,
+        'succeeded': ok,
+        'statuses': test.statuses,
+        'throughput_rps': round(ok / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            name: round(value * 1000, 1) if value is not None else None
+            for name, value in (
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)),
+                ('max', latencies[-1] if latencies else None),
+                ('mean', sum(latencies) / ok if ok else None)
+            )
+        },
+        'sessions_created': test.sessions_created
+    }
+    if test.stream:
+        first_token = sorted(test.first_token)
+        report['time_to_first_token_ms'] = {
+            name: round(value * 1000, 1) if value is not None else None
+            for name, value in (
+                ('p50', percentile(first_token, 50)),
+                ('p95', percentile(first_token, 95)),
+                ('p99', percentile(first_token, 99))
+            )
+        }
+    if rss_before is not None and rss_after is not None:
+        report['memory'] = {
+            'rss_before_mb': round(rss_before / 2 ** 20, 1),
+            'rss_after_mb': round(rss_after / 2 ** 20, 1),
+            'bytes_per_session': round((rss_after - rss_before) / test.sessions_created)
+            if test.sessions_created else None
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    def delta(path: Tuple[str, ...], value) -> str:
+        if baseline is None or value is None:
+            return ''
+        base = baseline
+        for key in path:
+            base = (base or {}).get(key)
+        if not base:
+            return ''
+        return f"  ({(value - base) / base * 100:+.1f}% vs 基线)"
+
+    latency = report['latency_ms']
+    print("=" * 50)
+    print(f"请求数: {report['requests']}，成功: {report['succeeded']}，状态码: {report['statuses']}")
+    print(f"吞吐: {report['throughput_rps']} req/s{delta(('throughput_rps',), report['throughput_rps'])}")
+    for name in ('p50', 'p95', 'p99'):
+        print(f"延迟 {name}: {latency[name]} ms{delta(('latency_ms', name), latency[name])}")
+    if 'time_to_first_token_ms' in report:
+        first_token = report['time_to_first_token_ms']
+        for name in ('p50', 'p95', 'p99'):
+            print(f"首字 {name}: {first_token[name]} ms{delta(('time_to_first_token_ms', name), first_token[name])}")
+    if 'memory' in report:
+        memory = report['memory']
+        print(f"内存: {memory['rss_before_mb']} MB -> {memory['rss_after_mb']} MB，"
+              f"每会话 {memory['bytes_per_session']} 字节{delta(('memory', 'bytes_per_session'), memory['bytes_per_session'])}")
+    print("=" * 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='聊天服务压测')
+    parser.add_argument('--url', default=None, help='被测服务地址（不使用 --spawn 时必填）')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=None, help='总请求数（默认1000，与 --duration 二选一）')
+    parser.add_argument('--duration', type=float, default=None, help='压测时长（秒）')
+    parser.add_argument('--turns', type=int, default=3, help='每个会话的对话轮数')
+    parser.add_argument('--stream', action='store_true', help='使用SSE流式接口')
+    parser.add_argument('--prompt-type', default='travel')
+    parser.add_argument('--max-tokens', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    parser.add_argument('--baseline', help='与之前保存的结果对比')
+
+    spawn = parser.add_argument_group('本地启动（--spawn）')
+    spawn.add_argument('--spawn', action='store_true', help='启动模拟上游和被测服务')
+    spawn.add_argument('--server', choices=('flask', 'asgi', 'workers'), default='flask')
+    spawn.add_argument('--workers', type=int, default=4, help='--server workers 时的worker数')
+    spawn.add_argument('--port', type=int, default=5900)
+    spawn.add_argument('--mock-port', type=int, default=8900)
+    spawn.add_argument('--mock-latency', default='lognormal:0.3,0.4')
+    spawn.add_argument('--mock-tokens-per-second', type=float, default=200.0)
+    spawn.add_argument('--mock-completion-tokens', default='50,150')
+    spawn.add_argument('--mock-error-rate', type=float, default=0.0)
+    spawn.add_argument('--mock-error-statuses', default='500')
+    spawn.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.requests is None and args.duration is None:
+        args.requests = 1000
+
+    processes: List[subprocess.Popen] = []
+    if args.spawn:
+        processes = spawn_stack(args)
+        url = f'http://127.0.0.1:{args.port}'
+    elif args.url:
+        url = args.url.rstrip('/')
+    else:
+        parser.error('请指定 --url 或 --spawn')
+
+    try:
+        if not wait_ready(url):
+            print(f"❌ 服务未就绪: {url}")
+            sys.exit(1)
+
+        pids = service_pids(url)
+        rss_before = service_rss(pids)
+        test = LoadTest(
+            url,
+            concurrency=args.concurrency,
+            requests=args.requests,
+            duration=args.duration,
+            turns=args.turns,
+            stream=args.stream,
+            prompt_type=args.prompt_type,
+            max_tokens=args.max_tokens,
+            timeout=args.timeout
+        )
+        print(f"🏋️ 压测 {url}：并发 {args.concurrency}，"
+              f"{f'{args.requests} 个请求' if args.requests else f'{args.duration:g} 秒'}，每会话 {args.turns} 轮")
+        elapsed = test.run()
+        report = build_report(test, elapsed, rss_before, service_rss(pids))
+        if args.spawn:
+            report['config'].update(server=args.server, mock_latency=args.mock_latency,
+                                    mock_tokens_per_second=args.mock_tokens_per_second,
+                                    mock_error_rate=args.mock_error_rate, seed=args.seed)
+
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        print_report(report, baseline)
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"💾 结果已保存: {args.output}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == '__main__':
+    main()
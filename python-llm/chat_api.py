@@ -4,10 +4,27 @@ DeepSeek V3 聊天API服务
 """
 
 import os
-from flask import Flask, request, jsonify
+import re
+import json
+import atexit
+import signal
+import sys
+import threading
+import zlib
+from flask import Flask, request, jsonify, Response, g, stream_with_context
 from flask_cors import CORS
 from advanced_deepseek_chain import AdvancedDeepSeekChain
+from client_pool import get_client_pool
+from worker_pool import affine_session_id
+from single_flight import get_single_flight
+from resilience import CircuitBreaker, get_breaker_states
+from rate_limiter import get_quota_scheduler
+from backend_router import get_router
+from batch_runner import BatchCheckpoint, normalize_items, parse_jsonl, run_batch
+from message_history import parse_timestamp
+import metrics
 import logging
+import math
 from datetime import datetime
 import traceback
 
@@ -25,17 +42,157 @@ CORS(app)  # 允许跨域请求
 # 全局对话链条实例
 chat_chain = AdvancedDeepSeekChain(max_history=20)
 
+# 多worker模式（由 worker_pool.py 启动）下的worker编号，新会话ID只哈希到本worker
+WORKER_ID = int(os.environ.get('WORKER_ID', 0))
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 1))
+if WORKER_COUNT > 1:
+    chat_chain.conversation_manager.session_id_factory = lambda: affine_session_id(WORKER_ID, WORKER_COUNT)
+
 # 存储活跃会话
 active_sessions = {}
 
+# 批量任务的并发上限和检查点目录
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 8))
+BATCH_CHECKPOINT_DIR = os.environ.get('BATCH_CHECKPOINT_DIR', 'batch_checkpoints')
+BATCH_JOB_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# 会话因空闲超时或数量上限被淘汰时同步移除，并启动后台清理线程
+chat_chain.conversation_manager.add_eviction_listener(
+    lambda session_id, reason: active_sessions.pop(session_id, None)
+)
+chat_chain.conversation_manager.start_sweeper()
+atexit.register(chat_chain.conversation_manager.close)
+if chat_chain.semantic_cache is not None:
+    atexit.register(chat_chain.semantic_cache.close)
+
+# 上游调用客户端（openai / httpx）在后台预加载，不阻塞服务启动；LLM_WARMUP=0 时推迟到第一次请求
+if os.environ.get('LLM_WARMUP', '1').lower() not in ('0', 'false', 'no'):
+    threading.Thread(target=chat_chain.warm_up, name='llm-warmup', daemon=True).start()
+
+# 抓取 /api/metrics 时读取的实时值
+metrics.REGISTRY.gauge(
+    'chat_sessions_live', 'Sessions held in this process memory',
+    callback=lambda: {(): chat_chain.conversation_manager.get_stats()['live_sessions']}
+)
+metrics.REGISTRY.gauge(
+    'chat_session_store_sessions', 'Sessions persisted in the session store', ('backend',),
+    callback=lambda: {
+        (stats['backend'],): stats['sessions']
+        for stats in [chat_chain.conversation_manager.store.get_stats()] if stats['sessions'] is not None
+    }
+)
+metrics.REGISTRY.gauge(
+    'chat_session_store_pending_writes', 'Session store writes waiting to be committed',
+    callback=lambda: {(): chat_chain.conversation_manager.store.get_stats()['pending_writes']}
+)
+metrics.REGISTRY.gauge(
+    'llm_quota_queued', 'Requests waiting for upstream RPM/TPM quota',
+    callback=lambda: {(): get_quota_scheduler().get_stats()['queued']}
+)
+
+@app.before_request
+def _start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = metrics.request_started(g.metrics_route)
+
+@app.after_request
+def _record_request_metrics(response):
+    """响应体发送完毕后再记录，流式响应的耗时包含整个推送过程"""
+    if 'metrics_start' in g:
+        route, start, method = g.metrics_route, g.metrics_start, request.method
+        response.call_on_close(lambda: metrics.request_finished(route, method, response.status_code, start))
+    return response
+
+def _restore_session(session_id):
+    """会话不在本进程内存中但存储里存在时（重启或被淘汰后），重新登记为活跃会话"""
+    history = chat_chain.conversation_manager.get_history(session_id)
+    if history is None:
+        return False
+    info = chat_chain.conversation_manager.get_session_info(session_id)
+    active_sessions[session_id] = {
+        'created_at': info.get('created_at'),
+        'prompt_type': history.system.meta('prompt_type', 'default') if history.system else 'default'
+    }
+    return True
+
+def _ensure_session(session_id):
+    """确保会话存在，不存在时创建默认会话"""
+    if session_id and session_id not in active_sessions and _restore_session(session_id):
+        return session_id
+    if not session_id or session_id not in active_sessions:
+        session_id = chat_chain.create_session()
+        active_sessions[session_id] = {
+            'created_at': datetime.now().isoformat(),
+            'prompt_type': 'default'
+        }
+    return session_id
+
+def _generation_params(data):
+    """解析并校验 temperature / max_tokens，不合法时抛出 ValueError（信息可直接返回给客户端）"""
+    try:
+        temperature = float(data.get('temperature', 0.7))
+        max_tokens = int(data.get('max_tokens', 2048))
+    except (TypeError, ValueError):
+        raise ValueError('max_tokens 必须是整数，temperature 必须是数字') from None
+    if not math.isfinite(temperature) or temperature < 0 or max_tokens < 1:
+        raise ValueError('temperature 不能为负数，max_tokens 必须大于0')
+    return temperature, max_tokens
+
+def _retry_after_headers(result):
+    """限流或熔断时告知客户端多久后重试"""
+    if result.get('retry_after') is None:
+        return {}
+    return {'Retry-After': str(math.ceil(result['retry_after']))}
+
+def _sse_event(event):
+    """格式化一条Server-Sent Events消息"""
+    payload = json.dumps(event, ensure_ascii=False)
+    return f"event: {event['type']}\ndata: {payload}\n\n"
+
+def _stream_message(session_id, message, temperature, max_tokens):
+    """以SSE方式流式返回回复"""
+    def generate():
+        for event in chat_chain.chat_stream(
+            session_id,
+            message,
+            temperature=temperature,
+            max_tokens=max_tokens
+        ):
+            if event['type'] == 'done':
+                logger.info(f"会话 {session_id} 流式响应完成，首字: {event['time_to_first_token'] or 0:.2f}秒，"
+                            f"总用时: {event['response_time']:.2f}秒")
+            elif event['type'] == 'error':
+                logger.error(f"会话 {session_id} 流式响应失败: {event['error']}")
+            yield _sse_event(event)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查端点"""
+    breakers = get_breaker_states()
+    upstream_open = any(state['state'] == CircuitBreaker.OPEN for state in breakers.values())
     return jsonify({
-        'status': 'healthy',
+        # 上游熔断时服务本身可用，但对话请求会快速失败
+        'status': 'degraded' if upstream_open else 'healthy',
         'service': 'DeepSeek V3 Chat API',
         'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'worker': {
+            'id': WORKER_ID,
+            'count': WORKER_COUNT,
+            'pid': os.getpid(),
+            'active_sessions': len(active_sessions)
+        },
+        'llm_ready': chat_chain.llm_ready,
+        'circuit_breakers': breakers
     })
 
 @app.route('/api/chat/session', methods=['POST'])
@@ -44,22 +201,35 @@ def create_session():
     try:
         data = request.get_json() or {}
         prompt_type = data.get('prompt_type', 'default')
+        variables = data.get('variables')
+        if variables is not None and not isinstance(variables, dict):
+            return jsonify({
+                'success': False,
+                'error': 'variables 必须是对象'
+            }), 400
         
-        session_id = chat_chain.create_session(prompt_type)
+        session_id = chat_chain.create_session(prompt_type, variables)
+        prompt_version = chat_chain.conversation_manager.get_session_info(session_id).get('prompt_version')
         active_sessions[session_id] = {
             'created_at': datetime.now().isoformat(),
             'prompt_type': prompt_type
         }
         
-        logger.info(f"创建新会话: {session_id}, 类型: {prompt_type}")
+        logger.info(f"创建新会话: {session_id}, 类型: {prompt_type} v{prompt_version}")
         
         return jsonify({
             'success': True,
             'session_id': session_id,
             'prompt_type': prompt_type,
+            'prompt_version': prompt_version,
             'message': '会话创建成功'
         })
         
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         logger.error(f"创建会话失败: {str(e)}")
         return jsonify({
@@ -87,26 +257,31 @@ def send_message():
                 'error': '消息内容不能为空'
             }), 400
         
-        # 如果没有会话ID，创建新会话
-        if not session_id or session_id not in active_sessions:
-            session_id = chat_chain.create_session()
-            active_sessions[session_id] = {
-                'created_at': datetime.now().isoformat(),
-                'prompt_type': 'default'
-            }
-        
         # 获取可选参数
-        temperature = data.get('temperature', 0.7)
-        max_tokens = data.get('max_tokens', 2048)
+        try:
+            temperature, max_tokens = _generation_params(data)
+        except ValueError as e:
+            return jsonify({
+                'success': False,
+                'error': str(e)
+            }), 400
+        
+        # 如果没有会话ID，创建新会话
+        session_id = _ensure_session(session_id)
         
         logger.info(f"会话 {session_id} 收到消息: {message[:50]}...")
         
+        # SSE模式：逐字推送回复
+        if data.get('stream'):
+            return _stream_message(session_id, message, temperature, max_tokens)
+        
         # 调用对话链条
         result = chat_chain.chat(
             session_id, 
             message, 
             temperature=temperature,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            cacheable=bool(data.get('cacheable'))
         )
         
         if result['success']:
@@ -116,15 +291,17 @@ def send_message():
                 'session_id': session_id,
                 'response': result['response'],
                 'message_count': result['message_count'],
-                'response_time': result['response_time']
+                'response_time': result['response_time'],
+                'cached': result['cached']
             })
         else:
             logger.error(f"会话 {session_id} 响应失败: {result['error']}")
             return jsonify({
                 'success': False,
                 'error': result['error'],
+                'error_type': result['error_type'],
                 'session_id': session_id
-            }), 500
+            }), result['status_code'], _retry_after_headers(result)
             
     except Exception as e:
         logger.error(f"发送消息失败: {str(e)}\n{traceback.format_exc()}")
@@ -135,7 +312,20 @@ def send_message():
 
 @app.route('/api/chat/history/<session_id>', methods=['GET'])
 def get_conversation_history(session_id):
-    """获取对话历史"""
+    """获取对话历史（只含用户和AI消息）
+
+    查询参数: offset（默认0）、limit（默认不限，最大500）、since（ISO时间戳，只返回其后的消息）
+    """
+    since = request.args.get('since') or None
+    if since is not None:
+        try:
+            parse_timestamp(since)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'since 必须是ISO格式的时间戳，如 2025-01-01T08:00:00'
+            }), 400
+    
     try:
         summary = chat_chain.get_conversation_summary(session_id)
         
@@ -145,25 +335,25 @@ def get_conversation_history(session_id):
                 'error': summary['error']
             }), 404
         
-        # 获取完整历史
-        history = chat_chain.conversation_manager.conversations.get(session_id, [])
-        
-        # 过滤掉系统消息，只返回用户和AI的对话
-        filtered_history = [
-            {
-                'role': msg['role'],
-                'content': msg['content'],
-                'timestamp': msg['timestamp']
-            }
-            for msg in history
-            if msg['role'] in ['user', 'assistant']
-        ]
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = request.args.get('limit', type=int)
+        if limit is not None:
+            limit = min(max(limit, 1), 500)
+        page = chat_chain.conversation_manager.page_messages(
+            session_id,
+            offset=offset,
+            limit=limit,
+            since=since
+        )
+        history, total = page or ([], 0)
         
         return jsonify({
             'success': True,
             'session_id': session_id,
             'summary': summary,
-            'history': filtered_history
+            'history': history,
+            'total': total,
+            'has_more': offset + len(history) < total
         })
         
     except Exception as e:
@@ -194,24 +384,23 @@ def clear_conversation(session_id):
 
 @app.route('/api/chat/sessions', methods=['GET'])
 def list_sessions():
-    """列出所有活跃会话"""
+    """按最近活跃时间从新到旧分页列出会话
+
+    查询参数: limit（默认50，最大500）、cursor（上一页返回的 next_cursor）、prompt_type
+    """
     try:
-        sessions = []
-        for session_id, info in active_sessions.items():
-            summary = chat_chain.get_conversation_summary(session_id)
-            if 'error' not in summary:
-                sessions.append({
-                    'session_id': session_id,
-                    'created_at': info['created_at'],
-                    'prompt_type': info['prompt_type'],
-                    'message_count': summary.get('total_messages', 0),
-                    'last_activity': summary.get('last_activity')
-                })
+        limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+        sessions, next_cursor = chat_chain.conversation_manager.list_sessions(
+            limit=limit,
+            cursor=request.args.get('cursor') or None,
+            prompt_type=request.args.get('prompt_type') or None
+        )
         
         return jsonify({
             'success': True,
             'sessions': sessions,
-            'total_sessions': len(sessions)
+            'total_sessions': chat_chain.conversation_manager.get_stats()['live_sessions'],
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
@@ -223,7 +412,14 @@ def list_sessions():
 
 @app.route('/api/chat/export/<session_id>', methods=['GET'])
 def export_conversation(session_id):
-    """导出对话记录"""
+    """导出对话记录
+
+    format=ndjson 时逐行流式输出（首行为会话信息，之后每行一条消息），
+    请求头 Accept-Encoding 含 gzip 时压缩输出；默认仍返回完整JSON。
+    """
+    if request.args.get('format') == 'ndjson':
+        return _export_ndjson(session_id)
+    
     try:
         result = chat_chain.export_conversation(session_id)
         
@@ -245,6 +441,149 @@ def export_conversation(session_id):
             'error': str(e)
         }), 500
 
+def _read_batch_request():
+    """解析批量请求：JSON请求体中的 prompts 列表、JSONL请求体，或上传的JSONL文件（file字段）"""
+    if 'file' in request.files:
+        options = request.form
+        lines = request.files['file'].read().decode('utf-8').splitlines()
+        return options, parse_jsonl(lines)
+    if request.is_json:
+        options = request.get_json() or {}
+        return options, normalize_items(options.get('prompts') or [])
+    options = request.args
+    return options, parse_jsonl(request.get_data(as_text=True).splitlines())
+
+@app.route('/api/chat/batch', methods=['POST'])
+def batch_chat():
+    """批量对话，按完成顺序以JSONL流式返回结果
+
+    提供 job_id 时结果同时写入检查点，用相同的 job_id 重新提交即从中断处继续，
+    已完成的条目直接从检查点返回（resumed=true）。
+    """
+    try:
+        options, items = _read_batch_request()
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+
+    if not items:
+        return jsonify({
+            'success': False,
+            'error': '提示词列表不能为空'
+        }), 400
+
+    # 表单和查询参数中的值都是字符串，统一转换并校验
+    try:
+        max_workers = int(options.get('max_workers', BATCH_MAX_WORKERS))
+        temperature = float(options.get('temperature', 0.7))
+        max_tokens = int(options.get('max_tokens', 2048))
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': 'max_workers、max_tokens 必须是整数，temperature 必须是数字'
+        }), 400
+    if not math.isfinite(temperature) or temperature < 0 or max_tokens < 1:
+        return jsonify({
+            'success': False,
+            'error': 'temperature 不能为负数，max_tokens 必须大于0'
+        }), 400
+    max_workers = min(max(max_workers, 1), BATCH_MAX_WORKERS)
+
+    job_id = options.get('job_id')
+    checkpoint = None
+    if job_id:
+        if not BATCH_JOB_ID_PATTERN.match(job_id):
+            return jsonify({
+                'success': False,
+                'error': 'job_id只能包含字母、数字、下划线和连字符'
+            }), 400
+        os.makedirs(BATCH_CHECKPOINT_DIR, exist_ok=True)
+        checkpoint = BatchCheckpoint(os.path.join(BATCH_CHECKPOINT_DIR, f"{job_id}.jsonl"))
+
+    prompt_type = options.get('prompt_type', 'default')
+    model_params = {'temperature': temperature, 'max_tokens': max_tokens}
+
+    logger.info(f"批量任务 {job_id or '-'} 开始: {len(items)} 条，类型: {prompt_type}，并发: {max_workers}")
+
+    def generate():
+        for result in run_batch(
+            chat_chain,
+            items,
+            prompt_type=prompt_type,
+            max_workers=max_workers,
+            checkpoint=checkpoint,
+            **model_params
+        ):
+            if not result['success']:
+                logger.error(f"批量任务 {job_id or '-'} 条目 {result['id']} 失败: {result['error']}")
+            yield json.dumps(result, ensure_ascii=False) + '\n'
+        logger.info(f"批量任务 {job_id or '-'} 完成")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+def _gzip_stream(chunks):
+    """把字符串块流式压缩为gzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _export_ndjson(session_id):
+    records = chat_chain.iter_export(session_id)
+    if records is None:
+        return jsonify({
+            'success': False,
+            'error': '会话不存在'
+        }), 404
+
+    def generate():
+        try:
+            for record in records:
+                yield json.dumps(record, ensure_ascii=False) + '\n'
+        except Exception as e:
+            # 响应头已发出，只能以一行错误记录结束
+            logger.error(f"导出对话失败: {str(e)}")
+            yield json.dumps({'type': 'error', 'error': str(e)}, ensure_ascii=False) + '\n'
+
+    filename = re.sub(r'[^\w-]', '_', session_id)
+    headers = {
+        'Content-Disposition': f'attachment; filename="conversation-{filename}.jsonl"',
+        'Vary': 'Accept-Encoding'
+    }
+    body = generate()
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers['Content-Encoding'] = 'gzip'
+        body = _gzip_stream(body)
+
+    return Response(
+        stream_with_context(body),
+        mimetype='application/x-ndjson',
+        headers=headers
+    )
+
+def _routing_stats():
+    """路由表及各后端延迟；未配置API密钥时返回错误信息"""
+    try:
+        return get_router().get_stats()
+    except ValueError as e:
+        return {'error': str(e)}
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus格式的运行指标"""
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
 @app.route('/api/config', methods=['GET'])
 def get_config():
     """获取配置信息"""
@@ -252,10 +591,30 @@ def get_config():
         'success': True,
         'config': {
             'max_history': chat_chain.conversation_manager.max_history,
-            'available_prompts': list(chat_chain.system_prompts.keys()),
-            'model': 'deepseek-ai/DeepSeek-V3',
+            'max_context_tokens': chat_chain.max_context_tokens,
+            'available_prompts': chat_chain.prompt_registry.names(),
+            'model': chat_chain.llm.model_name,
             'api_url': os.environ.get('SILICON_FLOW_API_URL', 'https://api.siliconflow.cn/v1')
-        }
+        },
+        'connection_pool': get_client_pool().get_stats(),
+        'sessions': chat_chain.conversation_manager.get_stats(),
+        'response_cache': chat_chain.response_cache.get_stats() if chat_chain.response_cache else None,
+        'semantic_cache': chat_chain.semantic_cache.get_stats() if chat_chain.semantic_cache else None,
+        'prompts': chat_chain.prompt_registry.get_stats(),
+        'coalescing': get_single_flight().get_stats(),
+        'compaction': chat_chain.get_compaction_stats(),
+        'session_locks': chat_chain.session_locks.get_stats(),
+        'quota': get_quota_scheduler().get_stats(),
+        'routing': _routing_stats()
+    })
+
+@app.route('/api/prompts', methods=['GET'])
+def get_prompts():
+    """系统提示模板（版本、变量）及各版本的使用统计"""
+    return jsonify({
+        'success': True,
+        'prompts': chat_chain.prompt_registry.describe(),
+        'registry': chat_chain.prompt_registry.get_stats()
     })
 
 @app.errorhandler(404)
@@ -286,18 +645,32 @@ if __name__ == '__main__':
     print("📡 API文档:")
     print("   GET  /api/health              - 健康检查")
     print("   POST /api/chat/session        - 创建会话")
-    print("   POST /api/chat/message        - 发送消息")
-    print("   GET  /api/chat/history/<id>   - 获取历史")
+    print("   POST /api/chat/message        - 发送消息（stream=true 时以SSE流式返回）")
+    print("   POST /api/chat/batch          - 批量对话（JSONL流式返回，job_id 支持断点续跑）")
+    print("   GET  /api/chat/history/<id>   - 获取历史（offset/limit/since 分页）")
+    print("   GET  /api/chat/export/<id>    - 导出对话（format=ndjson 流式导出，支持gzip）")
     print("   POST /api/chat/clear/<id>     - 清空对话")
-    print("   GET  /api/chat/sessions       - 列出会话")
+    print("   GET  /api/chat/sessions       - 列出会话（limit/cursor/prompt_type 分页过滤）")
     print("   GET  /api/config              - 获取配置")
+    print("   GET  /api/prompts             - 系统提示模板及各版本的用量和耗时")
+    print("   GET  /api/metrics             - 运行指标（Prometheus格式）")
+    print()
+    print("   多进程模式: python worker_pool.py --workers 4")
     print()
-    print("🌐 服务地址: http://localhost:5000")
-    print("📖 Swagger文档: http://localhost:5000/api/health")
+    
+    port = int(os.environ.get('PORT', 5000))
+    if WORKER_COUNT > 1:
+        # SIGTERM时正常退出，使atexit提交会话存储
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print(f"👷 worker {WORKER_ID}/{WORKER_COUNT} 监听端口 {port}")
+    else:
+        print(f"🌐 服务地址: http://localhost:{port}")
+        print(f"📖 Swagger文档: http://localhost:{port}/api/health")
     
     app.run(
-        host='0.0.0.0',
-        port=5000,
-        debug=True,
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=port,
+        # 多worker模式下关闭调试重载器，避免每个worker再派生子进程；压测时用 FLASK_DEBUG=0 关闭
+        debug=WORKER_COUNT <= 1 and os.environ.get('FLASK_DEBUG', '1') != '0',
         threaded=True
     ) 
\ No newline at end of file
@@ -0,0 +1,191 @@
+"""
+DeepSeek V3 聊天API服务（ASGI异步版本）
+路由与JSON结构与 chat_api.py 完全一致：
+/api/chat/message 由协程处理，等待上游时不占用线程；
+其余轻量路由直接复用 chat_api 中的Flask应用。
+
+启动方式: uvicorn chat_asgi:app --host 0.0.0.0 --port 5000
+"""
+
+import os
+import logging
+import traceback
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route, Mount
+from a2wsgi import WSGIMiddleware
+import chat_api
+import metrics
+from chat_api import chat_chain, _ensure_session, _generation_params, _sse_event, _retry_after_headers
+from client_pool import get_client_pool
+
+logger = logging.getLogger(__name__)
+
+# 由协程直接处理的路由；挂载的Flask路由由 chat_api 自己统计
+_NATIVE_ROUTES = {'/api/chat/message'}
+
+
+class MetricsMiddleware:
+    """统计协程路由的耗时、状态码和在途数（直到响应体发送完毕）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] not in _NATIVE_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        route = scope['path']
+        start = metrics.request_started(route)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.request_finished(route, scope['method'], status, start)
+
+
+def _stream_message(session_id, message, temperature, max_tokens):
+    """以SSE方式流式返回回复（异步版本）"""
+    async def generate():
+        async for event in chat_chain.achat_stream(
+            session_id,
+            message,
+            temperature=temperature,
+            max_tokens=max_tokens
+        ):
+            if event['type'] == 'done':
+                logger.info(f"会话 {session_id} 流式响应完成，首字: {event['time_to_first_token'] or 0:.2f}秒，"
+                            f"总用时: {event['response_time']:.2f}秒")
+            elif event['type'] == 'error':
+                logger.error(f"会话 {session_id} 流式响应失败: {event['error']}")
+            yield _sse_event(event)
+
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+
+async def send_message(request: Request):
+    """发送消息并获取回复"""
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not data:
+            return JSONResponse({
+                'success': False,
+                'error': '请求数据为空'
+            }, status_code=400)
+
+        session_id = data.get('session_id')
+        message = data.get('message', '').strip()
+
+        if not message:
+            return JSONResponse({
+                'success': False,
+                'error': '消息内容不能为空'
+            }, status_code=400)
+
+        # 获取可选参数
+        try:
+            temperature, max_tokens = _generation_params(data)
+        except ValueError as e:
+            return JSONResponse({
+                'success': False,
+                'error': str(e)
+            }, status_code=400)
+
+        # 如果没有会话ID，创建新会话（可能读取存储，不在事件循环上执行）
+        session_id = await run_in_threadpool(_ensure_session, session_id)
+
+        logger.info(f"会话 {session_id} 收到消息: {message[:50]}...")
+
+        # SSE模式：逐字推送回复
+        if data.get('stream'):
+            return _stream_message(session_id, message, temperature, max_tokens)
+
+        # 调用对话链条
+        result = await chat_chain.achat(
+            session_id,
+            message,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            cacheable=bool(data.get('cacheable'))
+        )
+
+        if result['success']:
+            logger.info(f"会话 {session_id} 响应成功，用时: {result['response_time']:.2f}秒")
+            return JSONResponse({
+                'success': True,
+                'session_id': session_id,
+                'response': result['response'],
+                'message_count': result['message_count'],
+                'response_time': result['response_time'],
+                'cached': result['cached']
+            })
+        else:
+            logger.error(f"会话 {session_id} 响应失败: {result['error']}")
+            return JSONResponse({
+                'success': False,
+                'error': result['error'],
+                'error_type': result['error_type'],
+                'session_id': session_id
+            }, status_code=result['status_code'], headers=_retry_after_headers(result))
+
+    except Exception as e:
+        logger.error(f"发送消息失败: {str(e)}\n{traceback.format_exc()}")
+        return JSONResponse({
+            'success': False,
+            'error': str(e)
+        }, status_code=500)
+
+
+async def _close_clients():
+    """关闭异步客户端的连接"""
+    await get_client_pool().aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/chat/message', send_message, methods=['POST']),
+        # 其余路由不涉及上游调用，交给Flask应用在线程池中处理
+        Mount('/', app=WSGIMiddleware(chat_api.app))
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(MetricsMiddleware)
+    ],
+    on_shutdown=[_close_clients]
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    print("🚀 DeepSeek V3 聊天API服务启动（ASGI异步模式）")
+    print(f"🔀 上游并发上限: {chat_chain.max_concurrency}")
+    print("🌐 服务地址: http://localhost:5000")
+
+    uvicorn.run(
+        app,
+        host='0.0.0.0',
+        port=int(os.environ.get('PORT', 5000))
+    )
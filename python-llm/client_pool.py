@@ -0,0 +1,244 @@
+"""
+OpenAI客户端连接池
+按 (api_key, base_url) 复用长生命周期客户端，避免每轮对话重新建立连接
+httpx 和 openai 在创建第一个客户端时才导入，不计入服务启动时间
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Dict, Tuple, Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import OpenAI, AsyncOpenAI
+
+
+def _env_int(name: str, default: int) -> int:
+    """读取整数环境变量"""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    """读取浮点数环境变量"""
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class ConnectionStats:
+    """连接复用统计，通过httpcore的trace事件识别新建连接"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+
+    def on_request(self, request: 'httpx.Request'):
+        """httpx请求钩子：计数并挂载trace回调"""
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self._trace
+
+    async def on_request_async(self, request: 'httpx.Request'):
+        """异步httpx请求钩子"""
+        with self._lock:
+            self.requests += 1
+        request.extensions['trace'] = self._trace_async
+
+    def _trace(self, event_name: str, info: Dict[str, Any]):
+        if event_name == 'connection.connect_tcp.complete':
+            with self._lock:
+                self.connections_opened += 1
+
+    async def _trace_async(self, event_name: str, info: Dict[str, Any]):
+        self._trace(event_name, info)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = self.requests
+            opened = self.connections_opened
+        reused = max(requests - opened, 0)
+        return {
+            'requests': requests,
+            'connections_opened': opened,
+            'connections_reused': reused,
+            'reuse_ratio': round(reused / requests, 4) if requests else 0.0
+        }
+
+
+class OpenAIClientPool:
+    """线程安全的OpenAI客户端池，每个 (api_key, base_url) 共享一个keep-alive连接池"""
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        max_retries: Optional[int] = None
+    ):
+        self.max_connections = max_connections if max_connections is not None \
+            else _env_int('LLM_HTTP_MAX_CONNECTIONS', 100)
+        self.max_keepalive_connections = max_keepalive_connections if max_keepalive_connections is not None \
+            else _env_int('LLM_HTTP_MAX_KEEPALIVE', 20)
+        self.keepalive_expiry = keepalive_expiry if keepalive_expiry is not None \
+            else _env_float('LLM_HTTP_KEEPALIVE_EXPIRY', 60.0)
+        self.timeout = timeout if timeout is not None \
+            else _env_float('LLM_HTTP_TIMEOUT', 120.0)
+        self.connect_timeout = connect_timeout if connect_timeout is not None \
+            else _env_float('LLM_HTTP_CONNECT_TIMEOUT', 10.0)
+        # SDK内置重试默认关闭，由 resilience.call_with_retry 统一重试并配合熔断
+        self.max_retries = max_retries if max_retries is not None \
+            else _env_int('LLM_HTTP_MAX_RETRIES', 0)
+
+        self._clients: Dict[Tuple[str, str], 'OpenAI'] = {}
+        # 事件循环 -> {(api_key, base_url): 客户端}；以循环对象本身（弱引用）为键，
+        # 新循环不会因复用了旧循环的 id 而拿到绑定在已关闭循环上的客户端
+        self._async_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._stats: Dict[Tuple[str, str], ConnectionStats] = {}
+        self._lock = threading.Lock()
+
+    def _limits(self) -> 'httpx.Limits':
+        import httpx
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def _timeout(self) -> 'httpx.Timeout':
+        import httpx
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+    def _build_http_client(self, stats: ConnectionStats) -> 'httpx.Client':
+        """构建带连接池限制和超时设置的httpx客户端"""
+        import httpx
+        return httpx.Client(
+            limits=self._limits(),
+            timeout=self._timeout(),
+            event_hooks={'request': [stats.on_request]}
+        )
+
+    def _get_stats(self, key: Tuple[str, str]) -> ConnectionStats:
+        """获取端点统计对象（调用方需持有锁）"""
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = ConnectionStats()
+        return stats
+
+    def get_client(self, api_key: str, base_url: str) -> 'OpenAI':
+        """获取（或创建）对应 (api_key, base_url) 的共享客户端"""
+        key = (api_key, base_url)
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                from openai import OpenAI
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=self.max_retries,
+                    http_client=self._build_http_client(self._get_stats(key))
+                )
+                self._clients[key] = client
+            return client
+
+    def get_async_client(self, api_key: str, base_url: str) -> 'AsyncOpenAI':
+        """获取当前事件循环下对应 (api_key, base_url) 的共享异步客户端
+
+        httpx.AsyncClient 的连接绑定在事件循环上，因此按事件循环分别缓存。
+        """
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url)
+        clients = self._async_clients.get(loop)
+        client = clients.get(key) if clients is not None else None
+        if client is not None:
+            return client
+
+        with self._lock:
+            self._drop_closed_loops()
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                import httpx
+                from openai import AsyncOpenAI
+                stats = self._get_stats((api_key, base_url))
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=self.max_retries,
+                    http_client=httpx.AsyncClient(
+                        limits=self._limits(),
+                        timeout=self._timeout(),
+                        event_hooks={'request': [stats.on_request_async]}
+                    )
+                )
+                clients[key] = client
+            return client
+
+    def _drop_closed_loops(self):
+        """释放已关闭的事件循环上的客户端（调用方需持有锁）
+
+        客户端的连接引用着所属的循环，弱引用键不会自动失效；循环关闭后已无法 await 关闭，
+        丢弃引用后由垃圾回收释放底层socket。
+        """
+        for loop in [loop for loop in self._async_clients if loop.is_closed()]:
+            del self._async_clients[loop]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取连接池配置及各端点的连接复用统计"""
+        with self._lock:
+            self._drop_closed_loops()
+            items = list(self._stats.items())
+        return {
+            'config': {
+                'max_connections': self.max_connections,
+                'max_keepalive_connections': self.max_keepalive_connections,
+                'keepalive_expiry': self.keepalive_expiry,
+                'timeout': self.timeout,
+                'connect_timeout': self.connect_timeout
+            },
+            'endpoints': {
+                base_url: stats.snapshot()
+                for (_, base_url), stats in items
+            }
+        }
+
+    def close(self):
+        """关闭所有同步客户端及其连接"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+    async def aclose(self):
+        """关闭当前事件循环下的异步客户端"""
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.close()
+
+
+_default_pool: Optional[OpenAIClientPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_client_pool() -> OpenAIClientPool:
+    """获取进程级默认客户端池"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = OpenAIClientPool()
+    return _default_pool
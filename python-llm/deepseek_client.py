@@ -0,0 +1,359 @@
+"""
+DeepSeek V3 上游调用客户端
+按 BackendRouter 选择后端并失败切换，负责配额排队、重试、相同请求合并和用量统计。
+不依赖 langchain_core，AdvancedDeepSeekChain 在第一次使用 llm 时才加载本模块；
+需要接入LangChain时使用 deepseek_llm.DeepSeekV3LLM。
+"""
+
+import logging
+import os
+import time
+from functools import lru_cache
+from typing import Optional, List, Dict, Any, Iterator, AsyncIterator, Callable, Awaitable
+from single_flight import get_single_flight, make_request_key
+from llm_errors import LLMError, CircuitOpenError, classify_error
+from resilience import RetryPolicy, call_with_retry, acall_with_retry
+from rate_limiter import QuotaScheduler, get_quota_scheduler
+from backend_router import Backend, DEFAULT_MODEL, get_router
+from metrics import UPSTREAM_LATENCY, record_usage
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=1)
+def _get_retry_policy() -> RetryPolicy:
+    """上游调用的重试策略（进程内共享）"""
+    return RetryPolicy()
+
+
+def _report_usage(kwargs: Dict[str, Any], usage) -> None:
+    """把响应的 usage 交给调用方传入的 on_usage 回调"""
+    on_usage = kwargs.get('on_usage')
+    if on_usage is not None and usage is not None:
+        on_usage(usage)
+
+
+def _admitted(scheduler: QuotaScheduler, cost: int, priority: str, create: Callable[[], Any]) -> Callable[[], Any]:
+    """包装一次上游请求：每次发送前（含重试和切换后端）都申请配额，失败时退还预扣的token
+
+    返回的函数产出 (响应, 预扣token数)，由调用方在拿到用量后 settle。
+    """
+    def send():
+        reserved = scheduler.acquire(cost, priority)
+        try:
+            return create(), reserved
+        except BaseException:
+            scheduler.refund(reserved)
+            raise
+    return send
+
+
+def _aadmitted(scheduler: QuotaScheduler, cost: int, priority: str,
+               create: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+    """_admitted 的异步版本"""
+    async def send():
+        reserved = await scheduler.aacquire(cost, priority)
+        try:
+            return await create(), reserved
+        except BaseException:
+            scheduler.refund(reserved)
+            raise
+    return send
+
+
+@lru_cache(maxsize=1)
+def _stream_options() -> Dict[str, Any]:
+    """流式请求附带 stream_options.include_usage，使上游在最后一个分块中返回用量（LLM_STREAM_USAGE=0 关闭）"""
+    if os.environ.get('LLM_STREAM_USAGE', '1').lower() in ('0', 'false', 'no'):
+        return {}
+    return {'extra_body': {'stream_options': {'include_usage': True}}}
+
+
+class DeepSeekV3Client:
+    """DeepSeek V3硅基流动调用封装
+    
+    请求由 BackendRouter 按延迟选择后端，当前后端失败时依次切换到下一个。
+    """
+    
+    model_name: str = DEFAULT_MODEL
+    temperature: float = 0.7
+    max_tokens: int = 4096
+    
+    def __init__(self, model_name: Optional[str] = None, temperature: Optional[float] = None,
+                 max_tokens: Optional[int] = None):
+        if model_name is not None:
+            self.model_name = model_name
+        if temperature is not None:
+            self.temperature = temperature
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
+    
+    @staticmethod
+    def _record_attempt(backend: Backend, start: float, ok: bool):
+        """更新后端的EWMA统计和上游耗时直方图"""
+        elapsed = time.perf_counter() - start
+        backend.end(elapsed, ok=ok)
+        UPSTREAM_LATENCY.observe(elapsed, backend=backend.name, outcome='ok' if ok else 'error')
+    
+    @staticmethod
+    def _record_rejected(backend: Backend, start: float):
+        """上游拒绝了请求本身（如参数错误、上下文过长）：后端是健康的，不计入其错误率"""
+        backend.abort()
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, backend=backend.name, outcome='rejected')
+    
+    @staticmethod
+    def _should_fail_over(error: LLMError) -> bool:
+        """可重试的错误（限流、5xx、超时、连接失败）和熔断才切换后端；
+        请求本身的错误换一个后端也会失败，还可能被另一个模型悄悄回答，直接抛出"""
+        return error.retryable or isinstance(error, CircuitOpenError)
+    
+    def _with_failover(self, model: str, attempt: Callable[[Backend], Any]) -> Any:
+        """依次在候选后端上执行 attempt(backend)，直到成功或全部失败"""
+        last_error: Optional[LLMError] = None
+        for backend in get_router().candidates(model):
+            start = time.perf_counter()
+            backend.begin()
+            try:
+                result = attempt(backend)
+            except LLMError as e:
+                if not self._should_fail_over(e):
+                    self._record_rejected(backend, start)
+                    raise
+                self._record_attempt(backend, start, ok=False)
+                last_error = e
+                logger.warning(f"后端 {backend.name} 调用失败（{e.code}），尝试下一个后端")
+                continue
+            except BaseException:
+                self._record_attempt(backend, start, ok=False)
+                raise
+            self._record_attempt(backend, start, ok=True)
+            return result
+        raise last_error
+    
+    async def _awith_failover(self, model: str, attempt: Callable[[Backend], Awaitable[Any]]) -> Any:
+        """_with_failover 的异步版本"""
+        last_error: Optional[LLMError] = None
+        for backend in get_router().candidates(model):
+            start = time.perf_counter()
+            backend.begin()
+            try:
+                result = await attempt(backend)
+            except LLMError as e:
+                if not self._should_fail_over(e):
+                    self._record_rejected(backend, start)
+                    raise
+                self._record_attempt(backend, start, ok=False)
+                last_error = e
+                logger.warning(f"后端 {backend.name} 调用失败（{e.code}），尝试下一个后端")
+                continue
+            except BaseException:
+                self._record_attempt(backend, start, ok=False)
+                raise
+            self._record_attempt(backend, start, ok=True)
+            return result
+        raise last_error
+    
+    def complete(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        """以单条用户消息调用API，使用实例的默认参数"""
+        try:
+            messages = [{"role": "user", "content": prompt}]
+            scheduler = get_quota_scheduler()
+            cost = scheduler.estimate_cost(messages, self.max_tokens)
+            
+            def attempt(backend: Backend):
+                return call_with_retry(
+                    _admitted(scheduler, cost, 'interactive', lambda: backend.client().chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=self.temperature,
+                        max_tokens=self.max_tokens,
+                        stop=stop if stop else None
+                    )),
+                    backend.breaker,
+                    _get_retry_policy()
+                )
+            
+            response, reserved = self._with_failover(self.model_name, attempt)
+            scheduler.settle(reserved, response.usage)
+            record_usage(response.model or self.model_name, response.usage)
+            return response.choices[0].message.content or ""
+            
+        except Exception as e:
+            raise classify_error(e) from e
+    
+    def call_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """使用消息列表调用API（支持多轮对话）
+        
+        同时进行的完全相同的请求（消息列表与参数都相同）只向上游发送一次，共享同一结果。
+        发送前按 priority（interactive / default / batch）排队申请RPM/TPM配额，
+        可重试的错误按 RetryPolicy 重试，失败时抛出分类后的 LLMError。
+        kwargs 中的 model 指定首选模型，默认使用 model_name；on_usage 在拿到响应的 usage 后被调用
+        （合并的请求只对发出请求的调用方调用一次）。
+        """
+        try:
+            # 应用kwargs中的参数
+            model = kwargs.get('model') or self.model_name
+            temperature = kwargs.get('temperature', self.temperature)
+            max_tokens = kwargs.get('max_tokens', self.max_tokens)
+            priority = kwargs.get('priority', 'interactive')
+            scheduler = get_quota_scheduler()
+            cost = scheduler.estimate_cost(messages, max_tokens)
+            
+            def attempt(backend: Backend):
+                return call_with_retry(
+                    _admitted(scheduler, cost, priority, lambda: backend.client().chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens
+                    )),
+                    backend.breaker,
+                    _get_retry_policy()
+                )
+            
+            def request():
+                response, reserved = self._with_failover(model, attempt)
+                scheduler.settle(reserved, response.usage)
+                record_usage(response.model or model, response.usage)
+                # 只有真正发出请求的调用方记录用量，合并的等待者不重复计入
+                _report_usage(kwargs, response.usage)
+                return response.choices[0].message.content or ""
+            
+            key = make_request_key(model, messages, temperature, max_tokens)
+            return get_single_flight().do(key, request)
+            
+        except Exception as e:
+            raise classify_error(e) from e
+    
+    def stream_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> Iterator[str]:
+        """使用消息列表流式调用API，逐段产出文本增量
+        
+        只在建立流（收到首个响应）之前重试和切换后端，开始输出后的错误直接抛出。
+        """
+        try:
+            model = kwargs.get('model') or self.model_name
+            temperature = kwargs.get('temperature', self.temperature)
+            max_tokens = kwargs.get('max_tokens', self.max_tokens)
+            scheduler = get_quota_scheduler()
+            cost = scheduler.estimate_cost(messages, max_tokens)
+            priority = kwargs.get('priority', 'interactive')
+            
+            def attempt(backend: Backend):
+                return call_with_retry(
+                    _admitted(scheduler, cost, priority, lambda: backend.client().chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=True,
+                        **_stream_options()
+                    )),
+                    backend.breaker,
+                    _get_retry_policy()
+                )
+            
+            stream, reserved = self._with_failover(model, attempt)
+        except Exception as e:
+            raise classify_error(e) from e
+        
+        usage = None
+        try:
+            for chunk in stream:
+                # 用量在最后一个分块中返回
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+                    record_usage(chunk.model or model, usage)
+                    _report_usage(kwargs, usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except Exception as e:
+            raise classify_error(e) from e
+        finally:
+            # 提前中断时释放底层连接，使其回到连接池
+            stream.close()
+            # 按最后一个分块的用量退还多预扣的token；没有收到用量时（提前中断）不退还
+            scheduler.settle(reserved, usage)
+    
+    async def acall_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        """使用消息列表异步调用API，相同的并发请求同样只发送一次"""
+        try:
+            model = kwargs.get('model') or self.model_name
+            temperature = kwargs.get('temperature', self.temperature)
+            max_tokens = kwargs.get('max_tokens', self.max_tokens)
+            priority = kwargs.get('priority', 'interactive')
+            scheduler = get_quota_scheduler()
+            cost = scheduler.estimate_cost(messages, max_tokens)
+            
+            def attempt(backend: Backend):
+                return acall_with_retry(
+                    _aadmitted(scheduler, cost, priority, lambda: backend.async_client().chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens
+                    )),
+                    backend.breaker,
+                    _get_retry_policy()
+                )
+            
+            async def request():
+                response, reserved = await self._awith_failover(model, attempt)
+                scheduler.settle(reserved, response.usage)
+                record_usage(response.model or model, response.usage)
+                _report_usage(kwargs, response.usage)
+                return response.choices[0].message.content or ""
+            
+            key = make_request_key(model, messages, temperature, max_tokens)
+            return await get_single_flight().ado(key, request)
+            
+        except Exception as e:
+            raise classify_error(e) from e
+    
+    async def astream_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        """使用消息列表异步流式调用API"""
+        try:
+            model = kwargs.get('model') or self.model_name
+            temperature = kwargs.get('temperature', self.temperature)
+            max_tokens = kwargs.get('max_tokens', self.max_tokens)
+            scheduler = get_quota_scheduler()
+            cost = scheduler.estimate_cost(messages, max_tokens)
+            priority = kwargs.get('priority', 'interactive')
+            
+            def attempt(backend: Backend):
+                return acall_with_retry(
+                    _aadmitted(scheduler, cost, priority, lambda: backend.async_client().chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        stream=True,
+                        **_stream_options()
+                    )),
+                    backend.breaker,
+                    _get_retry_policy()
+                )
+            
+            stream, reserved = await self._awith_failover(model, attempt)
+        except Exception as e:
+            raise classify_error(e) from e
+        
+        usage = None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+                    record_usage(chunk.model or model, usage)
+                    _report_usage(kwargs, usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except Exception as e:
+            raise classify_error(e) from e
+        finally:
+            await stream.close()
+            scheduler.settle(reserved, usage)
@@ -0,0 +1,55 @@
+"""
+DeepSeek V3 的LangChain LLM封装
+调用逻辑都在 deepseek_client.DeepSeekV3Client 中；服务本身不经过LangChain，
+只有在LangChain链路中使用时才需要导入本模块（langchain_core 导入较慢）。
+"""
+
+from typing import Optional, List, Dict, Any, Iterator, AsyncIterator
+from langchain_core.language_models import LLM
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from backend_router import DEFAULT_MODEL
+from deepseek_client import DeepSeekV3Client
+
+
+class DeepSeekV3LLM(LLM):
+    """DeepSeek V3硅基流动LLM封装 - 高级版本
+    
+    请求由 BackendRouter 按延迟选择后端，当前后端失败时依次切换到下一个。
+    """
+    
+    model_name: str = DEFAULT_MODEL
+    temperature: float = 0.7
+    max_tokens: int = 4096
+    
+    def __init__(self, **kwargs):
+        """初始化DeepSeek V3 LLM"""
+        super().__init__(**kwargs)
+    
+    @property
+    def _llm_type(self) -> str:
+        return "deepseek_v3_advanced"
+    
+    def _client(self) -> DeepSeekV3Client:
+        return DeepSeekV3Client(self.model_name, self.temperature, self.max_tokens)
+    
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> str:
+        """调用DeepSeek V3 API"""
+        return self._client().complete(prompt, stop)
+    
+    def call_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        return self._client().call_with_messages(messages, **kwargs)
+    
+    def stream_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> Iterator[str]:
+        return self._client().stream_with_messages(messages, **kwargs)
+    
+    async def acall_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        return await self._client().acall_with_messages(messages, **kwargs)
+    
+    def astream_with_messages(self, messages: List[Dict[str, str]], **kwargs) -> AsyncIterator[str]:
+        return self._client().astream_with_messages(messages, **kwargs)
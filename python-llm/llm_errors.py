@@ -0,0 +1,142 @@
+"""
+上游调用错误分类
+把OpenAI SDK抛出的各类异常归为限流、服务端错误、超时等，便于重试、熔断以及向前端返回对应的状态码
+"""
+
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+class LLMError(Exception):
+    """上游调用失败
+
+    - code: 错误类别，随响应一起返回给前端
+    - status_code: 本服务应返回的HTTP状态码
+    - retryable: 是否值得重试
+    - retry_after: 上游建议的等待秒数（Retry-After）
+    """
+
+    code = 'upstream_error'
+    status_code = 502
+    retryable = False
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, upstream_status: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.upstream_status = upstream_status
+
+
+class RateLimitError(LLMError):
+    """上游限流（429）"""
+    code = 'rate_limited'
+    status_code = 429
+    retryable = True
+
+
+class UpstreamServerError(LLMError):
+    """上游服务端错误（5xx）"""
+    code = 'upstream_unavailable'
+    status_code = 502
+    retryable = True
+
+
+class UpstreamTimeoutError(LLMError):
+    """请求上游超时"""
+    code = 'upstream_timeout'
+    status_code = 504
+    retryable = True
+
+
+class UpstreamConnectionError(LLMError):
+    """无法连接上游"""
+    code = 'upstream_unreachable'
+    status_code = 502
+    retryable = True
+
+
+class UpstreamRequestError(LLMError):
+    """上游拒绝请求（除429外的4xx，如参数错误、密钥无效），重试无意义"""
+    code = 'upstream_rejected'
+    status_code = 502
+
+
+class QuotaExceededError(LLMError):
+    """本地配额调度排队超时，未向上游发送请求"""
+    code = 'quota_exceeded'
+    status_code = 429
+
+
+class CircuitOpenError(LLMError):
+    """熔断器打开，未向上游发送请求"""
+    code = 'circuit_open'
+    status_code = 503
+
+
+class InternalError(LLMError):
+    """本服务自身的错误（如参数类型不对导致的异常），与上游无关"""
+    code = 'internal_error'
+    status_code = 500
+
+
+def _parse_retry_after(response) -> Optional[float]:
+    """解析 retry-after-ms / Retry-After（秒数或HTTP日期）"""
+    if response is None:
+        return None
+    headers = response.headers
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _classify_status(message: str, status: int, response) -> LLMError:
+    """按上游返回的HTTP状态码分类"""
+    retry_after = _parse_retry_after(response)
+    if status == 429:
+        return RateLimitError(message, retry_after, status)
+    if status >= 500:
+        return UpstreamServerError(message, retry_after, status)
+    if status == 408:
+        return UpstreamTimeoutError(message, retry_after, status)
+    return UpstreamRequestError(message, upstream_status=status)
+
+
+def classify_error(error: Exception) -> LLMError:
+    """把异常转换为对应的 LLMError
+
+    只有SDK（openai / httpx）抛出的异常才归为上游错误，其余异常是本服务自身的问题，
+    归为 InternalError（500，不重试、不切换后端、不计入熔断）。
+    """
+    if isinstance(error, LLMError):
+        return error
+
+    # 只在出错时才需要SDK的异常类型，避免导入本模块时加载openai
+    import httpx
+    import openai
+
+    message = f"API调用失败: {str(error)}"
+    if isinstance(error, (openai.APITimeoutError, httpx.TimeoutException)):
+        return UpstreamTimeoutError(message)
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return UpstreamConnectionError(message)
+    if isinstance(error, openai.APIStatusError):
+        return _classify_status(message, error.status_code, error.response)
+    if isinstance(error, httpx.HTTPStatusError):
+        return _classify_status(message, error.response.status_code, error.response)
+    if isinstance(error, (openai.OpenAIError, httpx.HTTPError)):
+        return LLMError(message)
+    return InternalError(f"内部错误: {str(error)}")
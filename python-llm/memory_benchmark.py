@@ -0,0 +1,157 @@
+"""
+会话内存基准
+在进程内用 tracemalloc 统计 ConversationManager 保存N个会话、每个会话M轮对话后的内存，输出：
+- 每会话字节数（含消息正文）和扣除正文后的结构开销
+- 单条消息的表示开销：Message 对象 vs 旧版的字典表示（ISO时间戳字符串、metadata字典、
+  每条消息复制一份 model_params、另存一份 {'role', 'content'} API字典）
+
+不需要API密钥和网络，结果可用 --output 保存，再用 --baseline 与之前的结果对比。
+
+示例:
+    python memory_benchmark.py --sessions 2000 --turns 10 --output memory.json
+    python memory_benchmark.py --sessions 2000 --turns 10 --baseline memory.json
+"""
+
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+from datetime import datetime
+from typing import Optional, Callable, Dict, Any, List
+
+from advanced_deepseek_chain import ConversationManager
+from message_history import Message
+from session_store import InMemorySessionStore
+
+SYSTEM_PROMPT = "你是一个专业的旅行规划助手，能够根据用户的需求提供详细的旅行建议和行程规划。"
+USER_PROMPT = "我想规划一个北京3天游，预算大概3000元，第{turn}个问题"
+REPLY_UNIT = "第一天上午参观故宫，下午前往颐和园。"
+MODEL_PARAMS = {'temperature': 0.7, 'max_tokens': 2048}
+
+
+def measure(build: Callable[[], Any]) -> int:
+    """build() 执行后仍被引用的内存（字节）"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del kept
+    return used
+
+
+def make_reply(reply_chars: int) -> str:
+    return (REPLY_UNIT * (reply_chars // len(REPLY_UNIT) + 1))[:reply_chars]
+
+
+def populate(sessions: int, turns: int, reply_chars: int, max_history: int) -> ConversationManager:
+    manager = ConversationManager(
+        max_history=max_history, session_ttl=0, max_sessions=0, store=InMemorySessionStore()
+    )
+    for _ in range(sessions):
+        session_id = manager.create_session()
+        manager.add_message(session_id, 'system', SYSTEM_PROMPT, {'prompt_type': 'travel'})
+        for turn in range(turns):
+            manager.add_message(session_id, 'user', USER_PROMPT.format(turn=turn))
+            # 每轮各自的回复字符串，与线上一样不共享正文
+            manager.add_message(session_id, 'assistant', make_reply(reply_chars) + str(turn), {
+                'response_time': 1.25,
+                'cached': False,
+                'model_params': dict(MODEL_PARAMS)
+            })
+    return manager
+
+
+def legacy_message(role: str, content: str, metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """旧版的消息字典及其缓存的API字典"""
+    return [
+        {
+            'role': role,
+            'content': content,
+            'timestamp': datetime.now().isoformat(),
+            'metadata': metadata or {}
+        },
+        {'role': role, 'content': content}
+    ]
+
+
+def message_overhead(count: int, make: Callable[..., Any]) -> float:
+    """单条助手消息除正文外的平均字节数"""
+    contents = [f"回复{i}" for i in range(count)]
+    used = measure(lambda: [
+        make('assistant', content, metadata={
+            'response_time': 1.25, 'cached': False, 'model_params': dict(MODEL_PARAMS)
+        })
+        for content in contents
+    ])
+    return used / count
+
+
+def run(args) -> Dict[str, Any]:
+    reply = make_reply(args.reply_chars)
+    content_bytes = sys.getsizeof(SYSTEM_PROMPT) + args.turns * (
+        sys.getsizeof(USER_PROMPT.format(turn=0)) + sys.getsizeof(reply + '0')
+    )
+    total = measure(lambda: populate(args.sessions, args.turns, args.reply_chars, args.max_history))
+    per_session = total / args.sessions
+    return {
+        'config': {
+            'sessions': args.sessions,
+            'turns': args.turns,
+            'reply_chars': args.reply_chars,
+            'max_history': args.max_history
+        },
+        'bytes_per_session': round(per_session),
+        'content_bytes_per_session': content_bytes,
+        'overhead_bytes_per_session': round(per_session - content_bytes),
+        'bytes_per_message': {
+            'message': round(message_overhead(args.samples, Message)),
+            'legacy_dict': round(message_overhead(args.samples, legacy_message))
+        }
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    def delta(key: str) -> str:
+        if not baseline or not baseline.get(key):
+            return ''
+        return f"  ({(report[key] - baseline[key]) / baseline[key] * 100:+.1f}%)"
+
+    config = report['config']
+    print(f"📦 {config['sessions']} 个会话 × {config['turns']} 轮，回复 {config['reply_chars']} 字")
+    print(f"   每会话内存:   {report['bytes_per_session']:>8,} B{delta('bytes_per_session')}")
+    print(f"   其中消息正文: {report['content_bytes_per_session']:>8,} B")
+    print(f"   结构开销:     {report['overhead_bytes_per_session']:>8,} B{delta('overhead_bytes_per_session')}")
+    per_message = report['bytes_per_message']
+    print(f"   单条消息开销: Message {per_message['message']} B / 旧版字典 {per_message['legacy_dict']} B")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会话内存基准')
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--turns', type=int, default=10, help='每个会话的对话轮数')
+    parser.add_argument('--reply-chars', type=int, default=200, help='每条回复的字数')
+    parser.add_argument('--max-history', type=int, default=20, help='每个会话保留的轮数')
+    parser.add_argument('--samples', type=int, default=10000, help='单条消息开销的采样数')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    parser.add_argument('--baseline', help='与之前保存的结果对比')
+    args = parser.parse_args()
+
+    report = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+有界对话历史
+系统提示常驻，其余消息保存在定长环形缓冲区中，追加与淘汰均为O(1)
+"""
+
+import sys
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from typing import Optional, List, Dict, Any, Iterator, Tuple
+from token_counter import estimate_message_tokens
+
+# 角色只有少数几种，统一指向同一个字符串对象，从存储加载的消息也不会各自持有一份
+_ROLES = {role: role for role in ('system', 'user', 'assistant')}
+
+
+def intern_role(role: str) -> str:
+    return _ROLES.get(role) or sys.intern(role)
+
+
+@lru_cache(maxsize=256)
+def _shared_params(items: Tuple[Tuple[str, Any], ...]) -> Dict[str, Any]:
+    return dict(items)
+
+
+def share_model_params(params: Dict[str, Any]) -> Dict[str, Any]:
+    """相同的模型参数在所有消息间共享同一个字典（调用方不应修改），含不可哈希的值时原样返回"""
+    try:
+        return _shared_params(tuple(sorted(params.items())))
+    except TypeError:
+        return params
+
+
+def parse_timestamp(value: Optional[str]) -> float:
+    """ISO时间戳转为epoch秒，缺失时为0"""
+    return datetime.fromisoformat(value).timestamp() if value else 0.0
+
+
+def format_timestamp(created: float) -> str:
+    return datetime.fromtimestamp(created).isoformat()
+
+
+class Message:
+    """一条对话消息
+
+    只在接口和存储边界转换为 {'role', 'content', 'timestamp', 'metadata'} 字典：
+    - role 指向共享的角色字符串
+    - created 为epoch秒；由 datetime.now() 得到，与ISO字符串互转不丢精度
+    - metadata 为空时不分配字典，其中的 model_params 在消息间共享
+    """
+
+    __slots__ = ('role', 'content', 'created', 'metadata')
+
+    def __init__(
+        self,
+        role: str,
+        content: str,
+        created: Optional[float] = None,
+        metadata: Optional[Dict[str, Any]] = None
+    ):
+        self.role = intern_role(role)
+        self.content = content
+        self.created = datetime.now().timestamp() if created is None else created
+        if metadata and 'model_params' in metadata:
+            metadata = {**metadata, 'model_params': share_model_params(metadata['model_params'])}
+        self.metadata = metadata or None
+
+    @property
+    def timestamp(self) -> str:
+        return format_timestamp(self.created)
+
+    def meta(self, key: str, default: Any = None) -> Any:
+        return self.metadata.get(key, default) if self.metadata else default
+
+    def to_dict(self) -> Dict[str, Any]:
+        """接口格式，metadata 为副本"""
+        return {
+            'role': self.role,
+            'content': self.content,
+            'timestamp': self.timestamp,
+            'metadata': dict(self.metadata) if self.metadata else {}
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Message':
+        return cls(data['role'], data['content'], parse_timestamp(data.get('timestamp')), data.get('metadata'))
+
+    def __repr__(self) -> str:
+        return f"Message({self.role!r}, {self.content[:20]!r}, {self.timestamp})"
+
+
+class MessageHistory:
+    """单个会话的消息历史（Message 对象）
+
+    - system: 常驻的系统提示，不参与淘汰
+    - 其余消息存放在deque中，超出容量时丢弃最旧的 trim_step 条（默认1条，即滑动窗口）；
+      trim_step 较大时两次丢弃之间发送的上下文只在末尾追加，前缀保持不变，可命中上游的前缀缓存
+    - 每条消息的 {'role', 'content'} 字典在追加时创建一次，与消息一同淘汰；
+      api_messages() / window() 只重新组装列表，不再逐轮为整个窗口新建字典
+    - 每条消息的token估算值在追加时计算一次，供 window() 按token预算裁剪上下文，
+      裁剪的起点同样按 trim_step 成块移动
+    - summary: 较早消息压缩成的滚动摘要，紧跟在系统提示之后发送
+    - generation: 每次清空时加一，后台压缩据此判断历史是否已被重置
+    """
+
+    __slots__ = (
+        'system', '_system_api', '_system_tokens',
+        'summary', '_summary_api', '_summary_tokens', 'generation',
+        '_messages', '_token_counts', '_api_dicts', '_api_view',
+        '_capacity', '_trim_step', '_window_skip'
+    )
+
+    def __init__(self, capacity: int, trim_step: int = 1):
+        self.system: Optional[Message] = None
+        self._system_api: Optional[Dict[str, str]] = None
+        self._system_tokens = 0
+        self.summary: Optional[Message] = None
+        self._summary_api: Optional[Dict[str, str]] = None
+        self._summary_tokens = 0
+        self.generation = 0
+        self._capacity = capacity
+        self._trim_step = max(trim_step, 1)
+        # 逐条滑动时由deque自动淘汰；成块丢弃时在 append 中处理
+        maxlen = capacity if self._trim_step == 1 else None
+        self._messages: deque = deque(maxlen=maxlen)
+        self._token_counts: deque = deque(maxlen=maxlen)
+        self._api_dicts: deque = deque(maxlen=maxlen)
+        self._api_view: Optional[List[Dict[str, str]]] = None
+        # window() 按token预算跳过的最早若干条消息
+        self._window_skip = 0
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def trim_step(self) -> int:
+        return self._trim_step
+
+    @property
+    def recent_count(self) -> int:
+        """尚未压缩进摘要的消息数（不含系统提示和摘要）"""
+        return len(self._messages)
+
+    def append(self, message: Message):
+        """追加消息；系统消息替换常驻的系统提示"""
+        api_message = {'role': message.role, 'content': message.content}
+        tokens = estimate_message_tokens(api_message)
+        if message.role == 'system':
+            self.system = message
+            self._system_api = api_message
+            self._system_tokens = tokens
+        else:
+            self._messages.append(message)
+            self._token_counts.append(tokens)
+            self._api_dicts.append(api_message)
+            if len(self._messages) > self._capacity:
+                self._drop_oldest(min(self._trim_step, len(self._messages)))
+        self._api_view = None
+
+    def _drop_oldest(self, count: int):
+        for _ in range(count):
+            self._messages.popleft()
+            self._token_counts.popleft()
+            self._api_dicts.popleft()
+        self._window_skip = max(self._window_skip - count, 0)
+
+    def set_summary(self, message: Optional[Message]):
+        """设置（或清除）滚动摘要，以系统消息的形式发送"""
+        self.summary = message
+        self._summary_api = {'role': 'system', 'content': message.content} if message else None
+        self._summary_tokens = estimate_message_tokens(self._summary_api) if message else 0
+        self._api_view = None
+
+    def oldest(self, n: int) -> List[Message]:
+        """最早的n条消息"""
+        return list(islice(self._messages, n))
+
+    def compact(self, folded: List[Message], summary: Message) -> int:
+        """用摘要替换已折叠的消息，返回实际移除的条数
+
+        folded 是调度压缩时取出的 oldest()；压缩期间追加的消息不受影响，
+        其中已被环形缓冲区淘汰的消息也无需再移除。
+        """
+        folded_ids = {id(message) for message in folded}
+        removed = 0
+        while removed < len(self._messages) and id(self._messages[removed]) in folded_ids:
+            removed += 1
+        self._drop_oldest(removed)
+        self.set_summary(summary)
+        return removed
+
+    def clear(self, keep_system: bool = True):
+        """清空对话消息和摘要，默认保留系统提示"""
+        self._messages.clear()
+        self._token_counts.clear()
+        self._api_dicts.clear()
+        self._window_skip = 0
+        self.summary = None
+        self._summary_api = None
+        self._summary_tokens = 0
+        self.generation += 1
+        if not keep_system:
+            self.system = None
+            self._system_api = None
+            self._system_tokens = 0
+        self._api_view = None
+
+    def _prefix(self) -> List[Dict[str, str]]:
+        """每次都会发送的前缀：系统提示和摘要"""
+        prefix = [self._system_api] if self._system_api is not None else []
+        if self._summary_api is not None:
+            prefix.append(self._summary_api)
+        return prefix
+
+    def tail(self, n: int) -> List[Message]:
+        """返回最后n条消息（含系统提示和摘要）"""
+        if n <= 0:
+            return []
+        if n <= len(self._messages):
+            return [self._messages[i] for i in range(-n, 0)]
+        return list(self)[-n:]
+
+    def api_messages(self) -> List[Dict[str, str]]:
+        """OpenAI API格式的消息列表（共享缓存，调用方不应修改）"""
+        if self._api_view is None:
+            view = self._prefix()
+            view.extend(self._api_dicts)
+            self._api_view = view
+        return self._api_view
+
+    def window(self, max_tokens: int) -> Tuple[List[Dict[str, str]], int]:
+        """按token预算选取上下文：系统提示 + 摘要 + 能放下的最新若干条消息
+
+        最新一条消息总会被保留，即使它本身已超出预算。
+        trim_step 大于1时起点只在超出预算时向后跳 trim_step 条，其余轮次只在末尾追加。
+        返回 (OpenAI格式消息列表, 估算的token总数)。
+        """
+        used = self._system_tokens + self._summary_tokens
+        if self._trim_step > 1:
+            count, tokens = self._stable_window(max_tokens - used)
+            used += tokens
+        else:
+            count = 0
+            for tokens in reversed(self._token_counts):
+                if count and used + tokens > max_tokens:
+                    break
+                used += tokens
+                count += 1
+
+        if count == len(self._messages):
+            return self.api_messages(), used
+
+        view = self._prefix()
+        view.extend(islice(self._api_dicts, len(self._api_dicts) - count, None))
+        return view, used
+
+    def _stable_window(self, budget: int) -> Tuple[int, int]:
+        """成块移动窗口起点，返回 (窗口内的消息数, 其token数)"""
+        total = len(self._messages)
+        skip = self._window_skip
+        tokens = sum(islice(self._token_counts, skip, None))
+        while tokens > budget and total - skip > 1:
+            step = min(self._trim_step, total - skip - 1)
+            tokens -= sum(islice(self._token_counts, skip, skip + step))
+            skip += step
+        self._window_skip = skip
+        return total - skip, tokens
+
+    def __len__(self) -> int:
+        return len(self._messages) + (self.system is not None) + (self.summary is not None)
+
+    def __iter__(self) -> Iterator[Message]:
+        if self.system is not None:
+            yield self.system
+        if self.summary is not None:
+            yield self.summary
+        yield from self._messages
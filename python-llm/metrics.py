@@ -0,0 +1,285 @@
+"""
+运行指标
+进程内的计数器、仪表和直方图，以Prometheus文本格式输出（/api/metrics）。
+所有耗时都用 time.perf_counter() 计算；记录一次观测只需一次加锁和一次二分查找。
+多worker模式下每个worker各自统计，由分发器按worker编号分别抓取。
+"""
+
+import bisect
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# 请求耗时（秒）的默认分桶，覆盖从本地路由到长回复的范围
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    """带标签的指标基类，每组标签值对应一个序列"""
+
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series: Dict[LabelValues, object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}'
+        ]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            series = sorted(self._series.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in series]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；也可以提供回调，在输出时读取实时值"""
+
+    type_name = 'gauge'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def _samples(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                series = sorted(self.callback().items())
+            except Exception:
+                # 回调失败（如数据库暂时被锁）时本次不输出该指标的值
+                series = []
+        else:
+            with self._lock:
+                series = sorted(self._series.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}' for key, value in series]
+
+
+class Histogram(_Metric):
+    """累积分桶直方图，附带 _sum 和 _count"""
+
+    type_name = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [各桶计数..., +Inf桶计数, 总和]
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        lines = []
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(values[-1])}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """按注册顺序输出全部指标"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        callback: Optional[Callable[[], Dict[LabelValues, float]]] = None
+    ) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheus文本格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 接口层
+HTTP_REQUESTS = REGISTRY.counter(
+    'chat_http_requests_total', 'HTTP requests by route, method and status', ('route', 'method', 'status'))
+HTTP_LATENCY = REGISTRY.histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency (until the response body is fully sent)',
+    ('route', 'method'))
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    'chat_http_requests_in_flight', 'HTTP requests currently being handled', ('route',))
+
+# 对话链条
+CHAT_LATENCY = REGISTRY.histogram(
+    'chat_turn_duration_seconds', 'Chat turn latency by prompt type, mode and outcome',
+    ('prompt_type', 'mode', 'outcome'))
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    'chat_time_to_first_token_seconds', 'Time to the first streamed token', ('prompt_type',))
+COMPACTIONS = REGISTRY.counter(
+    'chat_compactions_total', 'Background history compactions by outcome', ('outcome',))
+
+# 上游
+UPSTREAM_LATENCY = REGISTRY.histogram(
+    'llm_upstream_duration_seconds', 'Upstream completion latency per backend attempt (including retries)',
+    ('backend', 'outcome'))
+UPSTREAM_TOKENS = REGISTRY.counter(
+    'llm_tokens_total', 'Tokens reported in the upstream usage field', ('model', 'kind'))
+
+
+def request_started(route: str) -> float:
+    """请求开始：在途数加一，返回起始时间"""
+    HTTP_IN_FLIGHT.inc(route=route)
+    return time.perf_counter()
+
+
+def request_finished(route: str, method: str, status: int, start: float) -> None:
+    """请求结束：记录耗时和状态码，在途数减一"""
+    HTTP_LATENCY.observe(time.perf_counter() - start, route=route, method=method)
+    HTTP_REQUESTS.inc(route=route, method=method, status=str(status))
+    HTTP_IN_FLIGHT.dec(route=route)
+
+
+def _field(obj, name: str):
+    # 较旧的SDK未声明的字段（如流式分块的 usage）保留为普通字典
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def usage_tokens(usage, name: str) -> int:
+    """usage 中的token数，缺失时为0"""
+    return int(_field(usage, name) or 0)
+
+
+def cached_prompt_tokens(usage) -> int:
+    """命中上游前缀缓存的提示词token数
+
+    DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 兼容接口返回 prompt_tokens_details.cached_tokens。
+    """
+    hit = _field(usage, 'prompt_cache_hit_tokens')
+    if hit is None:
+        hit = _field(_field(usage, 'prompt_tokens_details') or {}, 'cached_tokens')
+    return int(hit or 0)
+
+
+def record_usage(model: str, usage) -> None:
+    """累计响应 usage 字段中的提示词、命中前缀缓存的提示词和生成token数"""
+    if usage is None:
+        return
+    prompt_tokens = usage_tokens(usage, 'prompt_tokens')
+    completion_tokens = usage_tokens(usage, 'completion_tokens')
+    cache_hit_tokens = cached_prompt_tokens(usage)
+    if prompt_tokens:
+        UPSTREAM_TOKENS.inc(prompt_tokens, model=model, kind='prompt')
+    if cache_hit_tokens:
+        UPSTREAM_TOKENS.inc(cache_hit_tokens, model=model, kind='prompt_cache_hit')
+    if completion_tokens:
+        UPSTREAM_TOKENS.inc(completion_tokens, model=model, kind='completion')
@@ -0,0 +1,292 @@
+"""
+本地模拟的OpenAI兼容上游
+用于压测和基准测试，不消耗API额度：
+- POST /v1/chat/completions，支持 stream=true（SSE分块）和 usage 字段
+- 首字延迟按可配置的分布抽样，之后按 tokens/s 速率生成内容
+- 可按比例注入错误（429带Retry-After、5xx）
+- 固定 --seed 时同样的请求序列得到同样的延迟和错误
+- --echo 时回复以最后一条用户消息开头，便于校验回复与请求的对应关系
+- 模拟DeepSeek的前缀缓存：以消息为粒度记录见过的前缀，usage 中返回 prompt_cache_hit_tokens
+
+启动方式: python mock_deepseek_server.py --port 8900 --latency lognormal:0.4,0.5 --tokens-per-second 60
+服务端指向它: SILICON_FLOW_API_URL=http://127.0.0.1:8900/v1 SILICON_FLOW_API_KEY=mock python chat_api.py
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Any, List
+
+from token_counter import estimate_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# 模拟回复使用的词表，每个词约计一个token
+_VOCABULARY = ['第一天', '上午', '参观', '故宫', '下午', '前往', '颐和园', '晚上', '品尝', '烤鸭',
+               '建议', '提前', '预约', '门票', '交通', '地铁', '预算', '住宿', '推荐', '行程']
+
+
+def parse_distribution(spec: str) -> Callable[[random.Random], float]:
+    """解析延迟分布（秒）：fixed:0.2 / uniform:0.1,0.5 / lognormal:中位数,sigma / exp:均值"""
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',') if value]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'lognormal' and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    if kind == 'exp' and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"无法解析的延迟分布: {spec}")
+
+
+class MockConfig:
+    """模拟上游的行为参数"""
+
+    def __init__(
+        self,
+        latency: str = 'fixed:0.2',
+        tokens_per_second: float = 50.0,
+        completion_tokens: str = '50,200',
+        error_rate: float = 0.0,
+        error_statuses: str = '500',
+        retry_after: float = 1.0,
+        seed: int = 0,
+        echo: bool = False
+    ):
+        self.latency_spec = latency
+        self.first_token_delay = parse_distribution(latency)
+        self.tokens_per_second = tokens_per_second
+        low, _, high = completion_tokens.partition(',')
+        self.completion_tokens = (int(low), int(high or low))
+        self.error_rate = error_rate
+        self.error_statuses = [int(status) for status in error_statuses.split(',')]
+        self.retry_after = retry_after
+        self.echo = echo
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        # 见过的消息前缀（摘要 -> None），超出上限时淘汰最久未用的
+        self._prefixes: "OrderedDict[str, None]" = OrderedDict()
+        self.max_prefixes = 100000
+        self.prompt_tokens = 0
+        self.cache_hit_tokens = 0
+
+    def prompt_cache(self, messages: List[Dict[str, Any]]) -> Dict[str, int]:
+        """按消息边界计算命中缓存的最长前缀，并记录本次请求的所有前缀"""
+        digest = hashlib.sha256()
+        total = hit = 0
+        matched = True
+        with self._lock:
+            for message in messages:
+                digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+                key = digest.hexdigest()
+                tokens = estimate_message_tokens(message)
+                total += tokens
+                if matched and key in self._prefixes:
+                    hit += tokens
+                    self._prefixes.move_to_end(key)
+                else:
+                    matched = False
+                    self._prefixes[key] = None
+            while len(self._prefixes) > self.max_prefixes:
+                self._prefixes.popitem(last=False)
+            self.prompt_tokens += total
+            self.cache_hit_tokens += hit
+        return {'prompt_tokens': total, 'prompt_cache_hit_tokens': hit, 'prompt_cache_miss_tokens': total - hit}
+
+    def plan(self, max_tokens: int) -> Dict[str, Any]:
+        """为一次请求抽样：首字延迟、回复长度、是否注入错误"""
+        with self._lock:
+            self.requests += 1
+            rng = self._rng
+            plan = {
+                'delay': max(self.first_token_delay(rng), 0.0),
+                'tokens': min(rng.randint(*self.completion_tokens), max_tokens),
+                'error': rng.choice(self.error_statuses) if rng.random() < self.error_rate else None,
+                'offset': rng.randrange(len(_VOCABULARY))
+            }
+            if plan['error']:
+                self.errors += 1
+            return plan
+
+
+def _completion_text(tokens: int, offset: int) -> List[str]:
+    return [_VOCABULARY[(offset + i) % len(_VOCABULARY)] for i in range(tokens)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """OpenAI Chat Completions 接口的最小实现"""
+
+    protocol_version = 'HTTP/1.1'
+    # 响应头和正文分两次写出，不关闭Nagle时keep-alive连接上每个响应会多等一个延迟确认（约40ms）
+    disable_nagle_algorithm = True
+    config: MockConfig = None
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            return self._send_json(200, {'object': 'list', 'data': [{'id': 'mock', 'object': 'model'}]})
+        if self.path == '/stats':
+            return self._send_json(200, {
+                'requests': self.config.requests,
+                'errors': self.config.errors,
+                'prompt_tokens': self.config.prompt_tokens,
+                'prompt_cache_hit_tokens': self.config.cache_hit_tokens,
+                'latency': self.config.latency_spec,
+                'tokens_per_second': self.config.tokens_per_second
+            })
+        self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._send_json(400, {'error': {'message': 'invalid json', 'type': 'invalid_request_error'}})
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': 'not found'}})
+
+        messages = body.get('messages') or []
+        plan = self.config.plan(int(body.get('max_tokens') or 4096))
+        time.sleep(plan['delay'])
+
+        if plan['error']:
+            headers = {'Retry-After': str(self.config.retry_after)} if plan['error'] == 429 else {}
+            return self._send_json(plan['error'], {
+                'error': {'message': f"mock error {plan['error']}", 'type': 'mock_error'}
+            }, headers)
+
+        usage = {**self.config.prompt_cache(messages), 'completion_tokens': plan['tokens']}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        words = _completion_text(plan['tokens'], plan['offset'])
+        if self.config.echo:
+            last_user = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '')
+            words.insert(0, f"{last_user}｜")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get('model', 'mock')
+
+        if body.get('stream'):
+            include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+            return self._send_stream(completion_id, model, words, usage if include_usage else None)
+
+        # 非流式：按生成速率等待全部内容生成完毕
+        time.sleep(plan['tokens'] / self.config.tokens_per_second)
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': ''.join(words)},
+                'finish_reason': 'stop'
+            }],
+            'usage': usage
+        })
+
+    def _send_stream(self, completion_id: str, model: str, words: List[str], usage: Dict[str, int]):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta: Dict[str, Any], finish_reason=None, **extra) -> bytes:
+            payload = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}] if delta is not None else [],
+                **extra
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8')
+
+        interval = 1 / self.config.tokens_per_second
+        try:
+            self.wfile.write(chunk({'role': 'assistant', 'content': ''}))
+            for word in words:
+                self.wfile.write(chunk({'content': word}))
+                self.wfile.flush()
+                time.sleep(interval)
+            self.wfile.write(chunk({}, 'stop'))
+            if usage is not None:
+                self.wfile.write(chunk(None, usage=usage))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端中断流式请求
+            pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Dict[str, str] = None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def create_server(host: str, port: int, config: MockConfig) -> ThreadingHTTPServer:
+    handler = type('ConfiguredMockHandler', (MockHandler,), {'config': config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的OpenAI兼容上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', default='fixed:0.2',
+                        help='首字延迟分布（秒）: fixed:0.2 / uniform:0.1,0.5 / lognormal:0.3,0.5 / exp:0.2')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help='生成速率')
+    parser.add_argument('--completion-tokens', default='50,200', help='回复长度范围（token）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='注入错误的比例')
+    parser.add_argument('--error-statuses', default='500', help='注入的错误状态码，逗号分隔，如 429,500,503')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='429 响应的 Retry-After 秒数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--echo', action='store_true', help='回复以最后一条用户消息开头')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    config = MockConfig(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        error_statuses=args.error_statuses,
+        retry_after=args.retry_after,
+        seed=args.seed,
+        echo=args.echo
+    )
+    server = create_server(args.host, args.port, config)
+    print(f"🧪 模拟上游监听 http://{args.host}:{args.port}/v1 （首字延迟 {args.latency}，"
+          f"{args.tokens_per_second:g} tokens/s，错误率 {args.error_rate:g}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+"""
+系统提示模板库
+内置 default / travel / writing / code 四个模板，PROMPT_TEMPLATE_DIR 目录（默认为本目录下的 prompts/）
+中的 <名称>.json 可以新增或覆盖模板，修改后无需重启：访问模板库时最多每隔 PROMPT_RELOAD_INTERVAL 秒
+检查一次文件的修改时间，只重新编译有变化的文件；编译失败时保留原来的版本并记录错误。
+
+模板文件格式：
+{
+  "version": 2,
+  "description": "按目的地、天数和预算制定逐日行程",
+  "variables": {"destination": null, "budget": null, "language": "中文"},
+  "template": ["你是一个专业的旅行规划师。", "[[用户计划前往{destination}。]]请用{language}回答。"]
+}
+- template 为字符串或按行拼接的字符串列表，{变量} 在创建会话时替换，{{ 和 }} 表示花括号本身
+- variables 声明可用的变量及默认值，null 表示没有默认值
+- [[...]] 为可选片段，其中引用的变量都有值时才输出；可选片段以外没有默认值的变量必须提供
+
+模板在加载时编译为文本与变量的片段列表，同一组变量的渲染结果会被缓存；
+统计按 名称@v版本 分别记录，便于比较同一模板的不同版本。
+"""
+
+import json
+import logging
+import os
+import re
+import string
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional, List, Dict, Any, Tuple, Union
+
+from metrics import cached_prompt_tokens, usage_tokens
+
+logger = logging.getLogger(__name__)
+
+BUILTIN_TEMPLATES = {
+    'default': "你是DeepSeek V3智能助手，一个友好、专业且乐于助人的AI。请用中文回答问题。",
+    'travel': "你是一个专业的旅行规划师，擅长制定详细的旅行计划、推荐景点和提供旅行建议。",
+    'writing': "你是一个专业的写作助手，擅长协助用户进行各种类型的写作，包括文章、报告、创意写作等。",
+    'code': "你是一个编程专家，擅长多种编程语言，能够帮助用户解决编程问题、编写代码、解释算法等。"
+}
+TEMPLATE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+_OPTIONAL_RE = re.compile(r'\[\[(.*?)\]\]', re.S)
+# 单个变量值的最大长度
+MAX_VARIABLE_LENGTH = 200
+
+# 编译后的片段：str 为原样输出的文本，('var', 名称) 为变量，('optional', 片段列表, 变量名) 为可选片段
+Segment = Union[str, Tuple]
+
+
+def _compile_text(text: str, declared: Dict[str, Any]) -> Tuple[List[Segment], Tuple[str, ...]]:
+    segments: List[Segment] = []
+    names = []
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+        if literal:
+            segments.append(literal)
+        if field is None:
+            continue
+        if spec or conversion or not field.isidentifier():
+            raise ValueError(f"变量只支持 {{名称}} 形式: {{{field}}}")
+        if field not in declared:
+            raise ValueError(f"变量 {field} 未在 variables 中声明")
+        segments.append(('var', field))
+        names.append(field)
+    return segments, tuple(names)
+
+
+class PromptTemplate:
+    """编译后的模板"""
+
+    __slots__ = ('name', 'version', 'description', 'defaults', 'segments', 'required', 'source', 'path')
+
+    def __init__(
+        self,
+        name: str,
+        template: str,
+        version: int = 1,
+        description: str = '',
+        variables: Optional[Dict[str, Any]] = None,
+        path: Optional[str] = None
+    ):
+        self.name = name
+        self.version = version
+        self.description = description
+        self.defaults = {key: None if value is None else str(value) for key, value in (variables or {}).items()}
+        self.source = template
+        self.path = path
+        self.segments: List[Segment] = []
+        required = set()
+        position = 0
+        for match in _OPTIONAL_RE.finditer(template):
+            segments, names = _compile_text(template[position:match.start()], self.defaults)
+            self.segments.extend(segments)
+            required.update(names)
+            segments, names = _compile_text(match.group(1), self.defaults)
+            self.segments.append(('optional', segments, names))
+            position = match.end()
+        segments, names = _compile_text(template[position:], self.defaults)
+        self.segments.extend(segments)
+        required.update(names)
+        # 可选片段以外引用、且没有默认值的变量
+        self.required = tuple(sorted(name for name in required if self.defaults[name] is None))
+
+    @classmethod
+    def from_file(cls, path: str) -> 'PromptTemplate':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        template = data['template']
+        if isinstance(template, list):
+            template = '\n'.join(template)
+        version = data.get('version', 1)
+        if not isinstance(version, int) or isinstance(version, bool):
+            raise ValueError(f"version 必须是整数: {version!r}")
+        return cls(
+            os.path.splitext(os.path.basename(path))[0],
+            template,
+            version=version,
+            description=data.get('description', ''),
+            variables=data.get('variables'),
+            path=path
+        )
+
+    def resolve(self, variables: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+        """合并默认值，返回本模板声明的变量的取值（未声明的变量忽略）"""
+        values = {}
+        for name, default in self.defaults.items():
+            value = (variables or {}).get(name)
+            value = default if value is None or str(value).strip() == '' else str(value).strip()
+            if value is not None:
+                if len(value) > MAX_VARIABLE_LENGTH:
+                    raise ValueError(f"变量 {name} 超过 {MAX_VARIABLE_LENGTH} 个字符")
+                values[name] = value
+        missing = [name for name in self.required if name not in values]
+        if missing:
+            raise ValueError(f"模板 {self.name} 缺少变量: {', '.join(missing)}")
+        return values
+
+    def render(self, values: Dict[str, str]) -> str:
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, str):
+                parts.append(segment)
+            elif segment[0] == 'var':
+                parts.append(values[segment[1]])
+            elif all(name in values for name in segment[2]):
+                parts.extend(part if isinstance(part, str) else values[part[1]] for part in segment[1])
+        return ''.join(parts)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'version': self.version,
+            'description': self.description,
+            'variables': dict(self.defaults),
+            'required': list(self.required),
+            'source': 'file' if self.path else 'builtin'
+        }
+
+
+class _TemplateStats:
+    """一个模板版本的使用情况，耗时保留最近 LATENCY_SAMPLES 轮用于计算分位数"""
+
+    LATENCY_SAMPLES = 1000
+
+    __slots__ = ('sessions', 'turns', 'errors', 'latency_sum', 'latencies',
+                 'prompt_tokens', 'prompt_cache_hit_tokens', 'completion_tokens')
+
+    def __init__(self):
+        self.sessions = 0
+        self.turns = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.prompt_tokens = 0
+        self.prompt_cache_hit_tokens = 0
+        self.completion_tokens = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+
+        def percentile(q: float) -> Optional[float]:
+            return round(latencies[min(int(len(latencies) * q), len(latencies) - 1)], 4) if latencies else None
+
+        completed = self.turns - self.errors
+        return {
+            'sessions': self.sessions,
+            'turns': self.turns,
+            'errors': self.errors,
+            'latency': {
+                'avg': round(self.latency_sum / self.turns, 4) if self.turns else None,
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'max': round(latencies[-1], 4) if latencies else None
+            },
+            'tokens': {
+                'prompt': self.prompt_tokens,
+                'prompt_cache_hit': self.prompt_cache_hit_tokens,
+                'completion': self.completion_tokens,
+                'completion_per_turn': round(self.completion_tokens / completed, 1) if completed > 0 else None
+            }
+        }
+
+
+class PromptRegistry:
+    """线程安全的模板库"""
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        reload_interval: Optional[float] = None,
+        render_cache_size: int = 1024
+    ):
+        self.directory = directory if directory is not None else os.environ.get(
+            'PROMPT_TEMPLATE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts')
+        )
+        # 检查模板文件变化的最小间隔（秒），0 表示只在启动时加载
+        self.reload_interval = reload_interval if reload_interval is not None \
+            else float(os.environ.get('PROMPT_RELOAD_INTERVAL', 2))
+        self.render_cache_size = render_cache_size
+
+        self._lock = threading.Lock()
+        self._builtin = {name: PromptTemplate(name, text) for name, text in BUILTIN_TEMPLATES.items()}
+        self._files: Dict[str, PromptTemplate] = {}
+        # 文件名 -> (修改时间, 大小)，包括编译失败的文件，内容不变时不再重试
+        self._snapshot: Dict[str, Tuple[int, int]] = {}
+        self._errors: Dict[str, str] = {}
+        self._next_check = 0.0
+        self._rendered: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._stats: Dict[Tuple[str, int], _TemplateStats] = {}
+        self.reloads = 0
+        self.render_hits = 0
+        self.render_misses = 0
+        self._refresh(force=True)
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return {}
+        snapshot = {}
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _refresh(self, force: bool = False):
+        """模板文件有变化时重新编译（调用方不持有锁）"""
+        now = time.monotonic()
+        if not force and (self.reload_interval <= 0 or now < self._next_check):
+            return
+        with self._lock:
+            if not force and now < self._next_check:
+                return
+            self._next_check = now + self.reload_interval if self.reload_interval > 0 else float('inf')
+            snapshot = self._scan()
+            if snapshot == self._snapshot:
+                return
+            files = {
+                name: template for name, template in self._files.items()
+                if template.path and os.path.basename(template.path) in snapshot
+            }
+            for filename, signature in snapshot.items():
+                if self._snapshot.get(filename) == signature:
+                    continue
+                name = os.path.splitext(filename)[0]
+                if not TEMPLATE_NAME_PATTERN.match(name):
+                    self._errors[filename] = '文件名只能包含字母、数字、下划线和连字符'
+                    continue
+                try:
+                    files[name] = PromptTemplate.from_file(os.path.join(self.directory, filename))
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    # 保留之前成功加载的版本
+                    self._errors[filename] = str(e)
+                    logger.error(f"提示模板 {filename} 加载失败，继续使用原来的版本: {str(e)}")
+                    continue
+                self._errors.pop(filename, None)
+                logger.info(f"已加载提示模板 {name} v{files[name].version}")
+            for filename in set(self._errors) - set(snapshot):
+                del self._errors[filename]
+            self._files = files
+            self._snapshot = snapshot
+            self._rendered.clear()
+            self.reloads += 1
+
+    def get(self, name: str) -> PromptTemplate:
+        """按名称获取模板，不存在时抛出 KeyError"""
+        self._refresh()
+        template = self._files.get(name) or self._builtin.get(name)
+        if template is None:
+            raise KeyError(name)
+        return template
+
+    def names(self) -> List[str]:
+        self._refresh()
+        return sorted(set(self._builtin) | set(self._files))
+
+    def render(self, name: str, variables: Optional[Dict[str, Any]] = None) -> Tuple[PromptTemplate, Dict[str, str], str]:
+        """渲染模板，返回 (模板, 实际使用的变量, 系统提示)；模板不存在或缺少变量时抛出 ValueError"""
+        try:
+            template = self.get(name)
+        except KeyError:
+            raise ValueError(f"未知的系统提示类型: {name}（可用: {', '.join(self.names())}）") from None
+        values = template.resolve(variables)
+        # 重新加载后即使版本号未变，新模板对象也不会命中旧的渲染结果
+        key = (template.name, template.version, id(template), tuple(sorted(values.items())))
+        with self._lock:
+            content = self._rendered.get(key)
+            if content is not None:
+                self._rendered.move_to_end(key)
+                self.render_hits += 1
+                return template, values, content
+        content = template.render(values)
+        with self._lock:
+            self.render_misses += 1
+            self._rendered[key] = content
+            while len(self._rendered) > self.render_cache_size:
+                self._rendered.popitem(last=False)
+        return template, values, content
+
+    def _template_stats(self, name: str, version: Optional[int]) -> _TemplateStats:
+        """调用方需持有锁"""
+        key = (name, version or 1)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = _TemplateStats()
+        return stats
+
+    def record_session(self, name: str, version: Optional[int]):
+        with self._lock:
+            self._template_stats(name, version).sessions += 1
+
+    def record_turn(self, name: str, version: Optional[int], latency: float, ok: bool):
+        with self._lock:
+            stats = self._template_stats(name, version)
+            stats.turns += 1
+            stats.latency_sum += latency
+            stats.latencies.append(latency)
+            if not ok:
+                stats.errors += 1
+
+    def record_usage(self, name: str, version: Optional[int], usage):
+        if usage is None:
+            return
+        with self._lock:
+            stats = self._template_stats(name, version)
+            stats.prompt_tokens += usage_tokens(usage, 'prompt_tokens')
+            stats.prompt_cache_hit_tokens += cached_prompt_tokens(usage)
+            stats.completion_tokens += usage_tokens(usage, 'completion_tokens')
+
+    def describe(self) -> List[Dict[str, Any]]:
+        """所有可用模板及其各版本的统计"""
+        self._refresh()
+        with self._lock:
+            templates = {**self._builtin, **self._files}
+            stats: Dict[str, Dict[str, Any]] = {}
+            for (name, version), item in self._stats.items():
+                stats.setdefault(name, {})[f"v{version}"] = item.snapshot()
+        return [
+            {**template.describe(), 'stats': stats.get(name, {})}
+            for name, template in sorted(templates.items())
+        ]
+
+    def get_stats(self) -> Dict[str, Any]:
+        self._refresh()
+        with self._lock:
+            return {
+                'directory': self.directory,
+                'templates': len(set(self._builtin) | set(self._files)),
+                'file_templates': len(self._files),
+                'reloads': self.reloads,
+                'errors': dict(self._errors),
+                'render_cache': {
+                    'entries': len(self._rendered),
+                    'hits': self.render_hits,
+                    'misses': self.render_misses
+                }
+            }
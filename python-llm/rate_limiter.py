@@ -0,0 +1,241 @@
+"""
+上游配额调度
+SiliconFlow 按每分钟请求数（RPM）和每分钟token数（TPM）限流。
+调用前同时从两个令牌桶中申请配额：RPM 每次请求计1，TPM 按提示词估算值加 max_tokens 预扣，
+响应返回实际用量后退还多扣的部分。配额不足的请求按优先级排队，等待超时后快速失败。
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Optional, List, Dict, Any, Tuple
+
+from llm_errors import QuotaExceededError
+from token_counter import estimate_message_tokens
+
+# 数值越小越优先
+PRIORITIES = {
+    'interactive': 0,
+    'default': 1,
+    'batch': 2
+}
+
+
+class TokenBucket:
+    """每分钟补满 per_minute 个令牌的令牌桶"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """还需等待多少秒才能取出 amount 个令牌"""
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= amount
+
+    def give(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class QuotaScheduler:
+    """RPM/TPM双令牌桶调度器，线程和协程都可使用
+
+    排队的请求按 (优先级, 到达顺序) 排序，只有队首能取令牌：
+    高优先级请求排在低优先级之前，同优先级先到先得，大请求不会被后来的小请求一直插队。
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_wait: Optional[float] = None,
+        headroom: Optional[float] = None
+    ):
+        rpm = rpm if rpm is not None else int(os.environ.get('LLM_RPM_LIMIT', 0))
+        tpm = tpm if tpm is not None else int(os.environ.get('LLM_TPM_LIMIT', 0))
+        # 只使用配额的一部分，给估算误差和其他客户端留出余量
+        headroom = headroom if headroom is not None else float(os.environ.get('LLM_QUOTA_HEADROOM', 0.95))
+        self.max_wait = max_wait if max_wait is not None else float(os.environ.get('LLM_QUOTA_MAX_WAIT', 30))
+
+        self.rpm_limit = rpm
+        self.tpm_limit = tpm
+        self._rpm = TokenBucket(rpm * headroom) if rpm > 0 else None
+        self._tpm = TokenBucket(tpm * headroom) if tpm > 0 else None
+        self.enabled = self._rpm is not None or self._tpm is not None
+
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[int, int]] = []
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.tokens_refunded = 0
+
+    def estimate_cost(self, messages: List[Dict[str, str]], max_tokens: int) -> int:
+        """本次请求预扣的token数：提示词估算值 + 最大输出"""
+        cost = sum(estimate_message_tokens(message) for message in messages) + max_tokens
+        if self._tpm is not None:
+            # 超过桶容量的请求永远无法放行，按桶容量计
+            cost = min(cost, int(self._tpm.capacity))
+        return cost
+
+    def _try_admit(self, ticket: Tuple[int, int], cost: int) -> Optional[float]:
+        """队首请求配额足够时放行并返回0，否则返回需等待的秒数（非队首返回None，调用方需持有锁）"""
+        if self._queue[0] != ticket:
+            return None
+        now = time.monotonic()
+        wait = 0.0
+        if self._rpm is not None:
+            wait = max(wait, self._rpm.wait_time(1, now))
+        if self._tpm is not None:
+            wait = max(wait, self._tpm.wait_time(cost, now))
+        if wait > 0:
+            return wait
+        if self._rpm is not None:
+            self._rpm.take(1)
+        if self._tpm is not None:
+            self._tpm.take(cost)
+        heapq.heappop(self._queue)
+        self._cond.notify_all()
+        return 0.0
+
+    def _enqueue(self, priority: str) -> Tuple[int, int]:
+        ticket = (PRIORITIES.get(priority, PRIORITIES['default']), next(self._seq))
+        heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _dequeue(self, ticket: Tuple[int, int]):
+        """放弃排队（超时或被取消，调用方需持有锁）"""
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            self._cond.notify_all()
+
+    def _reject(self, ticket: Tuple[int, int], wait: Optional[float]) -> QuotaExceededError:
+        self._dequeue(ticket)
+        self.rejected += 1
+        return QuotaExceededError(
+            f"API调用失败: 上游配额已用尽，排队超过{self.max_wait:.0f}秒",
+            retry_after=wait if wait else 1.0
+        )
+
+    def acquire(self, cost: int, priority: str = 'interactive', timeout: Optional[float] = None) -> int:
+        """阻塞直到获得配额，返回实际预扣的token数"""
+        if not self.enabled:
+            return 0
+        start = time.monotonic()
+        deadline = start + (timeout if timeout is not None else self.max_wait)
+        with self._cond:
+            ticket = self._enqueue(priority)
+            try:
+                while True:
+                    wait = self._try_admit(ticket, cost)
+                    if wait == 0:
+                        self.admitted += 1
+                        self.total_wait += time.monotonic() - start
+                        return cost
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        raise self._reject(ticket, wait)
+                    self._cond.wait(remaining if wait is None else wait)
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+
+    async def aacquire(self, cost: int, priority: str = 'interactive', timeout: Optional[float] = None) -> int:
+        """acquire 的异步版本，等待期间不阻塞事件循环"""
+        if not self.enabled:
+            return 0
+        start = time.monotonic()
+        deadline = start + (timeout if timeout is not None else self.max_wait)
+        with self._cond:
+            ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(ticket, cost)
+                    if wait == 0:
+                        self.admitted += 1
+                        self.total_wait += time.monotonic() - start
+                        return cost
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        raise self._reject(ticket, wait)
+                # 非队首时无法预知何时轮到，短间隔轮询
+                await asyncio.sleep(0.02 if wait is None else wait)
+        except BaseException:
+            with self._cond:
+                self._dequeue(ticket)
+            raise
+
+    def settle(self, reserved: int, usage: Any):
+        """按响应中的实际用量退还多预扣的token"""
+        if self._tpm is None or not reserved or usage is None:
+            return
+        # 流式响应最后一个分块中的 usage 可能是未解析的dict
+        used = usage.get('total_tokens') if isinstance(usage, dict) else getattr(usage, 'total_tokens', None)
+        if used is None or used >= reserved:
+            return
+        with self._cond:
+            self._tpm.give(reserved - used)
+            self.tokens_refunded += reserved - used
+            self._cond.notify_all()
+
+    def refund(self, reserved: int):
+        """请求失败时退还全部预扣的token；RPM不退还，请求可能已经发出"""
+        if self._tpm is None or not reserved:
+            return
+        with self._cond:
+            self._tpm.give(reserved)
+            self.tokens_refunded += reserved
+            self._cond.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            stats = {
+                'enabled': self.enabled,
+                'rpm_limit': self.rpm_limit,
+                'tpm_limit': self.tpm_limit,
+                'max_wait': self.max_wait,
+                'queued': len(self._queue),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'avg_wait': round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+                'tokens_refunded': self.tokens_refunded
+            }
+            if self._rpm is not None:
+                self._rpm.wait_time(0, now)
+                stats['rpm_available'] = int(self._rpm.tokens)
+            if self._tpm is not None:
+                self._tpm.wait_time(0, now)
+                stats['tpm_available'] = int(self._tpm.tokens)
+            return stats
+
+
+_default_scheduler: Optional[QuotaScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_quota_scheduler() -> QuotaScheduler:
+    """获取进程级默认的配额调度器"""
+    global _default_scheduler
+    if _default_scheduler is None:
+        with _default_scheduler_lock:
+            if _default_scheduler is None:
+                _default_scheduler = QuotaScheduler()
+    return _default_scheduler
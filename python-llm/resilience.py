@@ -0,0 +1,194 @@
+"""
+上游调用的重试与熔断
+- 可重试的错误（限流、5xx、超时、连接失败）按带抖动的指数退避重试，优先遵循 Retry-After
+- 每个上游端点一个熔断器：连续失败达到阈值后打开，冷却期内直接失败，之后放行一个探测请求
+"""
+
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from llm_errors import LLMError, RateLimitError, CircuitOpenError, QuotaExceededError, classify_error
+
+
+class CircuitBreaker:
+    """单个端点的熔断器（closed -> open -> half_open -> closed）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, endpoint: str, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold if failure_threshold is not None \
+            else int(os.environ.get('LLM_BREAKER_FAILURES', 5))
+        self.reset_timeout = reset_timeout if reset_timeout is not None \
+            else float(os.environ.get('LLM_BREAKER_RESET_TIMEOUT', 30))
+
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def before_call(self):
+        """请求前检查，熔断期间抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(
+            f"API调用失败: 上游服务暂时不可用（熔断中），请{max(remaining, 1):.0f}秒后重试",
+            retry_after=max(remaining, 1.0)
+        )
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def release_probe(self):
+        """探测请求被取消时不改变状态，允许下一个请求继续探测"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self, error: LLMError):
+        """记录失败；限流和请求错误说明上游仍在正常响应，不计入熔断"""
+        with self._lock:
+            if not error.retryable or isinstance(error, RateLimitError):
+                self._probe_in_flight = False
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+            if self.state == self.OPEN:
+                snapshot['retry_after'] = round(max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0), 2)
+            return snapshot
+
+
+class RetryPolicy:
+    """有上限的重试策略"""
+
+    def __init__(
+        self,
+        max_attempts: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None
+    ):
+        self.max_attempts = max_attempts if max_attempts is not None \
+            else int(os.environ.get('LLM_RETRY_MAX_ATTEMPTS', 3))
+        self.base_delay = base_delay if base_delay is not None \
+            else float(os.environ.get('LLM_RETRY_BASE_DELAY', 0.5))
+        self.max_delay = max_delay if max_delay is not None \
+            else float(os.environ.get('LLM_RETRY_MAX_DELAY', 8.0))
+
+    def next_delay(self, attempt: int, error: LLMError) -> Optional[float]:
+        """第 attempt 次（从1开始）失败后的等待秒数，不再重试时返回None"""
+        if not error.retryable or attempt >= self.max_attempts:
+            return None
+        if error.retry_after is not None:
+            # 上游要求的等待时间超过上限时，不如直接把错误返回给用户
+            return error.retry_after if error.retry_after <= self.max_delay else None
+        # full jitter，避免大量请求在同一时刻重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+
+def call_with_retry(fn: Callable[[], Any], breaker: CircuitBreaker, policy: RetryPolicy) -> Any:
+    """在熔断器保护下执行 fn()，失败时按策略重试，最终抛出 LLMError"""
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_call()
+        try:
+            result = fn()
+        except QuotaExceededError:
+            # 本地配额排队超时，请求没有发出，与上游状态无关
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            error = classify_error(e)
+            breaker.record_failure(error)
+            delay = policy.next_delay(attempt, error)
+            # 本次失败触发熔断时直接返回真实的上游错误
+            if delay is None or breaker.state == CircuitBreaker.OPEN:
+                raise error from e
+            time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+async def acall_with_retry(fn: Callable[[], Awaitable[Any]], breaker: CircuitBreaker, policy: RetryPolicy) -> Any:
+    """call_with_retry 的异步版本"""
+    attempt = 0
+    while True:
+        attempt += 1
+        breaker.before_call()
+        try:
+            result = await fn()
+        except (asyncio.CancelledError, QuotaExceededError):
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            error = classify_error(e)
+            breaker.record_failure(error)
+            delay = policy.next_delay(attempt, error)
+            # 本次失败触发熔断时直接返回真实的上游错误
+            if delay is None or breaker.state == CircuitBreaker.OPEN:
+                raise error from e
+            await asyncio.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    """获取端点对应的进程级熔断器"""
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(endpoint)
+            if breaker is None:
+                breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+def get_breaker_states() -> Dict[str, Dict[str, Any]]:
+    """所有端点熔断器的状态"""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.endpoint: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,111 @@
+"""
+回复缓存
+相同系统提示、相同对话上下文、相同生成参数的请求直接复用上一次的回复，
+按LRU淘汰，限制总字节数并支持过期时间
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, Tuple
+
+
+def normalize_content(content: str) -> str:
+    """统一全角/半角并合并空白，使仅格式不同的提问得到相同的缓存键"""
+    return ' '.join(unicodedata.normalize('NFKC', content).split())
+
+
+def make_cache_key(
+    prompt_type: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int
+) -> str:
+    """由系统提示类型、规范化后的消息列表和生成参数计算缓存键"""
+    payload = json.dumps(
+        [
+            prompt_type,
+            [[m['role'], normalize_content(m['content'])] for m in messages],
+            temperature,
+            max_tokens
+        ],
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """线程安全的LRU回复缓存"""
+
+    def __init__(self, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        # 缓存内容的总字节数上限与过期时间（秒），ttl 为 0 表示不过期
+        self.max_bytes = max_bytes if max_bytes is not None \
+            else int(os.environ.get('LLM_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+        self.ttl = ttl if ttl is not None \
+            else float(os.environ.get('LLM_CACHE_TTL', 3600))
+
+        # key -> (回复, 字节数, 写入时间)，最近使用的在末尾
+        self._entries: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            response, size, stored_at = entry
+            if self.ttl > 0 and time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: str, response: str):
+        size = len(key) + len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (response, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
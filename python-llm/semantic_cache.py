@@ -0,0 +1,335 @@
+"""
+语义回复缓存
+会话第一轮的提问按相似度复用已有回复（如「北京三日游推荐」与「推荐一个北京3天行程」）：
+- 提问经规范化后切成字符n-gram，哈希到定长向量（不依赖模型，CPU上每次几十微秒）
+- 同一进程内的向量索引，NumPy一次矩阵乘法完成全部余弦相似度计算
+- 按系统提示类型和模型分区，超出容量时淘汰最久未命中的条目
+- 设置 path 后每隔 save_interval 秒在后台保存到磁盘（npz，不使用pickle），重启后继续使用；
+  多个worker进程共用同一文件时以最后保存的为准
+
+哈希n-gram只能识别措辞上的近似，无法理解语义，因此命中还需满足：
+提问中的数字完全相同；去掉常用词和「推荐」「行程」等意图词后，两边按顺序比较的编辑距离不超过
+max_char_diff（默认0，避免「北京」命中「南京」、「北京到上海」命中「上海到北京」）；
+差异中不能有否定词（「带老人」与「不带老人」、「吃辣」与「不吃辣」意思相反）。
+"""
+
+import difflib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Optional, Dict, Any, List, Tuple
+
+import numpy as np
+
+from response_cache import normalize_content
+
+logger = logging.getLogger(__name__)
+
+# 含数字但不表示数量的说法，先于数字转换去掉
+_QUANTIFIER_FILLER_RE = re.compile(r'一个|一下|一份|一些')
+_NUMERALS = {'一': 1, '二': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9, '十': 10}
+# 表示天数、人数等数量的中文数字统一为阿拉伯数字
+_NUMERAL_RE = re.compile(r'([一二两三四五六七八九十]+)(?=[天日晚夜周个人位岁])')
+_DAYS_RE = re.compile(r'(\d+)日')
+# 旅行提问中意思相同的说法
+_SYNONYMS = [
+    (re.compile(r'旅游|游玩|旅行|出游|玩法|怎么玩|攻略|路线|行程|游'), '行程'),
+    (re.compile(r'推荐|建议|安排|规划|计划'), '推荐'),
+    (re.compile(r'美食|好吃的|小吃'), '美食'),
+]
+# 不影响提问含义的常用词和标点
+_FILLER_RE = re.compile(
+    r'请问|请|帮我|帮忙|给我|我想|我要|想要|有什么|有哪些|哪些|什么|可以|能不能|'
+    r'应该|如何|怎么|怎样|的|了|吗|呢|吧|啊|呀|[\s\W_]+'
+)
+_NUMBER_RE = re.compile(r'\d+')
+# 规范化后表示提问意图的词，出现在句首还是句尾不影响含义，不参与按顺序的比较
+_INTENT_RE = re.compile(r'推荐|行程')
+# 否定词：差异中只要涉及其中之一，提问的意思就可能相反
+_NEGATORS = frozenset('不没别无非')
+
+
+def _chinese_number(text: str) -> str:
+    if len(text) == 1:
+        return str(_NUMERALS[text])
+    if text.startswith('十'):
+        return str(10 + _NUMERALS.get(text[1:], 0))
+    if text.endswith('十'):
+        return str(_NUMERALS[text[0]] * 10)
+    if len(text) == 3 and text[1] == '十':
+        return str(_NUMERALS[text[0]] * 10 + _NUMERALS[text[2]])
+    return text
+
+
+def canonicalize(text: str) -> str:
+    """规范化提问：统一全角半角、数字写法和常见同义说法，去掉语气词和标点"""
+    text = _QUANTIFIER_FILLER_RE.sub('', normalize_content(text).lower())
+    text = _NUMERAL_RE.sub(lambda match: _chinese_number(match.group(1)), text)
+    text = _DAYS_RE.sub(r'\1天', text)
+    for pattern, replacement in _SYNONYMS:
+        text = pattern.sub(replacement, text)
+    return _FILLER_RE.sub('', text)
+
+
+class HashedNgramEmbedder:
+    """字符1~3-gram的哈希向量（带符号的特征哈希），结果已归一化
+
+    使用crc32而不是内置hash()，不同进程、重启前后得到相同的向量，索引才能持久化。
+    """
+
+    def __init__(self, dim: int = 512, ngrams: Tuple[int, ...] = (1, 2, 3)):
+        self.dim = dim
+        self.ngrams = ngrams
+
+    def embed(self, canonical: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in self.ngrams:
+            # 长的n-gram更能区分措辞，权重更高
+            weight = float(n)
+            for i in range(len(canonical) - n + 1):
+                digest = zlib.crc32(canonical[i:i + n].encode('utf-8'))
+                vector[digest % self.dim] += weight if digest & 0x80000000 else -weight
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+
+def _guard_key(canonical: str) -> Tuple[Tuple[str, ...], frozenset, str]:
+    """命中校验用的 (数字, 意图词, 去掉意图词后的文本) 特征"""
+    return (
+        tuple(_NUMBER_RE.findall(canonical)),
+        frozenset(_INTENT_RE.findall(canonical)),
+        _INTENT_RE.sub('', canonical)
+    )
+
+
+def _edit_distance(text: str, other: str) -> Optional[int]:
+    """按顺序比较两段文本，返回差异的字符数；差异中含否定词时返回None"""
+    distance = 0
+    matcher = difflib.SequenceMatcher(None, text, other, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        if _NEGATORS.intersection(text[i1:i2]) or _NEGATORS.intersection(other[j1:j2]):
+            return None
+        distance += max(i2 - i1, j2 - j1)
+    return distance
+
+
+class SemanticCache:
+    """线程安全的语义回复缓存"""
+
+    # 相似度超过阈值的条目中，最多对这么多个做命中校验
+    MAX_CANDIDATES = 8
+
+    def __init__(
+        self,
+        threshold: Optional[float] = None,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        path: Optional[str] = None,
+        save_interval: Optional[float] = None,
+        max_char_diff: int = 0,
+        embedder: Optional[HashedNgramEmbedder] = None
+    ):
+        self.threshold = threshold if threshold is not None \
+            else float(os.environ.get('LLM_SEMANTIC_CACHE_THRESHOLD', 0.7))
+        self.max_entries = max_entries if max_entries is not None \
+            else int(os.environ.get('LLM_SEMANTIC_CACHE_SIZE', 5000))
+        # 过期时间（秒），0 表示不过期；使用墙钟时间，重启后仍然有效
+        self.ttl = ttl if ttl is not None \
+            else float(os.environ.get('LLM_SEMANTIC_CACHE_TTL', 86400))
+        self.path = path if path is not None else os.environ.get('LLM_SEMANTIC_CACHE_PATH', '')
+        self.save_interval = save_interval if save_interval is not None \
+            else float(os.environ.get('LLM_SEMANTIC_CACHE_SAVE_INTERVAL', 60))
+        self.max_char_diff = max_char_diff
+        self.embedder = embedder or HashedNgramEmbedder()
+
+        # 预分配的定长数组，条目按槽位存放；_count 之后的槽位未使用
+        self._vectors = np.zeros((self.max_entries, self.embedder.dim), dtype=np.float32)
+        self._partitions = np.full(self.max_entries, -1, dtype=np.int32)
+        self._last_used = np.zeros(self.max_entries, dtype=np.int64)
+        self._created = np.zeros(self.max_entries, dtype=np.float64)
+        self._questions: List[str] = [''] * self.max_entries
+        self._responses: List[str] = [''] * self.max_entries
+        self._count = 0
+        # 分区名（"prompt_type|model"）-> 编号
+        self._partition_ids: Dict[str, int] = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+
+        if self.path and os.path.exists(self.path):
+            try:
+                self.load()
+            except Exception as e:
+                logger.warning(f"语义缓存文件 {self.path} 无法读取，忽略: {str(e)}")
+
+        self._closed = threading.Event()
+        self._saver: Optional[threading.Thread] = None
+        if self.path and self.save_interval > 0:
+            self._saver = threading.Thread(target=self._save_loop, name='semantic-cache-saver', daemon=True)
+            self._saver.start()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def _partition_id(self, partition: str, create: bool) -> Optional[int]:
+        partition_id = self._partition_ids.get(partition)
+        if partition_id is None and create:
+            partition_id = self._partition_ids[partition] = len(self._partition_ids)
+        return partition_id
+
+    def _accept(self, canonical: str, slot: int) -> bool:
+        """数字和意图词相同，其余文本按顺序的差异不超过 max_char_diff 个字符且不涉及否定词"""
+        numbers, intents, text = _guard_key(canonical)
+        cached_numbers, cached_intents, cached_text = _guard_key(self._questions[slot])
+        if numbers != cached_numbers or intents != cached_intents:
+            return False
+        distance = _edit_distance(text, cached_text)
+        return distance is not None and distance <= self.max_char_diff
+
+    def get(self, partition: str, question: str) -> Optional[Tuple[str, float]]:
+        """查找相似提问的回复，返回 (回复, 相似度)"""
+        canonical = canonicalize(question)
+        if not canonical:
+            return None
+        vector = self.embedder.embed(canonical)
+        with self._lock:
+            partition_id = self._partition_id(partition, create=False)
+            if partition_id is None or not self._count:
+                self.misses += 1
+                return None
+            count = self._count
+            scores = self._vectors[:count] @ vector
+            valid = self._partitions[:count] == partition_id
+            if self.ttl > 0:
+                valid &= self._created[:count] >= time.time() - self.ttl
+            candidates = np.flatnonzero(valid & (scores >= self.threshold))
+            if len(candidates) > self.MAX_CANDIDATES:
+                top = np.argpartition(scores[candidates], -self.MAX_CANDIDATES)[-self.MAX_CANDIDATES:]
+                candidates = candidates[top]
+            # 相似度从高到低，取第一个通过校验的
+            for slot in candidates[np.argsort(-scores[candidates])]:
+                if self._accept(canonical, slot):
+                    self._last_used[slot] = self._tick()
+                    self.hits += 1
+                    return self._responses[slot], float(scores[slot])
+            if len(candidates):
+                self.rejected += 1
+            self.misses += 1
+            return None
+
+    def put(self, partition: str, question: str, response: str):
+        canonical = canonicalize(question)
+        if not canonical or not response:
+            return
+        vector = self.embedder.embed(canonical)
+        with self._lock:
+            partition_id = self._partition_id(partition, create=True)
+            if self._count < self.max_entries:
+                slot = self._count
+                self._count += 1
+            else:
+                # 已满时替换最久未使用的条目
+                slot = int(np.argmin(self._last_used[:self._count]))
+                self.evictions += 1
+            self._vectors[slot] = vector
+            self._partitions[slot] = partition_id
+            self._last_used[slot] = self._tick()
+            self._created[slot] = time.time()
+            self._questions[slot] = canonical
+            self._responses[slot] = response
+            self._dirty = True
+
+    def save(self, force: bool = False):
+        """写入 path（先写临时文件再替换），没有新条目时跳过"""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty and not force:
+                return
+            count = self._count
+            arrays = {
+                'vectors': self._vectors[:count].copy(),
+                'partitions': self._partitions[:count].copy(),
+                'last_used': self._last_used[:count].copy(),
+                'created': self._created[:count].copy(),
+                'meta': np.array(json.dumps({
+                    'dim': self.embedder.dim,
+                    'partitions': self._partition_ids,
+                    'questions': self._questions[:count],
+                    'responses': self._responses[:count]
+                }, ensure_ascii=False))
+            }
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+    def _save_loop(self):
+        while not self._closed.wait(self.save_interval):
+            try:
+                self.save()
+            except OSError as e:
+                logger.warning(f"语义缓存保存失败: {str(e)}")
+
+    def load(self):
+        with np.load(self.path, allow_pickle=False) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['dim'] != self.embedder.dim:
+                raise ValueError(f"向量维度 {meta['dim']} 与当前配置 {self.embedder.dim} 不一致")
+            # 超出容量时保留最近使用的条目
+            order = np.argsort(data['last_used'])[-self.max_entries:]
+            count = len(order)
+            with self._lock:
+                self._vectors[:count] = data['vectors'][order]
+                self._partitions[:count] = data['partitions'][order]
+                self._last_used[:count] = np.arange(1, count + 1)
+                self._created[:count] = data['created'][order]
+                self._questions[:count] = [meta['questions'][i] for i in order]
+                self._responses[:count] = [meta['responses'][i] for i in order]
+                self._count = count
+                self._clock = count
+                self._partition_ids = dict(meta['partitions'])
+        logger.info(f"从 {self.path} 加载了 {count} 条语义缓存")
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+            self._partition_ids.clear()
+            self._dirty = True
+
+    def close(self):
+        """停止后台保存并写入尚未保存的条目"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._saver is not None:
+            self._saver.join()
+        self.save()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': self._count,
+                'max_entries': self.max_entries,
+                'threshold': self.threshold,
+                'ttl': self.ttl,
+                'path': self.path or None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'rejected': self.rejected,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,91 @@
+"""
+按会话加锁
+同一会话的对话轮次依次执行（记录用户消息、调用上游、写入回复作为一个整体），不同会话互不阻塞。
+每个会话的锁只在有请求使用时存在，用完即删除，全局锁只在取用/归还时短暂持有。
+"""
+
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator
+
+
+class _Entry:
+    """一个会话的锁及正在使用（持有或等待）它的请求数"""
+
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class SessionLocks:
+    """按 session_id 分配的互斥锁，同步与异步调用共用同一把锁"""
+
+    # 异步等待时的轮询间隔（秒），从最小值开始逐次加倍
+    POLL_MIN = 0.005
+    POLL_MAX = 0.05
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, _Entry] = {}
+        # 需要等待其他请求释放的次数
+        self.contended = 0
+
+    def _checkout(self, key: str) -> _Entry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.users += 1
+            return entry
+
+    def _checkin(self, key: str, entry: _Entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._entries[key]
+
+    def _contended(self):
+        with self._lock:
+            self.contended += 1
+
+    @contextmanager
+    def hold(self, key: str) -> Iterator[None]:
+        entry = self._checkout(key)
+        try:
+            if not entry.lock.acquire(blocking=False):
+                self._contended()
+                entry.lock.acquire()
+            try:
+                yield
+            finally:
+                entry.lock.release()
+        finally:
+            self._checkin(key, entry)
+
+    @asynccontextmanager
+    async def ahold(self, key: str) -> AsyncIterator[None]:
+        """异步版本：锁被占用时轮询等待，不阻塞事件循环，也不占用线程；等待中被取消不会遗留锁"""
+        entry = self._checkout(key)
+        try:
+            if not entry.lock.acquire(blocking=False):
+                self._contended()
+                delay = self.POLL_MIN
+                while not entry.lock.acquire(blocking=False):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.POLL_MAX)
+            try:
+                yield
+            finally:
+                entry.lock.release()
+        finally:
+            self._checkin(key, entry)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'active_sessions': len(self._entries),
+                'contended': self.contended
+            }
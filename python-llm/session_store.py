@@ -0,0 +1,361 @@
+"""
+会话存储后端
+ConversationManager 在内存中缓存活跃会话，通过 SessionStore 持久化：
+- InMemorySessionStore: 不落盘，会话只存在于当前进程
+- SQLiteSessionStore: WAL模式的SQLite文件，写入批量提交，可由同机多个worker进程共享
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, List, Dict, Any, Iterator, Tuple
+from message_history import Message, parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+def _row_to_message(role: str, content: str, timestamp: Optional[str], metadata: Optional[str]) -> Message:
+    return Message(role, content, parse_timestamp(timestamp), json.loads(metadata) if metadata and metadata != '{}' else None)
+
+
+class SessionStore:
+    """会话存储接口"""
+
+    name = 'base'
+
+    def load_session(self, session_id: str, limit: int) -> Optional[Tuple[Dict[str, Any], List[Message]]]:
+        """读取会话信息和最近 limit 条非系统消息（前面附带最新的系统提示），不存在时返回None"""
+        return None
+
+    def iter_messages(self, session_id: str) -> Optional[Iterator[Message]]:
+        """按顺序逐条读取会话的全部消息（不受内存历史长度限制），不支持时返回None"""
+        return None
+
+    def save_session(self, session_id: str, info: Dict[str, Any]):
+        """写入（或覆盖）会话信息"""
+
+    def append_message(self, session_id: str, message: Message):
+        """追加一条消息"""
+
+    def clear_messages(self, session_id: str):
+        """删除会话的对话消息，保留系统提示"""
+
+    def delete_session(self, session_id: str):
+        """删除会话及其全部消息"""
+
+    def purge_expired(self, ttl: float) -> int:
+        """删除超过 ttl 秒未活跃的会话，返回删除数量"""
+        return 0
+
+    def flush(self):
+        """提交尚未写入的数据"""
+
+    def get_stats(self) -> Dict[str, Any]:
+        """存储中的会话数和待提交的写操作数，不支持统计时为None"""
+        return {'backend': self.name, 'sessions': None, 'pending_writes': 0}
+
+    def close(self):
+        """提交剩余数据并释放资源"""
+
+
+class InMemorySessionStore(SessionStore):
+    """内存存储：会话状态只保存在 ConversationManager 的缓存中，进程退出即丢失"""
+
+    name = 'memory'
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite存储
+
+    写操作只进入缓冲区，由后台写入线程在达到 batch_size 条或每隔 flush_interval 秒时在一个事务中提交，
+    请求线程不会因磁盘慢或数据库被其他进程锁住而阻塞。
+    提交失败时记录日志并在下一轮重试；缓冲区超过 max_pending 条时丢弃最早的写操作（计入 dropped_writes）。
+    读取会话前等待该会话缓冲中的写操作提交（最多 load_timeout 秒），保证本进程的写入可见。
+    """
+
+    name = 'sqlite'
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        max_pending: Optional[int] = None,
+        load_timeout: float = 5.0
+    ):
+        self.path = path
+        self.batch_size = batch_size if batch_size is not None \
+            else int(os.environ.get('SESSION_STORE_BATCH_SIZE', 64))
+        self.flush_interval = flush_interval if flush_interval is not None \
+            else float(os.environ.get('SESSION_STORE_FLUSH_INTERVAL', 0.5))
+        self.max_pending = max_pending if max_pending is not None \
+            else int(os.environ.get('SESSION_STORE_MAX_PENDING', 10000))
+        self.load_timeout = load_timeout
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=30000')
+        self._create_schema()
+
+        # _lock 只保护缓冲区（持有时间很短）；_db_lock 保护连接，只在写入线程和读取时持有
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._db_lock = threading.Lock()
+        # (序号, session_id, sql, params)，序号递增；_done_seq 及之前的写操作都已提交或丢弃
+        self._pending: List[Tuple[int, str, str, tuple]] = []
+        self._seq = 0
+        self._done_seq = 0
+        # session_id -> 该会话最后一个缓冲中的写操作序号
+        self._pending_sessions: Dict[str, int] = {}
+        self.failed_flushes = 0
+        self.dropped_writes = 0
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='session-store-flusher', daemon=True)
+        self._flusher.start()
+
+    def _create_schema(self):
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                info TEXT NOT NULL,
+                last_activity REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TEXT,
+                metadata TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id);
+            CREATE INDEX IF NOT EXISTS idx_sessions_activity ON sessions (last_activity);
+        ''')
+
+    def _enqueue(self, session_id: str, sql: str, params: tuple):
+        with self._lock:
+            self._seq += 1
+            self._pending.append((self._seq, session_id, sql, params))
+            self._pending_sessions[session_id] = self._seq
+            self._trim_locked()
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wake.set()
+
+    def _trim_locked(self):
+        """缓冲区超出上限时丢弃最早的写操作（调用方需持有锁）"""
+        overflow = len(self._pending) - self.max_pending
+        if overflow <= 0:
+            return
+        dropped, self._pending = self._pending[:overflow], self._pending[overflow:]
+        self.dropped_writes += overflow
+        logger.error(f"会话存储缓冲区超过 {self.max_pending} 条，丢弃最早的 {overflow} 条写操作")
+        self._mark_done_locked(dropped[-1][0])
+
+    def _mark_done_locked(self, seq: int):
+        """序号不超过 seq 的写操作已提交或丢弃，唤醒等待的读取方（调用方需持有锁）"""
+        self._done_seq = max(self._done_seq, seq)
+        for session_id, last_seq in list(self._pending_sessions.items()):
+            if last_seq <= self._done_seq:
+                del self._pending_sessions[session_id]
+        self._flushed.notify_all()
+
+    def _flush_once(self):
+        """在一个事务中提交当前缓冲区，只在写入线程中调用"""
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            with self._db_lock:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    for _, _, sql, params in batch:
+                        self._conn.execute(sql, params)
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+        except sqlite3.OperationalError as e:
+            # 数据库被其他进程锁住或磁盘暂时不可写：放回缓冲区，下一轮重试
+            with self._lock:
+                self._pending = batch + self._pending
+                self.failed_flushes += 1
+                self._trim_locked()
+            logger.error(f"会话存储提交 {len(batch)} 条写操作失败，稍后重试: {str(e)}")
+            return
+        except Exception as e:
+            # 重试也不会成功的错误（如数据不合法），丢弃这一批，避免一直堵住后面的写入
+            with self._lock:
+                self.failed_flushes += 1
+                self.dropped_writes += len(batch)
+                self._mark_done_locked(batch[-1][0])
+            logger.error(f"会话存储提交失败，丢弃 {len(batch)} 条写操作: {str(e)}")
+            return
+        with self._lock:
+            self._mark_done_locked(batch[-1][0])
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            closing = self._closed.is_set()
+            self._flush_once()
+            if closing:
+                return
+
+    def _wait_flushed(self, seq: int, timeout: Optional[float]) -> bool:
+        """唤醒写入线程并等待序号不超过 seq 的写操作提交，超时返回False"""
+        with self._lock:
+            if self._done_seq >= seq:
+                return True
+        self._wake.set()
+        with self._lock:
+            self._flushed.wait_for(lambda: self._done_seq >= seq or not self._flusher.is_alive(), timeout)
+            return self._done_seq >= seq
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待写入线程提交目前缓冲中的全部写操作，超时返回False"""
+        with self._lock:
+            seq = self._seq
+        return self._wait_flushed(seq, timeout)
+
+    def load_session(self, session_id: str, limit: int) -> Optional[Tuple[Dict[str, Any], List[Message]]]:
+        with self._lock:
+            seq = self._pending_sessions.get(session_id, 0)
+        if not self._wait_flushed(seq, self.load_timeout):
+            logger.warning(f"会话 {session_id} 的写操作 {self.load_timeout} 秒内未提交，读取到的可能不是最新状态")
+        with self._db_lock:
+            row = self._conn.execute(
+                'SELECT info FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            system_rows = self._conn.execute(
+                "SELECT role, content, timestamp, metadata FROM messages "
+                "WHERE session_id = ? AND role = 'system' ORDER BY id DESC LIMIT 1",
+                (session_id,)
+            ).fetchall()
+            message_rows = self._conn.execute(
+                "SELECT role, content, timestamp, metadata FROM messages "
+                "WHERE session_id = ? AND role != 'system' ORDER BY id DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
+
+        messages = [_row_to_message(*row) for row in system_rows + message_rows[::-1]]
+        return json.loads(row[0]), messages
+
+    def iter_messages(self, session_id: str, batch_size: int = 500) -> Optional[Iterator[Message]]:
+        """使用独立的只读连接按id分批读取，导出期间不占用写连接的锁"""
+        self.flush(self.load_timeout)
+
+        def generate():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            try:
+                last_id = 0
+                while True:
+                    rows = conn.execute(
+                        "SELECT id, role, content, timestamp, metadata FROM messages "
+                        "WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?",
+                        (session_id, last_id, batch_size)
+                    ).fetchall()
+                    if not rows:
+                        return
+                    for row in rows:
+                        yield _row_to_message(*row[1:])
+                    last_id = rows[-1][0]
+            finally:
+                conn.close()
+
+        return generate()
+
+    def save_session(self, session_id: str, info: Dict[str, Any]):
+        self._enqueue(
+            session_id,
+            'INSERT INTO sessions (session_id, info, last_activity) VALUES (?, ?, ?) '
+            'ON CONFLICT(session_id) DO UPDATE SET info = excluded.info, last_activity = excluded.last_activity',
+            (session_id, json.dumps(info, ensure_ascii=False, default=str), time.time())
+        )
+
+    def append_message(self, session_id: str, message: Message):
+        self._enqueue(
+            session_id,
+            'INSERT INTO messages (session_id, role, content, timestamp, metadata) VALUES (?, ?, ?, ?, ?)',
+            (
+                session_id,
+                message.role,
+                message.content,
+                message.timestamp,
+                json.dumps(message.metadata or {}, ensure_ascii=False, default=str)
+            )
+        )
+
+    def clear_messages(self, session_id: str):
+        self._enqueue(
+            session_id,
+            "DELETE FROM messages WHERE session_id = ? AND role != 'system'",
+            (session_id,)
+        )
+
+    def delete_session(self, session_id: str):
+        self._enqueue(session_id, 'DELETE FROM messages WHERE session_id = ?', (session_id,))
+        self._enqueue(session_id, 'DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+    def purge_expired(self, ttl: float) -> int:
+        deadline = time.time() - ttl
+        # 由后台清理线程调用，先等缓冲中的活跃时间提交，避免误删刚活跃的会话
+        self.flush(self.load_timeout)
+        with self._db_lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'DELETE FROM messages WHERE session_id IN '
+                    '(SELECT session_id FROM sessions WHERE last_activity < ?)',
+                    (deadline,)
+                )
+                purged = self._conn.execute(
+                    'DELETE FROM sessions WHERE last_activity < ?', (deadline,)
+                ).rowcount
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return purged
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._db_lock:
+            # 未提交的写操作还不在表中，会话数以已提交的为准
+            sessions = self._conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+        with self._lock:
+            return {
+                'backend': self.name,
+                'sessions': sessions,
+                'pending_writes': len(self._pending),
+                'failed_flushes': self.failed_flushes,
+                'dropped_writes': self.dropped_writes
+            }
+
+    def close(self):
+        """通知写入线程提交剩余数据后退出，再关闭连接"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        self._flusher.join()
+        with self._db_lock:
+            self._conn.close()
+
+
+def create_session_store(backend: Optional[str] = None) -> SessionStore:
+    """按 SESSION_STORE 环境变量（memory / sqlite）创建存储后端"""
+    backend = (backend or os.environ.get('SESSION_STORE', 'memory')).lower()
+    if backend == 'memory':
+        return InMemorySessionStore()
+    if backend == 'sqlite':
+        return SQLiteSessionStore(os.environ.get('SESSION_DB_PATH', 'sessions.db'))
+    raise ValueError(f"未知的会话存储后端: {backend}")
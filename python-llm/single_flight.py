@@ -0,0 +1,144 @@
+"""
+相同请求合并（single-flight）
+同一时刻多个完全相同的上游调用只真正发出一次，其余调用方等待并共享同一个结果
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+def make_request_key(model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+    """由完整的消息列表和生成参数计算请求键"""
+    payload = json.dumps(
+        [model, messages, temperature, max_tokens],
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    """一次进行中的同步调用"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """按键合并进行中的调用，同步与异步调用分别合并"""
+
+    def __init__(self, enabled: Optional[bool] = None):
+        self.enabled = enabled if enabled is not None \
+            else os.environ.get('LLM_COALESCE', '1').lower() not in ('0', 'false', 'no')
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        # 事件循环 -> {键: 任务}；按循环对象而不是 id 区分，循环回收后 id 可能被复用
+        self._tasks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        # leaders: 实际发出的调用数；coalesced: 等待他人结果而未发出的调用数
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """执行 fn()；已有相同键的调用在进行时等待其结果"""
+        if not self.enabled:
+            return fn()
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """异步版本：相同键共享同一个任务
+
+        上游调用在独立任务中执行，发起者被取消（客户端断开）不会影响其他等待者。
+        """
+        if not self.enabled:
+            return await fn()
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._drop_closed_loops()
+            tasks = self._tasks.setdefault(loop, {})
+            task = tasks.get(key)
+            if task is None:
+                task = loop.create_task(fn())
+                tasks[key] = task
+                task.add_done_callback(lambda t: self._forget(loop, key, t))
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _forget(self, loop: asyncio.AbstractEventLoop, key: str, task: asyncio.Task):
+        with self._lock:
+            tasks = self._tasks.get(loop)
+            if tasks is not None and tasks.get(key) is task:
+                del tasks[key]
+                if not tasks:
+                    del self._tasks[loop]
+
+    def _drop_closed_loops(self):
+        """丢弃已关闭的事件循环上残留的任务（调用方需持有锁）
+
+        任务引用着所属的循环，弱引用键在任务完成前不会失效；循环关闭后任务不会再完成。
+        """
+        for loop in [loop for loop in self._tasks if loop.is_closed()]:
+            del self._tasks[loop]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._drop_closed_loops()
+            total = self.leaders + self.coalesced
+            return {
+                'enabled': self.enabled,
+                'in_flight': len(self._calls) + sum(len(tasks) for tasks in self._tasks.values()),
+                'upstream_calls': self.leaders,
+                'coalesced_waiters': self.coalesced,
+                'coalesced_ratio': round(self.coalesced / total, 4) if total else 0.0
+            }
+
+
+_default_single_flight: Optional[SingleFlight] = None
+_default_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """获取进程级默认的请求合并器"""
+    global _default_single_flight
+    if _default_single_flight is None:
+        with _default_single_flight_lock:
+            if _default_single_flight is None:
+                _default_single_flight = SingleFlight()
+    return _default_single_flight
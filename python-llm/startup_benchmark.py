@@ -0,0 +1,239 @@
+"""
+服务冷启动基准
+每次都在新的子进程中测量，输出：
+- 导入耗时：python -X importtime 统计 import chat_api 的总耗时及最慢的直接依赖，
+  并检查 langchain_core / openai / httpx / numpy 是否被推迟到第一次使用时才加载
+- 推迟加载的耗时：导入后创建LLM封装和HTTP客户端所需的时间（由后台预加载或第一次请求承担）
+- 就绪耗时：启动 chat_api.py 到 /api/health 返回200、到第一条对话返回的时间
+  （上游为进程内的模拟服务，不需要API密钥和网络）
+
+结果可用 --output 保存，再用 --baseline 与之前的结果对比。
+
+示例:
+    python startup_benchmark.py --runs 5 --output startup.json
+    python startup_benchmark.py --runs 5 --baseline startup.json
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.client import HTTPConnection
+from typing import Optional, Dict, Any, List, Tuple
+
+from mock_deepseek_server import MockConfig, create_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# 应当推迟加载的重量级依赖
+DEFERRED_MODULES = ('langchain_core', 'openai', 'httpx', 'numpy')
+
+
+def start_mock() -> int:
+    config = MockConfig(latency='fixed:0.01', tokens_per_second=100000, completion_tokens='8,16')
+    server = create_server('127.0.0.1', 0, config)
+    threading.Thread(target=server.serve_forever, name='mock-upstream', daemon=True).start()
+    return server.server_address[1]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def service_env(mock_port: int, **extra: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        'SILICON_FLOW_API_KEY': 'mock',
+        'SILICON_FLOW_API_URL': f'http://127.0.0.1:{mock_port}/v1',
+        'SESSION_STORE': 'memory',
+        'FLASK_DEBUG': '0',
+        'HOST': '127.0.0.1',
+        'PYTHONDONTWRITEBYTECODE': '1'
+    })
+    env.update(extra)
+    return env
+
+
+def parse_importtime(stderr: str, module: str) -> Tuple[float, Dict[str, float], List[str]]:
+    """返回 (总耗时毫秒, 直接依赖的累计耗时, 加载过的全部模块)"""
+    total = 0.0
+    children: Dict[str, float] = {}
+    pending: Dict[str, float] = {}
+    loaded = []
+    # 输出按导入完成的顺序排列，依赖先于导入它的模块出现；缩进表示嵌套深度
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        loaded.append(name)
+        if depth == 1:
+            pending[name] = int(cumulative) / 1000
+        elif depth == 0:
+            if name == module:
+                total = int(cumulative) / 1000
+                children = pending
+            pending = {}
+    return total, children, loaded
+
+
+def measure_llm_load(env: Dict[str, str]) -> float:
+    """导入 chat_api 之后加载LLM封装和HTTP客户端的耗时（毫秒），即推迟到后台或第一次请求的部分"""
+    code = (
+        "import time, chat_api; start = time.perf_counter(); chat_api.chat_chain.warm_up(); "
+        "print(time.perf_counter() - start)"
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code], cwd=HERE, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"加载LLM失败:\n{result.stderr[-2000:]}")
+    return float(result.stdout.strip().splitlines()[-1]) * 1000
+
+
+def measure_imports(module: str, runs: int, env: Dict[str, str]) -> Dict[str, Any]:
+    totals = []
+    children: Dict[str, List[float]] = {}
+    loaded: List[str] = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=HERE, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"import {module} 失败:\n{result.stderr[-2000:]}")
+        total, run_children, loaded = parse_importtime(result.stderr, module)
+        totals.append(total)
+        for name, ms in run_children.items():
+            children.setdefault(name, []).append(ms)
+    slowest = sorted(
+        ((name, statistics.median(values)) for name, values in children.items()),
+        key=lambda item: item[1], reverse=True
+    )[:8]
+    return {
+        'total_ms': round(statistics.median(totals), 1),
+        'slowest': [{'module': name, 'ms': round(ms, 1)} for name, ms in slowest],
+        'deferred': {
+            name: not any(module_name == name or module_name.startswith(name + '.') for module_name in loaded)
+            for name in DEFERRED_MODULES
+        }
+    }
+
+
+def request(port: int, method: str, path: str, body: Optional[Dict[str, Any]] = None,
+            timeout: float = 30.0) -> Tuple[int, Dict[str, Any]]:
+    conn = HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        payload = json.dumps(body) if body is not None else None
+        conn.request(method, path, body=payload, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        conn.close()
+
+
+def measure_ready(env: Dict[str, str], timeout: float) -> Dict[str, float]:
+    """启动一次服务，返回就绪和第一条对话的耗时（秒）"""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, 'chat_api.py'], cwd=HERE, env={**env, 'PORT': str(port)},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"chat_api.py 启动失败，退出码 {process.returncode}")
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError(f"chat_api.py {timeout}秒内未就绪")
+            try:
+                if request(port, 'GET', '/api/health', timeout=1.0)[0] == 200:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.01)
+        ready = time.perf_counter() - start
+
+        _, session = request(port, 'POST', '/api/chat/session', {'prompt_type': 'travel'})
+        status, reply = request(port, 'POST', '/api/chat/message', {
+            'session_id': session['session_id'], 'message': '北京三日游推荐', 'max_tokens': 32
+        })
+        if status != 200:
+            raise RuntimeError(f"第一条对话失败: {reply}")
+        return {
+            'ready_seconds': ready,
+            'first_chat_seconds': time.perf_counter() - start
+        }
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(args) -> Dict[str, Any]:
+    mock_port = start_mock()
+    env = service_env(mock_port)
+    # 导入耗时单独测量，不让后台预加载线程混入
+    import_env = {**env, 'LLM_WARMUP': '0'}
+    imports = measure_imports('chat_api', args.runs, import_env)
+    llm_load = [measure_llm_load(import_env) for _ in range(args.runs)]
+    samples = [measure_ready(env, args.timeout) for _ in range(args.runs)]
+    return {
+        'config': {'runs': args.runs, 'python': sys.version.split()[0], 'warmup': env.get('LLM_WARMUP', '1')},
+        'import_ms': imports['total_ms'],
+        'slowest_imports': imports['slowest'],
+        'deferred': imports['deferred'],
+        'llm_load_ms': round(statistics.median(llm_load), 1),
+        'ready_ms': round(statistics.median(s['ready_seconds'] for s in samples) * 1000, 1),
+        'first_chat_ms': round(statistics.median(s['first_chat_seconds'] for s in samples) * 1000, 1)
+    }
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    def delta(key: str) -> str:
+        if not baseline or not baseline.get(key):
+            return ''
+        return f"  ({(report[key] - baseline[key]) / baseline[key] * 100:+.1f}%)"
+
+    config = report['config']
+    print(f"⏱️  冷启动（{config['runs']} 次取中位数，Python {config['python']}，LLM_WARMUP={config['warmup']}）")
+    print(f"   import chat_api:   {report['import_ms']:>8.1f} ms{delta('import_ms')}")
+    print(f"   加载LLM（推迟）:   {report['llm_load_ms']:>8.1f} ms{delta('llm_load_ms')}")
+    print(f"   /api/health 就绪:  {report['ready_ms']:>8.1f} ms{delta('ready_ms')}")
+    print(f"   第一条对话返回:    {report['first_chat_ms']:>8.1f} ms{delta('first_chat_ms')}")
+    print("   最慢的直接依赖:")
+    for item in report['slowest_imports']:
+        print(f"     {item['module']:<28} {item['ms']:>7.1f} ms")
+    deferred = ', '.join(f"{name} {'✅' if ok else '❌'}" for name, ok in report['deferred'].items())
+    print(f"   启动时未加载: {deferred}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='服务冷启动基准')
+    parser.add_argument('--runs', type=int, default=5, help='测量次数（取中位数）')
+    parser.add_argument('--timeout', type=float, default=30.0, help='等待服务就绪的秒数')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    parser.add_argument('--baseline', help='与之前保存的结果对比')
+    args = parser.parse_args()
+
+    report = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+同一会话并发压力校验
+在进程内启动 --echo 模式的模拟上游（回复以对应的用户消息开头），
+每个会话由多个并发写入者各自按顺序发送消息，结束后逐个会话检查历史：
+- 没有丢失：每条用户消息及其回复都在历史中，且只出现一次
+- 没有交错：每条用户消息后紧跟的正是它自己的回复
+- 没有乱序：同一写入者的消息按发送顺序出现
+
+任何会话不满足时以非零状态退出。--unlocked 关闭会话锁作对照，用于确认校验能发现问题。
+
+示例:
+    python stress_sessions.py --mode sync --sessions 20 --writers 8 --messages 10
+    python stress_sessions.py --mode async --sessions 50 --writers 16 --messages 5
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import List, Tuple
+
+from mock_deepseek_server import MockConfig, create_server
+
+
+def start_mock(latency: str) -> int:
+    config = MockConfig(latency=latency, tokens_per_second=100000, completion_tokens='3,8', echo=True)
+    server = create_server('127.0.0.1', 0, config)
+    threading.Thread(target=server.serve_forever, name='mock-upstream', daemon=True).start()
+    return server.server_address[1]
+
+
+def message_text(writer: int, seq: int) -> str:
+    return f"w{writer}-m{seq}"
+
+
+def run_sync(chain, session_ids: List[str], writers: int, messages: int, stream: bool) -> List[str]:
+    errors = []
+
+    def writer_loop(session_id: str, writer: int):
+        for seq in range(messages):
+            text = message_text(writer, seq)
+            if stream:
+                events = list(chain.chat_stream(session_id, text, temperature=0.7, max_tokens=32))
+                failed = [event for event in events if event['type'] == 'error']
+                if failed:
+                    errors.append(f"{session_id} {text}: {failed[0]['error']}")
+            else:
+                result = chain.chat(session_id, text, temperature=0.7, max_tokens=32)
+                if not result['success']:
+                    errors.append(f"{session_id} {text}: {result['error']}")
+
+    with ThreadPoolExecutor(max_workers=len(session_ids) * writers) as executor:
+        futures = [
+            executor.submit(writer_loop, session_id, writer)
+            for session_id in session_ids for writer in range(writers)
+        ]
+        for future in futures:
+            future.result()
+    return errors
+
+
+def run_async(chain, session_ids: List[str], writers: int, messages: int) -> List[str]:
+    errors = []
+
+    async def writer_loop(session_id: str, writer: int):
+        for seq in range(messages):
+            text = message_text(writer, seq)
+            result = await chain.achat(session_id, text, temperature=0.7, max_tokens=32)
+            if not result['success']:
+                errors.append(f"{session_id} {text}: {result['error']}")
+
+    async def main():
+        await asyncio.gather(*(
+            writer_loop(session_id, writer) for session_id in session_ids for writer in range(writers)
+        ))
+
+    asyncio.run(main())
+    return errors
+
+
+def verify(chain, session_id: str, writers: int, messages: int) -> List[str]:
+    """检查一个会话的历史，返回发现的问题"""
+    history = [message for message in chain.conversation_manager.get_history(session_id) if message.role != 'system']
+    problems = []
+    expected = writers * messages * 2
+    if len(history) != expected:
+        problems.append(f"消息数 {len(history)}，应为 {expected}")
+
+    seen = set()
+    last_seq = [-1] * writers
+    for index in range(0, len(history) - 1, 2):
+        user, reply = history[index], history[index + 1]
+        if user.role != 'user' or reply.role != 'assistant':
+            problems.append(f"第{index}条起角色为 {user.role}/{reply.role}")
+            break
+        if not reply.content.startswith(user.content + '｜'):
+            problems.append(f"第{index}条 {user.content} 的回复是 {reply.content.split('｜')[0]} 的")
+            break
+        writer, seq = (int(part[1:]) for part in user.content.split('-'))
+        if (writer, seq) in seen:
+            problems.append(f"{user.content} 重复出现")
+        seen.add((writer, seq))
+        if seq <= last_seq[writer]:
+            problems.append(f"写入者{writer}的 m{seq} 出现在 m{last_seq[writer]} 之后")
+        last_seq[writer] = max(last_seq[writer], seq)
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同一会话并发压力校验')
+    parser.add_argument('--mode', choices=('sync', 'stream', 'async'), default='sync')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--writers', type=int, default=8, help='每个会话的并发写入者数')
+    parser.add_argument('--messages', type=int, default=10, help='每个写入者发送的消息数')
+    parser.add_argument('--latency', default='uniform:0.001,0.02', help='模拟上游的首字延迟分布')
+    parser.add_argument('--unlocked', action='store_true', help='对照：关闭会话锁')
+    args = parser.parse_args()
+
+    port = start_mock(args.latency)
+    os.environ['SILICON_FLOW_API_KEY'] = 'mock'
+    os.environ['SILICON_FLOW_API_URL'] = f'http://127.0.0.1:{port}/v1'
+    os.environ.setdefault('SESSION_STORE', 'memory')
+    from advanced_deepseek_chain import AdvancedDeepSeekChain
+
+    # 历史容量足以保存全部消息，便于完整校验
+    chain = AdvancedDeepSeekChain(max_history=args.writers * args.messages + 1)
+    if args.unlocked:
+        chain._turn_lock = lambda session_id: nullcontext()
+        chain._aturn_lock = lambda session_id: nullcontext()
+    session_ids = [chain.create_session('travel') for _ in range(args.sessions)]
+
+    start = time.perf_counter()
+    if args.mode == 'async':
+        errors = run_async(chain, session_ids, args.writers, args.messages)
+    else:
+        errors = run_sync(chain, session_ids, args.writers, args.messages, stream=args.mode == 'stream')
+    elapsed = time.perf_counter() - start
+
+    failures: List[Tuple[str, List[str]]] = []
+    for session_id in session_ids:
+        problems = verify(chain, session_id, args.writers, args.messages)
+        if problems:
+            failures.append((session_id, problems))
+
+    turns = args.sessions * args.writers * args.messages
+    print(f"🔒 {args.mode}: {args.sessions} 个会话 × {args.writers} 个写入者 × {args.messages} 条，"
+          f"共 {turns} 轮，用时 {elapsed:.2f}秒（{turns / elapsed:.0f} 轮/秒）")
+    print(f"   会话锁: {'关闭' if args.unlocked else chain.session_locks.get_stats()}")
+    for error in errors[:5]:
+        print(f"   ❌ 请求失败 {error}")
+    for session_id, problems in failures[:5]:
+        print(f"   ❌ 会话 {session_id}: {'；'.join(problems[:3])}")
+    if errors or failures:
+        print(f"   失败: {len(errors)} 个请求，{len(failures)}/{args.sessions} 个会话的历史不一致")
+        sys.exit(1)
+    print("   ✅ 所有会话的历史完整且有序")
+
+
+if __name__ == '__main__':
+    main()
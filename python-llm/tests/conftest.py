@@ -0,0 +1,54 @@
+"""
+pytest 配置：python-llm 下的模块是平铺的，测试时把该目录加入导入路径；
+并提供进程内的模拟上游和后端路由
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend_router import Backend, BackendRouter
+from mock_deepseek_server import MockConfig, create_server
+
+
+@pytest.fixture
+def mock_upstream():
+    """启动进程内的模拟上游，返回 base_url；参数同 MockConfig"""
+    servers = []
+
+    def start(**config) -> str:
+        config.setdefault('latency', 'fixed:0.01')
+        config.setdefault('tokens_per_second', 100000)
+        config.setdefault('completion_tokens', '8,16')
+        server = create_server('127.0.0.1', 0, MockConfig(**config))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_address[1]}/v1'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def use_backends(monkeypatch):
+    """让 DeepSeekV3Client 按顺序使用给定的 (名称, base_url) 后端"""
+    import advanced_deepseek_chain
+    import deepseek_client
+
+    def install(*endpoints) -> BackendRouter:
+        backends = [
+            Backend(name=name, base_url=base_url, model='test-model', api_key='mock', alpha=0.3)
+            for name, base_url in endpoints
+        ]
+        router = BackendRouter(backends, {}, 'test-model')
+        monkeypatch.setattr(deepseek_client, 'get_router', lambda: router)
+        monkeypatch.setattr(advanced_deepseek_chain, 'get_router', lambda: router)
+        return router
+
+    return install
@@ -0,0 +1,93 @@
+"""
+Flask接口的参数校验
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault('SILICON_FLOW_API_KEY', 'mock')
+os.environ.setdefault('LLM_WARMUP', '0')
+
+import chat_api  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return chat_api.app.test_client()
+
+
+@pytest.fixture
+def session_id(client):
+    return client.post('/api/chat/session', json={}).get_json()['session_id']
+
+
+@pytest.mark.parametrize('since, status', [
+    ('garbage', 400),
+    ('2025-13-01', 400),
+    ('2025-01-01T08:00:00', 200),
+])
+def test_history_validates_since(client, session_id, since, status):
+    response = client.get(f'/api/chat/history/{session_id}', query_string={'since': since})
+    assert response.status_code == status
+    assert response.get_json()['success'] is (status == 200)
+
+
+@pytest.mark.parametrize('options', [
+    {'temperature': 'hot'},
+    {'temperature': -1},
+    {'max_tokens': 'abc'},
+    {'max_tokens': 0},
+])
+def test_message_rejects_bad_options(client, options):
+    response = client.post('/api/chat/message', json={'message': '北京三日游推荐', **options})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+@pytest.mark.parametrize('options', [
+    {'max_workers': 'many'},
+    {'temperature': 'hot'},
+    {'temperature': 'nan'},
+    {'temperature': -1},
+    {'max_tokens': '2k'},
+    {'max_tokens': 0},
+])
+def test_batch_rejects_bad_options(client, options):
+    response = client.post('/api/chat/batch', json={'prompts': ['北京三日游推荐'], **options})
+    assert response.status_code == 400
+    assert response.get_json()['success'] is False
+
+
+def test_batch_clamps_max_workers(client, monkeypatch):
+    seen = {}
+
+    def fake_run_batch(chain, items, prompt_type, max_workers, checkpoint, **model_params):
+        seen.update(max_workers=max_workers, **model_params)
+        return iter([])
+
+    monkeypatch.setattr(chat_api, 'run_batch', fake_run_batch)
+    response = client.post('/api/chat/batch', query_string={'max_workers': '0', 'temperature': '0.2'},
+                           data='北京三日游推荐\n', content_type='text/plain')
+    assert response.status_code == 200
+    response.get_data()
+    assert seen == {'max_workers': 1, 'temperature': 0.2, 'max_tokens': 2048}
+
+
+
+def test_session_pages_follow_cursor(client):
+    created = [client.post('/api/chat/session', json={}).get_json()['session_id'] for _ in range(5)]
+    keys = []
+    query = {'limit': 2}
+    while True:
+        page = client.get('/api/chat/sessions', query_string=query).get_json()
+        keys.extend((item['last_activity'], item['session_id']) for item in page['sessions'])
+        if len(keys) == 2:
+            # 翻页期间新建的会话排在游标之前，不会出现在后面的页中
+            created.append(client.post('/api/chat/session', json={}).get_json()['session_id'])
+        if page['next_cursor'] is None:
+            break
+        query['cursor'] = page['next_cursor']
+    assert keys == sorted(set(keys), reverse=True)
+    listed = {session_id for _, session_id in keys}
+    assert set(created[:-1]) <= listed and created[-1] not in listed
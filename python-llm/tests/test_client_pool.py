@@ -0,0 +1,34 @@
+"""
+OpenAI客户端池：异步客户端按事件循环隔离
+"""
+
+import asyncio
+
+from client_pool import OpenAIClientPool
+
+
+async def get_client(pool: OpenAIClientPool):
+    return pool.get_async_client('key', 'http://127.0.0.1:1/v1')
+
+
+def test_async_clients_are_per_loop_and_closed_loops_are_released():
+    pool = OpenAIClientPool()
+    first = asyncio.run(get_client(pool))
+    second = asyncio.run(get_client(pool))
+    assert first is not second
+    # 已关闭的循环上的客户端不再保留（无引用时随循环回收，否则在下次创建客户端时丢弃）
+    assert all(not loop.is_closed() for loop in pool._async_clients)
+
+
+def test_same_loop_shares_client_until_aclose():
+    pool = OpenAIClientPool()
+
+    async def scenario():
+        first = await get_client(pool)
+        assert await get_client(pool) is first
+        await pool.aclose()
+        assert await get_client(pool) is not first
+        await pool.aclose()
+
+    asyncio.run(scenario())
+    assert len(pool._async_clients) == 0
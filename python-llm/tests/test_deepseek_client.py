@@ -0,0 +1,95 @@
+"""
+上游调用：后端切换与相同请求合并
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+import deepseek_client
+from deepseek_client import DeepSeekV3Client
+from llm_errors import InternalError, UpstreamConnectionError, UpstreamRequestError, classify_error
+from resilience import RetryPolicy
+from single_flight import SingleFlight, get_single_flight
+
+MESSAGES = [{'role': 'user', 'content': '北京三日游推荐'}]
+
+
+@pytest.fixture(autouse=True)
+def no_retry(monkeypatch):
+    monkeypatch.setattr(deepseek_client, '_get_retry_policy', lambda: RetryPolicy(max_attempts=1))
+
+
+def test_request_error_is_not_failed_over(mock_upstream, use_backends):
+    router = use_backends(
+        ('bad-request', mock_upstream(error_rate=1.0, error_statuses='400')),
+        ('healthy', mock_upstream())
+    )
+    first, second = router.backends
+    with pytest.raises(UpstreamRequestError):
+        DeepSeekV3Client(model_name='test-model').call_with_messages(MESSAGES)
+    assert second.requests == 0
+    # 请求本身的错误不计入后端的错误率
+    assert first.failures == 0 and first.ewma_error == 0.0 and first.in_flight == 0
+
+
+def test_server_error_fails_over(mock_upstream, use_backends):
+    router = use_backends(
+        ('broken', mock_upstream(error_rate=1.0, error_statuses='500')),
+        ('healthy', mock_upstream())
+    )
+    first, second = router.backends
+    assert DeepSeekV3Client(model_name='test-model').call_with_messages(MESSAGES)
+    assert first.failures == 1
+    assert second.requests == 1
+
+
+def test_only_sdk_errors_are_upstream_errors():
+    import httpx
+
+    assert isinstance(classify_error(httpx.ConnectError('refused')), UpstreamConnectionError)
+    # 本服务自身的异常（如参数类型错误）不应伪装成上游故障
+    error = classify_error(TypeError("'<' not supported between instances of 'str' and 'int'"))
+    assert isinstance(error, InternalError)
+    assert error.status_code == 500 and not error.retryable
+
+
+def test_coalesced_waiters_do_not_report_usage(mock_upstream, use_backends):
+    assert get_single_flight().enabled
+    use_backends(('slow', mock_upstream(latency='fixed:0.3')))
+    client = DeepSeekV3Client(model_name='test-model')
+    reports = []
+    results = []
+    barrier = threading.Barrier(4)
+
+    def call():
+        barrier.wait()
+        results.append(client.call_with_messages(MESSAGES, temperature=0.0, on_usage=reports.append))
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and len(set(results)) == 1
+    assert len(reports) == 1
+
+
+def test_async_coalescing_is_per_loop():
+    flight = SingleFlight(enabled=True)
+
+    async def run():
+        async def fetch():
+            await asyncio.sleep(0.05)
+            return asyncio.get_running_loop()
+
+        return await asyncio.gather(*(flight.ado('same', fetch) for _ in range(3)))
+
+    # 先后两个事件循环各自合并，结果不会串到已关闭的循环的任务上
+    first = asyncio.run(run())
+    second = asyncio.run(run())
+    assert len(set(first)) == 1 and len(set(second)) == 1
+    assert first[0] is not second[0]
+    assert flight.leaders == 2 and flight.coalesced == 4
+    assert flight.get_stats()['in_flight'] == 0
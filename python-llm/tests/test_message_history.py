@@ -0,0 +1,50 @@
+"""
+有界对话历史：OpenAI格式视图
+"""
+
+from message_history import Message, MessageHistory
+
+
+def make_history(capacity=4, trim_step=1) -> MessageHistory:
+    history = MessageHistory(capacity, trim_step)
+    history.append(Message('system', '你是旅行规划师'))
+    return history
+
+
+def test_api_dicts_are_reused_across_turns():
+    history = make_history()
+    history.append(Message('user', '北京三日游推荐'))
+    first = history.api_messages()
+    history.append(Message('assistant', '第一天故宫'))
+    second = history.api_messages()
+    assert second is not first
+    assert [id(message) for message in second[:2]] == [id(message) for message in first]
+    assert second[-1] == {'role': 'assistant', 'content': '第一天故宫'}
+
+
+def test_sliding_window_drops_oldest_dicts():
+    history = make_history(capacity=2)
+    for i in range(3):
+        history.append(Message('user', str(i)))
+    assert history.api_messages() == [
+        {'role': 'system', 'content': '你是旅行规划师'},
+        {'role': 'user', 'content': '1'},
+        {'role': 'user', 'content': '2'}
+    ]
+
+
+def test_window_reuses_dicts_and_keeps_latest_message():
+    history = make_history(capacity=10)
+    for i in range(5):
+        history.append(Message('user', '消息' * 50 + str(i)))
+    full = history.api_messages()
+    view, tokens = history.window(1)
+    assert view[0] is full[0] and view[-1] is full[-1]
+    assert len(view) == 2 and tokens > 1
+
+
+def test_clear_keeps_system_prompt():
+    history = make_history()
+    history.append(Message('user', 'hi'))
+    history.clear()
+    assert history.api_messages() == [{'role': 'system', 'content': '你是旅行规划师'}]
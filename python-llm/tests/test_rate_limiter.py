@@ -0,0 +1,137 @@
+"""
+配额调度：预扣与按实际用量退还
+"""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import deepseek_client
+from deepseek_client import DeepSeekV3Client
+from llm_errors import QuotaExceededError
+from metrics import usage_tokens
+from rate_limiter import QuotaScheduler
+from resilience import RetryPolicy
+
+
+def usage(total: int) -> SimpleNamespace:
+    return SimpleNamespace(prompt_tokens=total // 2, completion_tokens=total - total // 2, total_tokens=total)
+
+
+def available(scheduler: QuotaScheduler) -> int:
+    return scheduler.get_stats()['tpm_available']
+
+
+def test_settle_refunds_unused_reservation():
+    scheduler = QuotaScheduler(tpm=60000, headroom=1.0)
+    reserved = scheduler.acquire(10000)
+    assert reserved == 10000
+    assert available(scheduler) == pytest.approx(50000, abs=50)
+    scheduler.settle(reserved, usage(3000))
+    assert scheduler.tokens_refunded == 7000
+    assert available(scheduler) == pytest.approx(57000, abs=50)
+
+
+def test_settle_without_usage_keeps_reservation():
+    scheduler = QuotaScheduler(tpm=60000, headroom=1.0)
+    reserved = scheduler.acquire(10000)
+    scheduler.settle(reserved, None)
+    scheduler.settle(reserved, usage(20000))
+    assert scheduler.tokens_refunded == 0
+
+
+def test_settle_accepts_usage_dict():
+    scheduler = QuotaScheduler(tpm=60000, headroom=1.0)
+    scheduler.settle(scheduler.acquire(10000), {'total_tokens': 4000})
+    assert scheduler.tokens_refunded == 6000
+
+
+def test_disabled_scheduler_reserves_nothing():
+    scheduler = QuotaScheduler(rpm=0, tpm=0)
+    assert scheduler.acquire(10000) == 0
+    scheduler.settle(0, usage(10))
+
+
+def test_queue_times_out_when_quota_is_exhausted():
+    scheduler = QuotaScheduler(rpm=1, headroom=1.0)
+    scheduler.acquire(1)
+    with pytest.raises(QuotaExceededError):
+        scheduler.acquire(1, timeout=0.05)
+    assert scheduler.get_stats()['queued'] == 0
+
+
+def test_interactive_requests_are_admitted_before_batch():
+    scheduler = QuotaScheduler(rpm=60, headroom=1.0, max_wait=10)
+    for _ in range(60):
+        scheduler.acquire(1)
+    order = []
+
+    def worker(priority):
+        scheduler.acquire(1, priority)
+        order.append(priority)
+
+    batch = threading.Thread(target=worker, args=('batch',))
+    batch.start()
+    time.sleep(0.05)
+    interactive = threading.Thread(target=worker, args=('interactive',))
+    interactive.start()
+    batch.join()
+    interactive.join()
+    assert order == ['interactive', 'batch']
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = QuotaScheduler(tpm=600000, headroom=1.0)
+    monkeypatch.setattr(deepseek_client, 'get_quota_scheduler', lambda: scheduler)
+    return scheduler
+
+
+def test_stream_settles_reservation(scheduler, mock_upstream, use_backends):
+    use_backends(('mock', mock_upstream()))
+    client = DeepSeekV3Client(model_name='test-model', max_tokens=2000)
+    reported = []
+    chunks = list(client.stream_with_messages([{'role': 'user', 'content': '北京三日游推荐'}], on_usage=reported.append))
+    assert chunks and len(reported) == 1
+    reserved = scheduler.estimate_cost([{'role': 'user', 'content': '北京三日游推荐'}], 2000)
+    assert scheduler.tokens_refunded == reserved - usage_tokens(reported[0], 'total_tokens')
+
+
+def test_async_stream_settles_reservation(scheduler, mock_upstream, use_backends):
+    use_backends(('mock', mock_upstream()))
+    client = DeepSeekV3Client(model_name='test-model', max_tokens=2000)
+
+    async def consume():
+        return [chunk async for chunk in client.astream_with_messages([{'role': 'user', 'content': 'hi'}])]
+
+    assert asyncio.run(consume())
+    assert scheduler.tokens_refunded > 0
+
+
+def test_aborted_stream_keeps_reservation(scheduler, mock_upstream, use_backends):
+    use_backends(('mock', mock_upstream(completion_tokens='200', tokens_per_second=2000)))
+    client = DeepSeekV3Client(model_name='test-model', max_tokens=2000)
+    stream = client.stream_with_messages([{'role': 'user', 'content': 'hi'}])
+    next(stream)
+    stream.close()
+    # 提前中断时拿不到用量，预扣的token不退还
+    assert scheduler.tokens_refunded == 0
+
+
+def test_each_attempt_is_admitted_and_failures_refunded(scheduler, mock_upstream, use_backends, monkeypatch):
+    monkeypatch.setattr(deepseek_client, '_get_retry_policy', lambda: RetryPolicy(max_attempts=2, base_delay=0))
+    use_backends(
+        ('broken', mock_upstream(error_rate=1.0, error_statuses='503')),
+        ('healthy', mock_upstream())
+    )
+    client = DeepSeekV3Client(model_name='test-model', max_tokens=2000)
+    messages = [{'role': 'user', 'content': '北京三日游推荐'}]
+    reported = []
+    assert client.call_with_messages(messages, on_usage=reported.append)
+    # broken 上的两次尝试和 healthy 上的一次各自排队申请配额，失败的两次全额退还
+    assert scheduler.admitted == 3
+    reserved = scheduler.estimate_cost(messages, 2000)
+    assert scheduler.tokens_refunded == 3 * reserved - usage_tokens(reported[0], 'total_tokens')
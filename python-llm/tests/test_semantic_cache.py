@@ -0,0 +1,65 @@
+"""
+语义缓存的命中规则
+"""
+
+import pytest
+
+from semantic_cache import SemanticCache, canonicalize
+
+
+def make_cache(**kwargs) -> SemanticCache:
+    return SemanticCache(path='', max_entries=16, ttl=0, **kwargs)
+
+
+@pytest.mark.parametrize('cached, question', [
+    ('北京三日游推荐', '推荐一个北京3天行程'),
+    ('请问北京三日游怎么安排？', '北京3日游推荐'),
+])
+def test_similar_phrasing_hits(cached, question):
+    cache = make_cache()
+    cache.put('travel', cached, '行程A')
+    hit = cache.get('travel', question)
+    assert hit is not None and hit[0] == '行程A'
+
+
+@pytest.mark.parametrize('cached, question', [
+    ('北京3天行程推荐，带老人', '北京3天行程推荐，不带老人'),
+    ('要去长城', '不要去长城'),
+    ('吃辣', '不吃辣'),
+    ('北京三日游有没有推荐', '北京三日游有推荐'),
+])
+def test_negation_never_hits(cached, question):
+    # 放宽阈值和字符差异，确认是否定词校验拒绝了命中
+    cache = make_cache(threshold=0.3, max_char_diff=2)
+    cache.put('travel', cached, '行程A')
+    assert cache.get('travel', question) is None
+    assert cache.get_stats()['rejected'] == 1
+
+
+@pytest.mark.parametrize('cached, question', [
+    ('北京三日游推荐', '南京三日游推荐'),
+    ('北京三日游推荐', '北京五日游推荐'),
+    ('北京到上海行程', '上海到北京行程'),
+])
+def test_different_places_or_numbers_miss(cached, question):
+    cache = make_cache()
+    cache.put('travel', cached, '行程A')
+    assert cache.get('travel', question) is None
+
+
+def test_max_char_diff_allows_small_ordered_edits():
+    cache = make_cache(max_char_diff=1)
+    cache.put('travel', '北京3天行程推荐带老人', '行程A')
+    assert cache.get('travel', '北京3天行程推荐带老年人') is not None
+    assert cache.get('travel', '北京3天行程推荐带小孩') is None
+
+
+def test_partitions_are_isolated():
+    cache = make_cache()
+    cache.put('travel', '北京三日游推荐', '行程A')
+    assert cache.get('code', '北京三日游推荐') is None
+
+
+def test_canonicalize_numbers_and_synonyms():
+    assert canonicalize('请问北京三日游怎么安排？') == '北京3天行程推荐'
+    assert canonicalize('推荐一个北京两日游') == '推荐北京2天行程'
@@ -0,0 +1,164 @@
+"""
+按会话加锁：同一会话的轮次依次执行，不同会话互不阻塞
+"""
+
+import asyncio
+import threading
+import time
+
+from session_lock import SessionLocks
+
+
+def test_same_session_is_serialized():
+    locks = SessionLocks()
+    active = []
+    overlaps = []
+
+    def turn(i):
+        with locks.hold('s1'):
+            active.append(i)
+            if len(active) > 1:
+                overlaps.append(tuple(active))
+            time.sleep(0.01)
+            active.remove(i)
+
+    threads = [threading.Thread(target=turn, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == []
+    assert locks.get_stats() == {'active_sessions': 0, 'contended': locks.contended}
+    assert locks.contended > 0
+
+
+def test_different_sessions_do_not_block_each_other():
+    locks = SessionLocks()
+    entered = threading.Event()
+    with locks.hold('s1'):
+        def other():
+            with locks.hold('s2'):
+                entered.set()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        assert entered.wait(1)
+        thread.join()
+
+
+def test_sync_and_async_share_the_lock():
+    locks = SessionLocks()
+    order = []
+
+    async def async_turn():
+        async with locks.ahold('s1'):
+            order.append('async')
+
+    with locks.hold('s1'):
+        thread = threading.Thread(target=lambda: asyncio.run(async_turn()))
+        thread.start()
+        time.sleep(0.05)
+        order.append('sync')
+    thread.join()
+    assert order == ['sync', 'async']
+
+
+def test_cancelled_waiter_does_not_leak_lock():
+    locks = SessionLocks()
+
+    async def scenario():
+        async def waiter():
+            async with locks.ahold('s1'):
+                pass
+
+        with locks.hold('s1'):
+            task = asyncio.ensure_future(waiter())
+            await asyncio.sleep(0.02)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        async with locks.ahold('s1'):
+            pass
+
+    asyncio.run(asyncio.wait_for(scenario(), 2))
+    assert locks.get_stats()['active_sessions'] == 0
+
+
+def test_concurrent_turns_keep_user_and_reply_adjacent(mock_upstream, use_backends, monkeypatch):
+    monkeypatch.setenv('SESSION_STORE', 'memory')
+    from advanced_deepseek_chain import AdvancedDeepSeekChain
+
+    use_backends(('mock', mock_upstream(echo=True, latency='uniform:0.005,0.03')))
+    chain = AdvancedDeepSeekChain(max_history=50)
+    session_id = chain.create_session()
+    barrier = threading.Barrier(6)
+
+    def writer(w):
+        barrier.wait()
+        for i in range(3):
+            assert chain.chat(session_id, f'w{w}-m{i}', temperature=0.9, max_tokens=16)['success']
+
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    history = [m for m in chain.conversation_manager.get_conversation_history(session_id) if m['role'] != 'system']
+    assert len(history) == 36
+    for user, reply in zip(history[::2], history[1::2]):
+        assert user['role'] == 'user' and reply['role'] == 'assistant'
+        assert reply['content'].startswith(user['content'])
+    # 每个写入者自己的消息保持发送顺序
+    for w in range(6):
+        sent = [m['content'] for m in history[::2] if m['content'].startswith(f'w{w}-')]
+        assert sent == [f'w{w}-m{i}' for i in range(3)]
+
+
+def test_compaction_does_not_race_with_context_reads():
+    from advanced_deepseek_chain import ConversationManager
+    from session_store import InMemorySessionStore
+
+    manager = ConversationManager(max_history=1000, store=InMemorySessionStore())
+    session_id = manager.create_session()
+    manager.add_message(session_id, 'system', '系统提示')
+    stop = threading.Event()
+    errors = []
+
+    def turns():
+        i = 0
+        while not stop.is_set():
+            manager.add_message(session_id, 'user', f'm{i}')
+            i += 1
+
+    def compactions():
+        while not stop.is_set():
+            snapshot = manager.oldest_messages(session_id, keep_recent=4)
+            if snapshot and snapshot[2]:
+                history, generation, folded = snapshot
+                manager.apply_summary(session_id, history, generation, folded, f'摘要至 {folded[-1].content}')
+
+    def reads():
+        while not stop.is_set():
+            try:
+                for messages in (manager.get_conversation_history(session_id),
+                                 manager.get_context_window(session_id, 10 ** 6)[0]):
+                    # 被折叠的消息和替代它们的摘要必须同时可见：第一条消息之前的都已在摘要中
+                    first = next(m['content'] for m in messages if m['role'] == 'user')
+                    summary = [m['content'] for m in messages if m['content'].startswith('摘要至')]
+                    if first != 'm0':
+                        assert summary and summary[0] == f'摘要至 m{int(first[1:]) - 1}', (first, summary)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+    threads = [threading.Thread(target=fn) for fn in (turns, compactions, reads, reads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1.0)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors[0]
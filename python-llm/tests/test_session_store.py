@@ -0,0 +1,113 @@
+"""
+SQLite会话存储的批量提交与失败恢复
+"""
+
+import sqlite3
+import time
+
+import pytest
+
+from message_history import Message
+from session_store import SQLiteSessionStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'sessions.db')
+
+
+def make_store(path, **kwargs) -> SQLiteSessionStore:
+    kwargs.setdefault('batch_size', 1000)
+    kwargs.setdefault('flush_interval', 0.05)
+    store = SQLiteSessionStore(path, **kwargs)
+    # 数据库被锁住时尽快失败，不等默认的30秒
+    store._conn.execute('PRAGMA busy_timeout=50')
+    return store
+
+
+def count_messages(path, session_id):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_load_sees_own_buffered_writes(db_path):
+    store = make_store(db_path, flush_interval=60)
+    try:
+        store.save_session('s1', {'prompt_type': 'travel'})
+        store.append_message('s1', Message('user', '北京三日游推荐'))
+        info, messages = store.load_session('s1', 10)
+        assert info == {'prompt_type': 'travel'}
+        assert [m.content for m in messages] == ['北京三日游推荐']
+    finally:
+        store.close()
+
+
+def test_batch_is_committed_by_background_writer(db_path):
+    store = make_store(db_path, batch_size=4, flush_interval=60)
+    try:
+        for i in range(4):
+            store.append_message('s1', Message('user', str(i)))
+        deadline = time.time() + 2
+        while count_messages(db_path, 's1') < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        assert count_messages(db_path, 's1') == 4
+    finally:
+        store.close()
+
+
+def test_locked_database_does_not_block_writers_and_recovers(db_path):
+    store = make_store(db_path)
+    blocker = sqlite3.connect(db_path, isolation_level=None)
+    blocker.execute('BEGIN EXCLUSIVE')
+    try:
+        start = time.perf_counter()
+        for i in range(100):
+            store.append_message('s1', Message('user', str(i)))
+        assert time.perf_counter() - start < 0.5
+        assert store.flush(timeout=0.3) is False
+        assert store.get_stats()['pending_writes'] == 100
+        assert store.failed_flushes > 0
+    finally:
+        blocker.execute('ROLLBACK')
+        blocker.close()
+    try:
+        assert store.flush(timeout=2)
+        assert count_messages(db_path, 's1') == 100
+        assert store.get_stats()['pending_writes'] == 0
+    finally:
+        store.close()
+
+
+def test_buffer_is_capped_while_database_is_locked(db_path):
+    store = make_store(db_path, max_pending=10)
+    blocker = sqlite3.connect(db_path, isolation_level=None)
+    blocker.execute('BEGIN EXCLUSIVE')
+    try:
+        for i in range(25):
+            store.append_message('s1', Message('user', str(i)))
+        stats = store.get_stats()
+        assert stats['pending_writes'] <= 10
+        assert stats['dropped_writes'] >= 15
+    finally:
+        blocker.execute('ROLLBACK')
+        blocker.close()
+    try:
+        assert store.flush(timeout=2)
+        # 保留的是最新的写操作
+        conn = sqlite3.connect(db_path)
+        contents = [row[0] for row in conn.execute('SELECT content FROM messages ORDER BY id')]
+        conn.close()
+        assert contents == [str(i) for i in range(15, 25)]
+    finally:
+        store.close()
+
+
+def test_close_commits_remaining_writes(db_path):
+    store = make_store(db_path, flush_interval=60)
+    store.save_session('s1', {})
+    store.append_message('s1', Message('user', 'hi'))
+    store.close()
+    assert count_messages(db_path, 's1') == 1
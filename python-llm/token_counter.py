@@ -0,0 +1,30 @@
+"""
+本地token估算
+不依赖远程分词器，按DeepSeek官方给出的字符换算比例快速估算消息的token数
+"""
+
+import math
+import re
+from typing import Dict
+
+# 中日韩文字、全角符号等按“1个字符≈0.6个token”计
+_CJK_RE = re.compile('[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+CJK_TOKENS_PER_CHAR = 0.6
+# 英文、数字、半角符号按“1个字符≈0.3个token”计
+OTHER_TOKENS_PER_CHAR = 0.3
+# 每条消息的角色标记和分隔符开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """估算一段文本的token数"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return math.ceil(cjk * CJK_TOKENS_PER_CHAR + other * OTHER_TOKENS_PER_CHAR)
+
+
+def estimate_message_tokens(message: Dict[str, str]) -> int:
+    """估算一条OpenAI格式消息的token数（含消息开销）"""
+    return estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
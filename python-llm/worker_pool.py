@@ -0,0 +1,513 @@
+"""
+多进程worker模式
+主进程作为轻量转发器监听对外端口，预先启动多个 chat_api.py worker 进程（各自监听本机端口）：
+- 按 session_id 的哈希把请求固定转发到同一个worker，会话的内存历史始终留在一个进程中
+- 没有 session_id 的请求轮询分配，worker 生成的新会话ID本身就哈希到该worker
+- worker 意外退出时自动拉起；收到 SIGHUP 时逐个排空在途请求后重启（滚动重启）
+- /api/health 汇总所有worker的健康状态
+- /api/metrics 汇总所有worker的指标，每条序列加上 worker 标签
+
+启动方式: python worker_pool.py --workers 4 --port 5000
+worker 重启会丢失其内存中的会话，多worker部署建议配合 SESSION_STORE=sqlite 使用。
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, List, Dict, Any
+from urllib.parse import parse_qsl
+
+logger = logging.getLogger(__name__)
+
+# 路径中携带会话ID的路由
+_SESSION_PATH_RE = re.compile(r'^/api/chat/(?:history|clear|export)/([^/?#]+)')
+# 逐跳头部，不向下一跳转发
+_HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade', 'content-length', 'host'
+}
+
+
+def worker_for_session(session_id: str, workers: int) -> int:
+    """会话所属的worker编号（跨进程稳定的哈希）"""
+    return zlib.crc32(session_id.encode('utf-8')) % workers
+
+
+def affine_session_id(worker_id: int, workers: int) -> str:
+    """生成一个哈希到指定worker的会话ID（平均尝试 workers 次）"""
+    while True:
+        session_id = str(uuid.uuid4())
+        if worker_for_session(session_id, workers) == worker_id:
+            return session_id
+
+
+class Worker:
+    """一个 chat_api.py 子进程及其在途请求计数"""
+
+    def __init__(self, worker_id: int, port: int):
+        self.worker_id = worker_id
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+        self.restarts = 0
+        self.in_flight = 0
+        # ready 为False时（启动中、排空中）新请求等待
+        self.ready = False
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        """等待worker可用并登记一个在途请求"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.ready, timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def set_ready(self, ready: bool):
+        with self._cond:
+            self.ready = ready
+            self._cond.notify_all()
+
+    def wait_drained(self, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.in_flight == 0, timeout)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'worker_id': self.worker_id,
+            'port': self.port,
+            'pid': self.process.pid if self.process else None,
+            'ready': self.ready,
+            'in_flight': self.in_flight,
+            'restarts': self.restarts
+        }
+
+
+class WorkerSupervisor:
+    """启动、监控和重启worker进程"""
+
+    def __init__(
+        self,
+        workers: int,
+        worker_port: int,
+        script: str = 'chat_api.py',
+        request_timeout: float = 300.0,
+        drain_timeout: float = 30.0,
+        startup_timeout: float = 30.0
+    ):
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+        self.workers = [Worker(i, worker_port + i) for i in range(workers)]
+        self.request_timeout = request_timeout
+        self.drain_timeout = drain_timeout
+        self.startup_timeout = startup_timeout
+        self._round_robin = itertools.count()
+        self._restart_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    def _spawn(self, worker: Worker):
+        env = dict(os.environ)
+        env.update({
+            'WORKER_ID': str(worker.worker_id),
+            'WORKER_COUNT': str(len(self.workers)),
+            'PORT': str(worker.port),
+            'HOST': '127.0.0.1'
+        })
+        worker.process = subprocess.Popen([sys.executable, self.script], env=env)
+        logger.info(f"worker {worker.worker_id} 启动，pid={worker.process.pid}，端口 {worker.port}")
+
+    def _wait_healthy(self, worker: Worker) -> bool:
+        """轮询worker的 /api/health 直到可用"""
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if worker.process.poll() is not None:
+                return False
+            if self.fetch_health(worker, timeout=1.0) is not None:
+                worker.set_ready(True)
+                return True
+            time.sleep(0.2)
+        return False
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        for worker in self.workers:
+            if not self._wait_healthy(worker):
+                logger.error(f"worker {worker.worker_id} 启动超时")
+        self._monitor = threading.Thread(target=self._monitor_loop, name='worker-monitor', daemon=True)
+        self._monitor.start()
+
+    def _monitor_loop(self):
+        """worker意外退出时自动重启"""
+        while not self._stopping.wait(1.0):
+            for worker in self.workers:
+                if worker.process.poll() is None:
+                    continue
+                with self._restart_lock:
+                    if self._stopping.is_set() or worker.process.poll() is None:
+                        continue
+                    logger.warning(f"worker {worker.worker_id} 已退出（返回码 {worker.process.returncode}），正在重启")
+                    worker.set_ready(False)
+                    worker.restarts += 1
+                    self._spawn(worker)
+                    self._wait_healthy(worker)
+
+    def _stop_process(self, worker: Worker):
+        """SIGTERM后等待退出（worker会先提交会话存储），超时则强制结束"""
+        if worker.process is None or worker.process.poll() is not None:
+            return
+        worker.process.terminate()
+        try:
+            worker.process.wait(timeout=self.drain_timeout)
+        except subprocess.TimeoutExpired:
+            worker.process.kill()
+            worker.process.wait()
+
+    def restart_worker(self, worker: Worker):
+        """排空在途请求后重启单个worker，期间发往该worker的请求排队等待"""
+        with self._restart_lock:
+            worker.set_ready(False)
+            if not worker.wait_drained(self.drain_timeout):
+                logger.warning(f"worker {worker.worker_id} 排空超时，仍有 {worker.in_flight} 个请求")
+            self._stop_process(worker)
+            worker.restarts += 1
+            self._spawn(worker)
+            if not self._wait_healthy(worker):
+                logger.error(f"worker {worker.worker_id} 重启后未就绪")
+
+    def rolling_restart(self):
+        """逐个重启所有worker，同一时间只有一个worker不可用"""
+        logger.info("开始滚动重启worker")
+        for worker in self.workers:
+            if self._stopping.is_set():
+                return
+            self.restart_worker(worker)
+        logger.info("滚动重启完成")
+
+    def stop(self):
+        self._stopping.set()
+        with self._restart_lock:
+            for worker in self.workers:
+                worker.set_ready(False)
+                if worker.process is not None and worker.process.poll() is None:
+                    worker.process.terminate()
+            for worker in self.workers:
+                self._stop_process(worker)
+
+    def route(self, session_id: Optional[str]) -> Worker:
+        """按会话ID选择worker，没有会话ID时轮询"""
+        if session_id:
+            return self.workers[worker_for_session(session_id, len(self.workers))]
+        # 优先跳过正在重启的worker
+        for _ in range(len(self.workers)):
+            worker = self.workers[next(self._round_robin) % len(self.workers)]
+            if worker.ready:
+                return worker
+        return worker
+
+    def fetch_health(self, worker: Worker, timeout: float = 2.0) -> Optional[Dict[str, Any]]:
+        """读取worker自身的 /api/health，失败时返回None"""
+        conn = HTTPConnection('127.0.0.1', worker.port, timeout=timeout)
+        try:
+            conn.request('GET', '/api/health')
+            response = conn.getresponse()
+            if response.status != 200:
+                return None
+            return json.loads(response.read())
+        except (OSError, ValueError):
+            return None
+        finally:
+            conn.close()
+
+    def fetch(self, worker: Worker, path: str) -> Optional[bytes]:
+        """向worker发送GET请求并返回响应体，失败时返回None"""
+        if not worker.acquire(self.request_timeout):
+            return None
+        conn = HTTPConnection('127.0.0.1', worker.port, timeout=self.request_timeout)
+        try:
+            conn.request('GET', path)
+            return conn.getresponse().read()
+        except OSError:
+            return None
+        finally:
+            conn.close()
+            worker.release()
+
+    def fetch_json(self, worker: Worker, path: str) -> Optional[Dict[str, Any]]:
+        """向worker发送GET请求并解析JSON结果"""
+        data = self.fetch(worker, path)
+        if data is None:
+            return None
+        try:
+            return json.loads(data)
+        except ValueError:
+            return None
+
+
+class DispatchHandler(BaseHTTPRequestHandler):
+    """把请求转发到会话所属的worker，SSE等无长度的响应边读边写"""
+
+    protocol_version = 'HTTP/1.1'
+    supervisor: WorkerSupervisor = None
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_PUT(self):
+        self._dispatch()
+
+    def do_DELETE(self):
+        self._dispatch()
+
+    def do_OPTIONS(self):
+        self._dispatch()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path = self.path.split('?', 1)[0]
+
+        if self.command == 'GET' and path == '/api/health':
+            return self._send_health()
+        if self.command == 'GET' and path == '/api/chat/sessions':
+            return self._send_sessions()
+        if self.command == 'GET' and path == '/api/metrics':
+            return self._send_metrics()
+
+        worker = self.supervisor.route(self._session_id(path, body))
+        if not worker.acquire(self.supervisor.request_timeout):
+            return self._send_json(503, {'success': False, 'error': 'worker不可用'})
+        try:
+            self._forward(worker, body)
+        finally:
+            worker.release()
+
+    def _session_id(self, path: str, body: bytes) -> Optional[str]:
+        """从路径或JSON请求体中取出会话ID"""
+        match = _SESSION_PATH_RE.match(path)
+        if match:
+            return match.group(1)
+        if body and 'json' in (self.headers.get('Content-Type') or ''):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return None
+            if isinstance(data, dict) and isinstance(data.get('session_id'), str):
+                return data['session_id']
+        return None
+
+    def _forward(self, worker: Worker, body: bytes):
+        headers = {
+            key: value for key, value in self.headers.items()
+            if key.lower() not in _HOP_BY_HOP_HEADERS
+        }
+        if body:
+            headers['Content-Length'] = str(len(body))
+
+        conn = HTTPConnection('127.0.0.1', worker.port, timeout=self.supervisor.request_timeout)
+        try:
+            try:
+                conn.request(self.command, self.path, body=body or None, headers=headers)
+                response = conn.getresponse()
+            except OSError as e:
+                return self._send_json(502, {'success': False, 'error': f'worker请求失败: {str(e)}'})
+
+            self.send_response(response.status, response.reason)
+            for key, value in response.getheaders():
+                if key.lower() not in _HOP_BY_HOP_HEADERS:
+                    self.send_header(key, value)
+
+            content_length = response.getheader('Content-Length')
+            if content_length is not None:
+                data = response.read()
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            # 长度未知（如SSE）：逐块转发，结束后关闭连接
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            while True:
+                chunk = response.read1(8192)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        finally:
+            # 客户端断开时立即关闭上游连接，worker随之结束生成
+            conn.close()
+
+    def _send_json(self, status: int, payload: Dict[str, Any]):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        # 与worker上flask_cors的默认设置一致
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_health(self):
+        workers = []
+        for worker in self.supervisor.workers:
+            info = worker.snapshot()
+            health = self.supervisor.fetch_health(worker) if worker.ready else None
+            info['status'] = health.get('status', 'unknown') if health else 'unavailable'
+            info['health'] = health
+            workers.append(info)
+
+        healthy = sum(1 for info in workers if info['status'] == 'healthy')
+        # degraded 的worker（如上游熔断）仍能处理请求
+        available = sum(1 for info in workers if info['status'] in ('healthy', 'degraded'))
+        if healthy == len(workers):
+            status = 'healthy'
+        elif available:
+            status = 'degraded'
+        else:
+            status = 'unhealthy'
+
+        self._send_json(200 if available else 503, {
+            'status': status,
+            'service': 'DeepSeek V3 Chat API',
+            'mode': 'multi-worker',
+            'healthy_workers': healthy,
+            'total_workers': len(workers),
+            'workers': workers
+        })
+
+    def _send_sessions(self):
+        """合并所有worker的会话列表
+
+        每个worker返回自身游标之后最新的 limit 个会话，全局最新的 limit 个必然在其中，
+        合并排序后截取即可；游标格式与worker相同（"last_activity,session_id"）。
+        """
+        query = self.path.partition('?')[2]
+        params = dict(parse_qsl(query))
+        # 与worker一致：limit 不是整数时按默认值处理
+        try:
+            limit = int(params.get('limit') or 50)
+        except ValueError:
+            limit = 50
+        limit = min(max(limit, 1), 500)
+
+        sessions: List[Dict[str, Any]] = []
+        total = 0
+        for worker in self.supervisor.workers:
+            result = self.supervisor.fetch_json(worker, f'/api/chat/sessions?{query}' if query else '/api/chat/sessions')
+            if result and result.get('success'):
+                sessions.extend(result['sessions'])
+                total += result.get('total_sessions', len(result['sessions']))
+        sessions.sort(key=lambda item: (item['last_activity'], item['session_id']), reverse=True)
+        sessions = sessions[:limit]
+        next_cursor = None
+        if len(sessions) >= limit:
+            next_cursor = f"{sessions[-1]['last_activity']},{sessions[-1]['session_id']}"
+        self._send_json(200, {
+            'success': True,
+            'sessions': sessions,
+            'total_sessions': total,
+            'next_cursor': next_cursor
+        })
+
+    def _send_metrics(self):
+        """合并所有worker的Prometheus指标：HELP/TYPE只保留一份，样本加上 worker 标签"""
+        # 指标名 -> [注释行, 样本行]，保持同一指标的样本连续
+        families: Dict[str, List[List[str]]] = {}
+        for worker in self.supervisor.workers:
+            data = self.supervisor.fetch(worker, '/api/metrics') if worker.ready else None
+            if data is None:
+                continue
+            label = f'worker="{worker.worker_id}"'
+            family = None
+            for line in data.decode('utf-8').splitlines():
+                if line.startswith('# '):
+                    # worker按指标分组输出，每组以 # HELP 开头
+                    family = families.setdefault(line.split(' ')[2], [[], []])
+                    if line not in family[0]:
+                        family[0].append(line)
+                elif line and family is not None:
+                    name, sep, rest = line.partition('{')
+                    if sep:
+                        family[1].append(f'{name}{{{label},{rest}')
+                    else:
+                        name, _, value = line.partition(' ')
+                        family[1].append(f'{name}{{{label}}} {value}')
+
+        lines = [line for comments, samples in families.values() for line in comments + samples]
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description='DeepSeek V3 聊天API多进程模式')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('CHAT_API_WORKERS', os.cpu_count() or 2)))
+    parser.add_argument('--host', default=os.environ.get('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 5000)))
+    parser.add_argument('--worker-port', type=int, default=int(os.environ.get('WORKER_BASE_PORT', 5100)),
+                        help='第一个worker监听的本机端口，其余依次递增')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
+    supervisor = WorkerSupervisor(args.workers, args.worker_port)
+    DispatchHandler.supervisor = supervisor
+    supervisor.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), DispatchHandler)
+    server.daemon_threads = True
+
+    def shutdown(signum, frame):
+        # serve_forever 运行在主线程，需在其他线程中调用 shutdown
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: threading.Thread(target=supervisor.rolling_restart, daemon=True).start()
+        )
+
+    print(f"🚀 DeepSeek V3 聊天API服务启动（多进程模式，{args.workers} 个worker）")
+    print(f"🌐 服务地址: http://localhost:{args.port}")
+    print("🔄 kill -HUP <pid> 可滚动重启worker")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()